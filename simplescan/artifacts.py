@@ -0,0 +1,221 @@
+"""Write detection artifacts (frames, annotated images, metadata) off the detection thread."""
+
+import collections
+import logging
+import os
+import threading
+import time
+from io import BytesIO
+from timeit import default_timer as timer
+
+import cv2
+from PIL import Image
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_writer = None
+
+
+def encode(payload):
+    """The bytes to write for a frame, image or text"""
+    if isinstance(payload, bytes):
+        return payload
+    if isinstance(payload, str):
+        return payload.encode()
+    if isinstance(payload, Image.Image):
+        buf = BytesIO()
+        payload.save(buf, "JPEG")
+        return buf.getvalue()
+    ok, buf = cv2.imencode(".jpg", payload)
+    if not ok:
+        raise ValueError("Failed to encode image")
+    return buf.tobytes()
+
+
+def size_of(payload):
+    """Approximate memory held by a queued payload"""
+    if isinstance(payload, (bytes, str)):
+        return len(payload)
+    if isinstance(payload, Image.Image):
+        return payload.width * payload.height * len(payload.getbands())
+    return payload.nbytes
+
+
+def write_now(filename, payload, mtime=None):
+    with open(filename, "wb") as f:
+        f.write(encode(payload))
+    if mtime is not None:
+        os.utime(filename, (mtime, mtime))
+
+
+class ArtifactWriter(object):
+    """Encode and write files from a background thread.
+
+    Files are written in batches of up to batch_size, then fsynced together
+    with their directories, rather than one at a time. Queued payloads may hold
+    up to max_bytes: beyond that optional files (annotated images) are skipped,
+    and others are written by the caller as before.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, fsync=True, batch_size=16):
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.pending_bytes = 0
+        self.active = 0
+        self.closed = False
+        self.written = 0
+        self.skipped = 0
+        self.synchronous = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=100)
+        self.thread = threading.Thread(target=self.run, name="artifacts", daemon=True)
+        self.thread.start()
+
+    def write(self, filename, payload, mtime=None, optional=False, camera=""):
+        """Queue payload (JPEG bytes, a PIL or OpenCV image, or text) for filename.
+
+        mtime sets the modification time of the file once written, and camera
+        labels its write latency.
+        """
+        size = size_of(payload)
+        with self.cond:
+            if not self.closed and self.pending_bytes + size <= self.max_bytes:
+                self.queue.append((filename, payload, mtime, size, timer(), camera))
+                self.pending_bytes += size
+                self.cond.notify_all()
+                return True
+            if optional:
+                self.skipped += 1
+                logger.warning(
+                    f"Skipping {filename}, {self.pending_bytes} bytes queued"
+                )
+                return False
+            self.synchronous += 1
+        write_now(filename, payload, mtime)
+        return True
+
+    def take(self):
+        with self.cond:
+            while not self.queue and not self.closed:
+                self.cond.wait()
+            batch = []
+            while self.queue and len(batch) < self.batch_size:
+                batch.append(self.queue.popleft())
+            self.active += len(batch)
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.take()
+            if not batch:
+                return
+            try:
+                self.write_batch(batch)
+            finally:
+                with self.cond:
+                    self.active -= len(batch)
+                    self.pending_bytes -= sum(item[3] for item in batch)
+                    self.cond.notify_all()
+
+    def write_batch(self, batch):
+        written = []
+        for filename, payload, mtime, size, queued, camera in batch:
+            try:
+                f = open(filename, "wb")
+            except OSError:
+                self.errors += 1
+                logger.exception(f"Failed to write {filename}")
+                continue
+            try:
+                f.write(encode(payload))
+                f.flush()
+                written.append((f, filename, mtime, queued, camera))
+            except Exception:
+                f.close()
+                self.errors += 1
+                logger.exception(f"Failed to write {filename}")
+        try:
+            if self.fsync:
+                directories = set()
+                for f, filename, _, _, _ in written:
+                    os.fsync(f.fileno())
+                    directories.add(os.path.dirname(filename) or ".")
+                for directory in directories:
+                    fd = os.open(directory, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+        except OSError:
+            self.errors += 1
+            logger.exception("Failed to sync artifacts")
+        finally:
+            for f, _, _, _, _ in written:
+                f.close()
+        now = timer()
+        for f, filename, mtime, queued, camera in written:
+            if mtime is not None:
+                try:
+                    os.utime(filename, (mtime, mtime))
+                except OSError:
+                    self.errors += 1
+                    logger.exception(f"Failed to set the time of {filename}")
+            self.latencies.append(now - queued)
+            metrics.observe("write", now - queued, camera=camera)
+        self.written += len(written)
+
+    def flush(self, timeout=None):
+        """Wait until everything queued is written"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.queue or self.active:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def stats(self):
+        with self.cond:
+            latencies = sorted(self.latencies)
+            return {
+                "depth": len(self.queue) + self.active,
+                "pending_bytes": self.pending_bytes,
+                "written": self.written,
+                "skipped": self.skipped,
+                "synchronous": self.synchronous,
+                "errors": self.errors,
+                "latency_ms": (
+                    round(latencies[len(latencies) // 2] * 1000, 1)
+                    if latencies
+                    else 0.0
+                ),
+                "max_latency_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+            }
+
+
+def set_writer(writer):
+    """Use writer for save(), or write synchronously when it is None"""
+    global _writer
+    _writer = writer
+
+
+def save(filename, payload, mtime=None, optional=False, camera=""):
+    """Save an artifact with the background writer, if there is one"""
+    if _writer is not None:
+        return _writer.write(
+            filename, payload, mtime=mtime, optional=optional, camera=camera
+        )
+    write_now(filename, payload, mtime)
+    return True
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+import os
+import threading
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import artifacts
+from artifacts import ArtifactWriter
+
+
+def test_writes_payloads(tmp_path):
+    writer = ArtifactWriter()
+    frame = np.zeros((16, 16, 3), dtype=np.uint8)
+    writer.write(str(tmp_path / "a.jpg"), b"jpeg")
+    writer.write(str(tmp_path / "b.txt"), "text")
+    writer.write(str(tmp_path / "c.jpg"), Image.new("RGB", (16, 16)))
+    writer.write(str(tmp_path / "d.jpg"), frame, mtime=1000000)
+    assert writer.flush(5)
+    writer.close()
+    assert (tmp_path / "a.jpg").read_bytes() == b"jpeg"
+    assert (tmp_path / "b.txt").read_text() == "text"
+    assert Image.open(str(tmp_path / "c.jpg")).size == (16, 16)
+    assert cv2.imread(str(tmp_path / "d.jpg")).shape == (16, 16, 3)
+    assert os.path.getmtime(str(tmp_path / "d.jpg")) == 1000000
+    stats = writer.stats()
+    assert stats["written"] == 4 and stats["depth"] == 0
+
+
+def test_memory_budget_skips_optional(tmp_path, monkeypatch):
+    writer = ArtifactWriter(max_bytes=10)
+    gate = threading.Event()
+    write_batch = writer.write_batch
+
+    def slow_write_batch(batch):
+        gate.wait(5)
+        write_batch(batch)
+
+    monkeypatch.setattr(writer, "write_batch", slow_write_batch)
+    assert writer.write(str(tmp_path / "a"), b"12345678")
+    assert not writer.write(str(tmp_path / "annotated"), b"12345", optional=True)
+    # required files are written by the caller
+    assert writer.write(str(tmp_path / "b"), b"12345")
+    assert (tmp_path / "b").read_bytes() == b"12345"
+    gate.set()
+    assert writer.flush(5)
+    writer.close()
+    assert not (tmp_path / "annotated").exists()
+    assert (tmp_path / "a").read_bytes() == b"12345678"
+    stats = writer.stats()
+    assert stats["skipped"] == 1 and stats["synchronous"] == 1
+
+
+def test_save_without_writer(tmp_path):
+    artifacts.set_writer(None)
+    artifacts.save(str(tmp_path / "a.txt"), "now")
+    assert (tmp_path / "a.txt").read_text() == "now"
+
+
+def test_keeps_writing_after_utime_error(tmp_path, monkeypatch):
+    def utime(path, times):
+        raise PermissionError(path)
+
+    monkeypatch.setattr(artifacts.os, "utime", utime)
+    writer = ArtifactWriter(fsync=False)
+    writer.write(str(tmp_path / "a.jpg"), b"jpeg", mtime=1000000)
+    assert writer.flush(5)
+    writer.write(str(tmp_path / "b.txt"), "text")
+    assert writer.flush(5)
+    writer.close()
+    assert (tmp_path / "b.txt").read_text() == "text"
+    assert writer.stats()["errors"] == 1
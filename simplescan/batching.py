@@ -0,0 +1,96 @@
+"""Group frames from several cameras into batched forward passes."""
+
+import logging
+from timeit import default_timer as timer
+
+from tiling import FULL, merge_tiles
+
+logger = logging.getLogger(__name__)
+
+
+class BatchPredictor(object):
+    """Run the frames of several cameras through the models in batches.
+
+    Cameras are grouped by model: colour frames, greyscale (IR) frames and,
+    for cameras with vehicle_check, the vehicle model. Each group is one
+    forward pass per max_batch frames. The tiles of cameras with tiling are
+    batched with the other frames, then merged back into one frame.
+    """
+
+    def __init__(self, color_model, grey_model, vehicle_model, max_batch=8):
+        self.color_model = color_model
+        self.grey_model = grey_model
+        self.vehicle_model = vehicle_model
+        self.max_batch = max_batch
+
+    def run(self, model, images):
+        predictions = []
+        for start in range(0, len(images), self.max_batch):
+            predictions += model.predict_images(images[start : start + self.max_batch])
+        return predictions
+
+    def predict(self, cams):
+        """Predict the current frame of each camera.
+
+        Returns:
+            dict of camera to a (predictions, model_name, prediction_time)
+            tuple, suitable for detect(). Cameras without a usable frame
+            are left out.
+        """
+        color = []
+        grey = []
+        vehicle = []
+        for cam in cams:
+            if not cam.has_image or cam.resized is None:
+                continue
+            if len(cam.resized.shape) == 3:
+                color.append(cam)
+            elif len(cam.resized.shape) == 2:
+                grey.append(cam)
+            else:
+                continue
+            if cam.vehicle_check and self.vehicle_model is not None:
+                vehicle.append(cam)
+        results = {}
+        times = {}
+        for model, model_name, group in [
+            (self.color_model, "color", color),
+            (self.grey_model, "grey", grey),
+        ]:
+            if len(group) == 0:
+                continue
+            start = timer()
+            inputs = [cam.tiles or [(FULL, cam.resized)] for cam in group]
+            predictions = self.run(
+                model, [image for tiles in inputs for _, image in tiles]
+            )
+            elapsed = (timer() - start) / len(predictions)
+            i = 0
+            for cam, tiles in zip(group, inputs):
+                p = predictions[i : i + len(tiles)]
+                i += len(tiles)
+                if cam.tiles:
+                    p = [merge_tiles(tiles, p, cam.tiling.threshold)]
+                results[cam] = (p[0], model_name)
+                times[cam] = elapsed * len(tiles)
+        if len(vehicle) > 0:
+            start = timer()
+            predictions = self.run(
+                self.vehicle_model, [cam.resized2 for cam in vehicle]
+            )
+            elapsed = (timer() - start) / len(vehicle)
+            for cam, p in zip(vehicle, predictions):
+                logger.debug(f"{cam.name} vehicles={p}")
+                cam_predictions, model_name = results[cam]
+                # include all vehicle predictions for now
+                results[cam] = (cam_predictions + p, model_name + "+vehicle")
+                times[cam] += elapsed
+        logger.debug(
+            "Batched {} color, {} grey and {} vehicle frames".format(
+                len(color), len(grey), len(vehicle)
+            )
+        )
+        return {
+            cam: (predictions, model_name, times[cam])
+            for cam, (predictions, model_name) in results.items()
+        }
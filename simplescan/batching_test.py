@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import numpy as np
+
+from batching import BatchPredictor
+from prediction import Prediction
+from tiling import Tiling
+
+
+class FakeModel:
+    def __init__(self, tag):
+        self.tag = tag
+        self.batches = []
+
+    def predict_images(self, images):
+        self.batches.append(len(images))
+        return [[{"tagName": self.tag}] for _ in images]
+
+
+class FakeCamera:
+    def __init__(self, name, grey=False, vehicle_check=False):
+        shape = (8, 8) if grey else (8, 8, 3)
+        self.name = name
+        self.has_image = True
+        self.resized = np.zeros(shape, dtype=np.uint8)
+        self.resized2 = np.zeros((8, 8, 3), dtype=np.uint8)
+        self.vehicle_check = vehicle_check
+        self.tiles = []
+
+
+def test_batch_predictor_groups_by_model():
+    color, grey, vehicle = FakeModel("c"), FakeModel("g"), FakeModel("v")
+    cams = [FakeCamera("a"), FakeCamera("b", vehicle_check=True), FakeCamera("c", True)]
+    results = BatchPredictor(color, grey, vehicle, max_batch=8).predict(cams)
+    assert color.batches == [2]
+    assert grey.batches == [1]
+    assert vehicle.batches == [1]
+    assert results[cams[0]][1] == "color"
+    assert [p["tagName"] for p in results[cams[1]][0]] == ["c", "v"]
+    assert results[cams[1]][1] == "color+vehicle"
+    assert results[cams[2]][1] == "grey"
+
+
+def test_batch_predictor_splits_large_groups():
+    color = FakeModel("c")
+    cams = [FakeCamera(str(i)) for i in range(5)]
+    BatchPredictor(color, None, None, max_batch=2).predict(cams)
+    assert color.batches == [2, 2, 1]
+
+
+class BoxModel(FakeModel):
+    def predict_images(self, images):
+        self.batches.append(len(images))
+        box = {"left": 0.0, "top": 0.0, "width": 1.0, "height": 1.0}
+        # the whole frame comes first, and scores highest
+        return [
+            [Prediction(0.5 - i / 10, 0, self.tag, box)] for i in range(len(images))
+        ]
+
+
+def test_batch_predictor_merges_tiles():
+    color = BoxModel("c")
+    tiled = FakeCamera("tiled")
+    tiled.tiling = Tiling("2x1")
+    tiled.tiles = [(region, tiled.resized) for region in tiled.tiling.regions((8, 8))]
+    cams = [tiled, FakeCamera("a")]
+    results = BatchPredictor(color, None, None, max_batch=8).predict(cams)
+    assert color.batches == [4]
+    assert len(results[cams[1]][0]) == 1
+    # the whole frame box suppresses the box of each tile inside it
+    assert len(results[tiled][0]) == 1
+    assert results[tiled][0][0].boundingBox["width"] == 1.0
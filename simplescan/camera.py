@@ -1,54 +1,85 @@
-import hashlib
+import json
 import logging
 import os
-import subprocess
-import sys
-from datetime import datetime, timedelta
-from pathlib import Path
+import time
+from datetime import datetime
+from timeit import default_timer as timer
 from urllib.parse import urlparse
 
 import cv2
-import numpy as np
-import paho.mqtt.client as paho
 import requests
 from requests.auth import HTTPDigestAuth
 
-from utils import cleanup
+import jpeg
+import metrics
+from excludes import ExcludeIndex
+from fingerprint import create_fingerprint
+from ftpwatch import create_source
+from greyscale import GreyDetector
+from motion import MotionGate
+from tiling import FULL, create_tiling
+from tracker import Tracker
 
 logger = logging.getLogger(__name__)
 
+# (width, height) of the model input
+MODEL_SIZE = (608, 608)
+
 
 class Camera:
-    def __init__(self, config, excludes, mqtt_config):
+    def __init__(self, config, excludes, publisher):
         self.name = config["name"]
         self.ha_name = self.name.replace(" ", "_")
         self.config = config
         self.objects = set()
-        self.prev_predictions = {}
         self.is_file = False
         self.counts = {}
         self.last_show_count = -1
         self.vehicle_check = config.getboolean("vehicle_check", False)
         self.excludes = excludes
+        self.exclude_index = ExcludeIndex(excludes)
         self.capture_async = config.getboolean("async", False)
         self.error = None
+        # decode frames at the smallest DCT scale which still covers MODEL_SIZE
+        self.reduced_decode = config.getboolean("reduced_decode", False)
+        self.grey_detector = GreyDetector(
+            step=config.getint("grey_step", 8),
+            tolerance=config.getint("grey_tolerance", 0),
+            hold=config.getint("grey_hold", 2),
+        )
         self.image = None
-        self.image_hash = 0
+        self.fingerprint = create_fingerprint(
+            config.get("dedup", "exact"), config.getint("dedup_distance", 4)
+        )
+        # skip inference when less than motion_threshold of the frame changed
+        motion_threshold = config.getfloat("motion_threshold", 0)
+        self.motion_gate = (
+            MotionGate(motion_threshold, config.getfloat("motion_recheck", 120))
+            if motion_threshold > 0
+            else None
+        )
+        self.motion_published = None
+        # regions run through the model besides, or instead of, the whole frame
+        self.tiling = create_tiling(config)
+        self.tiles = []
         self.source = None
         self.prior_image = None
         self.prior_time = datetime.fromtimestamp(0)
         self.prior_priority = -4
         self.age = 0
+        # consecutive failed snapshots, the scheduler backs off on them
         self.fails = 0
-        self.skip = 0
         self.ftp_path = config.get("ftp-path", None)
+        self.ftp_source = None
+        # monotonic time the current frame entered the pipeline, None when idle
+        self.in_flight = None
         self.interval = config.getint("interval", 30)
+        self.tracker = Tracker(self.interval)
+        self.timeout = config.getfloat("timeout", 20)
         self.session = None
         self.mqtt = set(config.get("mqtt", "").split(","))
-        self.mqtt_client = paho.Client(f"aicam-{self.ha_name}")
-        self.mqtt_client.username_pw_set(mqtt_config["user"], mqtt_config["password"])
-        self.mqtt_client.connect(mqtt_config["host"], mqtt_config.getint("port", 1883))
-        self.mqtt_client.loop_start()
+        # shared by every camera, see publisher.Publisher
+        self.publisher = publisher
         road_line_raw = config.get("road_line", None)
         if road_line_raw == "all":
             self.road_line = "all"
@@ -73,67 +104,160 @@ class Camera:
                 return y0 + t * (y1 - y0)
         return points[-1][1]
 
-    def __del__(self):
-        self.mqtt_client.disconnect()  # disconnect gracefully
-        self.mqtt_client.loop_stop()  # disconnect gracefully
+    @property
+    def image(self):
+        """The full resolution frame, decoded on first use"""
+        if self._image is None and self.jpeg is not None:
+            image, _ = jpeg.decode(self.jpeg)
+            if image is not None and self.grey:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            self._image = image
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+        self.preview = image
+        self.jpeg = None
+        self.grey = False
+
+    @property
+    def has_image(self):
+        return self._image is not None or self.jpeg is not None
+
+    @property
+    def frame(self):
+        """The frame as captured, JPEG bytes when available"""
+        return self.jpeg if self.jpeg is not None else self._image
+
+    def load(self, data, flags=cv2.IMREAD_COLOR):
+        """Decode a JPEG into preview, which is reduced with reduced_decode.
+
+        The full resolution image is only decoded when image is used.
+        """
+        self.image = None
+        min_size = None
+        if self.reduced_decode:
+            min_size = MODEL_SIZE
+            if self.tiling is not None:
+                size = jpeg.jpeg_size(data)
+                min_size = size and self.tiling.min_size(size, MODEL_SIZE)
+        with metrics.time("decode", camera=self.name):
+            preview, factor = jpeg.decode(data, min_size, flags)
+        if preview is None:
+            return False
+        self.jpeg = data
+        self.preview = preview
+        if factor == 1:
+            self._image = preview
+        return True
+
+    def is_duplicate(self, data):
+        """Check the JPEG bytes against the last frame, before decoding them.
+
+        A duplicate means the scene hasn't changed, so everything tracked is
+        still there.
+        """
+        if self.fingerprint is None or not self.fingerprint.is_duplicate(data):
+            return False
+        self.error = "dup"
+        metrics.count("dup", self.name)
+        self.tracker.keep_alive()
+        return True
+
+    def is_still(self):
+        """Check the decoded preview for motion, dropping the frame if there's none"""
+        if self.motion_gate is None:
+            return False
+        run = self.motion_gate.update(self.preview)
+        now = time.monotonic()
+        if self.motion_published is None or now - self.motion_published > 300:
+            self.motion_published = now
+            self.publisher.publish(
+                f"{self.ha_name}/motion",
+                json.dumps(self.motion_gate.stats()),
+                retain=True,
+            )
+        if run:
+            return False
+        self.image = None
+        self.error = "still"
+        metrics.count("still", self.name)
+        self.tracker.keep_alive()
+        return True
 
     def poll(self):
         # logger.debug('read ftp {}'.format(self.name))
         if self.ftp_path:
-            img = None
-            try:
-                files = sorted(
-                    Path(self.ftp_path).glob("**/*.jpg"), key=os.path.getmtime
+            if self.ftp_source is None:
+                self.ftp_source = create_source(
+                    self.ftp_path, self.config.get("ftp-watch", "auto")
                 )
-                if len(files) == 0:
-                    cleanup(self.ftp_path)
-                    return None
-            except OSError as e:
-                logger.error(f"Error scanning {self.ftp_path}: {e}\n{e.args}")
-                return None
-            good_files = []
-            for f in files:
-                if datetime.fromtimestamp(
-                    os.path.getmtime(f)
-                ) < datetime.now() - timedelta(minutes=5):
-                    logger.warning(f"Skipping old file {f}")
-                    os.remove(f)
-                    continue
-                else:
-                    good_files.append(f)
-            if len(good_files) == 0:
-                return None
-            f = good_files[0]
-            # requires SUID on fuser
-            # sudo chmod u+s /bin/fuser
-            completedProc = subprocess.run(["/bin/fuser", str(f)])
-            if completedProc.returncode == 0:
-                print(f"{f} is open for writing")
+            f = self.ftp_source.next_file()
+            if f is None:
                 return None
-            img = cv2.imread(str(f))
+            with open(f, "rb") as fp:
+                data = fp.read()
             os.remove(f)
-            if img is not None and len(img) > 0:
-                h = hashlib.md5(img.tobytes()).hexdigest()
-                if self.image_hash == h:
-                    self.error = "dup"
-                    return None
-                self.image = img
-                self.image_hash = h
-                self.source = f
-                self.resize()
+            if self.process_file(data, f):
                 return self
-            else:
-                self.error = "bad file"
         return None
 
-    def capture(self):
+    def process_file(self, data, source):
+        """Decode the JPEG bytes of an uploaded file, True when there is a new frame"""
+        if len(data) > 0 and self.is_duplicate(data):
+            return False
+        if len(data) > 0 and self.load(data):
+            if self.is_still():
+                return False
+            self.source = source
+            self.resize()
+            return True
+        self.error = "bad file"
+        return False
+
+    def begin_capture(self):
+        """Reset for a new snapshot"""
         self.image = None
         self.resized = None
         self.resized2 = None
-        if self.skip > 0:
-            self.error = "skip={}".format(self.skip)
-            self.skip -= 1
+        self.tiles = []
+
+    def process_snapshot(self, data):
+        """Decode the JPEG bytes of a snapshot from the camera's uri"""
+        if len(data) == 0:
+            self.error = "empty"
             return self
+        # the camera answered, even if the frame is dropped as unchanged
+        self.fails = 0
+        if self.is_duplicate(data):
+            return self
+        if not self.load(data, cv2.IMREAD_UNCHANGED):
+            raise ValueError("Failed to decode image")
+        if self.is_still():
+            return self
+        self.source = self.config["uri"]
+        self.resize()
+        self.error = None
+        return self
+
+    def capture_failed(self, error):
+        """Count the failure, rebooting the camera after a few in a row"""
+        self.image = None
+        if self.fingerprint is not None:
+            self.fingerprint.reset()
+        self.source = None
+        self.resized = None
+        self.fails += 1
+        self.session = None
+        self.error = type(error)
+        metrics.count("error", self.name)
+        logger.error(f"Error with {self.name}:{self.error}", exc_info=error)
+        if self.fails > 2:
+            self.reboot()
+
+    def capture(self):
+        self.begin_capture()
         if "file" in self.config:
             self.is_file = True
             self.image = cv2.imread(self.config["file"])
@@ -148,32 +272,16 @@ class Camera:
                         self.config["user"], self.config["password"]
                     )
             try:
+                start = timer()
                 with self.session.get(
-                    self.config["uri"], timeout=20, stream=True
+                    self.config["uri"], timeout=self.timeout, stream=True
                 ) as resp:
                     resp.raise_for_status()
-                    bytes = np.asarray(bytearray(resp.raw.read()), dtype="uint8")
-                    if len(bytes) == 0:
-                        self.error = "empty"
-                        return self
-                    self.image = cv2.imdecode(bytes, cv2.IMREAD_UNCHANGED)
-                    self.image_hash = hashlib.md5(self.image.tobytes()).hexdigest()
-                    self.source = self.config["uri"]
-                    self.resize()
-                    self.error = None
-                    self.fails = 0
-            except Exception:
-                self.image = None
-                self.image_hash = 0
-                self.source = None
-                self.resized = None
-                self.skip = 2 ** self.fails
-                self.fails += 1
-                self.session = None
-                self.error = sys.exc_info()[0]
-                logger.exception(f"Error with {self.name}:{self.error}")
-                if self.skip > 3:
-                    self.reboot()
+                    data = resp.raw.read()
+                metrics.observe("capture", timer() - start, camera=self.name)
+                self.process_snapshot(data)
+            except Exception as e:
+                self.capture_failed(e)
         return self
 
     def reboot(self):
@@ -193,17 +301,33 @@ class Camera:
             logger.exception("Failed to reboot %s", self.name)
 
     def resize(self):
-        if self.image is None:
+        if self.preview is None:
             return
-        hsv = cv2.cvtColor(self.image, cv2.COLOR_BGR2HSV)
-        sum = np.sum(hsv[:, :, 0])
-        if sum == 0:
-            self.resized2 = cv2.resize(
-                cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB), (608, 608)
-            )
-            self.image = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
-            self.resized = cv2.resize(self.image, (608, 608))
+        with metrics.time("resize", camera=self.name):
+            self._resize(self.preview)
+
+    def _resize(self, frame):
+        was_grey = self.grey_detector.grey
+        if self.grey_detector.update(frame) != was_grey:
+            stats = self.grey_detector.stats()
+            logger.info(f"{self.name} ir={stats['grey']}, check took {stats['last_ms']}ms")
+            self.publisher.publish(f"{self.ha_name}/ir", stats["grey"], retain=True)
+            self.publisher.publish(f"{self.ha_name}/ir/stats", json.dumps(stats), retain=True)
+        if self.grey_detector.grey:
+            self.resized2 = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), MODEL_SIZE)
+            grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            if self._image is frame:
+                self._image = grey
+            self.preview = grey
+            self.grey = True
+            self.resized = cv2.resize(grey, MODEL_SIZE)
         else:
-            resized = cv2.resize(self.image, (608, 608))
+            resized = cv2.resize(frame, MODEL_SIZE)
             self.resized = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
             self.resized2 = self.resized
+        if self.tiling is not None:
+            self.tiles = [(FULL, self.resized)] if self.tiling.full else []
+            for region, crop in self.tiling.crops(self.preview, MODEL_SIZE):
+                if not self.grey:
+                    crop = cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)
+                self.tiles.append((region, crop))
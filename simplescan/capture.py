@@ -0,0 +1,182 @@
+"""Capture camera snapshots on an asyncio event loop with pooled connections."""
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import threading
+from timeit import default_timer as timer
+from urllib.parse import urlparse
+
+import aiohttp
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_PARAM = re.compile(r'(\w+)=(?:"([^"]*)"|([^,\s]*))')
+
+_HASHES = {
+    "MD5": hashlib.md5,
+    "MD5-SESS": hashlib.md5,
+    "SHA-256": hashlib.sha256,
+    "SHA-256-SESS": hashlib.sha256,
+}
+
+
+class DigestAuth(object):
+    """HTTP digest auth which keeps the server nonce between requests.
+
+    The camera is only challenged again when it rejects the nonce, instead of
+    on every snapshot.
+    """
+
+    def __init__(self, user, password):
+        self.user = user
+        self.password = password
+        self.params = None
+        self.nc = 0
+
+    def challenge(self, header):
+        """Store the parameters of a WWW-Authenticate: Digest header"""
+        scheme, _, rest = header.partition(" ")
+        if scheme.lower() != "digest":
+            raise ValueError("Expected a digest challenge, got {}".format(header))
+        self.params = {k.lower(): q or v for k, q, v in _PARAM.findall(rest)}
+        self.nc = 0
+
+    def authorization(self, method, url):
+        """The Authorization header for a request, None before a challenge"""
+        if self.params is None:
+            return None
+        realm = self.params.get("realm", "")
+        nonce = self.params["nonce"]
+        algorithm = self.params.get("algorithm", "MD5").upper()
+        digest = _HASHES.get(algorithm)
+        if digest is None:
+            raise ValueError("Unsupported digest algorithm {}".format(algorithm))
+
+        def h(s):
+            return digest(s.encode()).hexdigest()
+
+        parsed = urlparse(url)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        self.nc += 1
+        nc = "{:08x}".format(self.nc)
+        cnonce = os.urandom(8).hex()
+        ha1 = h("{}:{}:{}".format(self.user, realm, self.password))
+        if algorithm.endswith("-SESS"):
+            ha1 = h("{}:{}:{}".format(ha1, nonce, cnonce))
+        ha2 = h("{}:{}".format(method, path))
+        qop = self.params.get("qop")
+        fields = [
+            ("username", self.user),
+            ("realm", realm),
+            ("nonce", nonce),
+            ("uri", path),
+        ]
+        if qop:
+            if "auth" not in [q.strip() for q in qop.split(",")]:
+                raise ValueError("Unsupported digest qop {}".format(qop))
+            response = h("{}:{}:{}:{}:auth:{}".format(ha1, nonce, nc, cnonce, ha2))
+        else:
+            response = h("{}:{}:{}".format(ha1, nonce, ha2))
+        fields.append(("response", response))
+        if "opaque" in self.params:
+            fields.append(("opaque", self.params["opaque"]))
+        header = "Digest " + ", ".join('{}="{}"'.format(k, v) for k, v in fields)
+        header += ", algorithm={}".format(self.params.get("algorithm", "MD5"))
+        if qop:
+            header += ', qop=auth, nc={}, cnonce="{}"'.format(nc, cnonce)
+        return header
+
+
+class AsyncCaptureEngine(object):
+    """Snapshot cameras concurrently from one event loop thread.
+
+    Connections are pooled per host and kept alive, digest nonces are reused,
+    and at most concurrency snapshots are in flight. The detection loop is
+    synchronous, so the event loop runs in its own thread and submit() hands
+    back a concurrent.futures.Future, as a ThreadPoolExecutor would. Decoding
+    runs on executor so it doesn't hold up other downloads.
+    """
+
+    def __init__(self, executor=None, concurrency=8, limit_per_host=2, keepalive=60):
+        self.executor = executor
+        self.concurrency = concurrency
+        self.limit_per_host = limit_per_host
+        self.keepalive = keepalive
+        self.auths = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="capture", daemon=True
+        )
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.open(), self.loop).result()
+
+    async def open(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.concurrency,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive,
+            )
+        )
+
+    def auth_for(self, cam):
+        if "user" not in cam.config:
+            return None
+        auth = self.auths.get(cam.name)
+        if auth is None:
+            auth = DigestAuth(cam.config["user"], cam.config["password"])
+            self.auths[cam.name] = auth
+        return auth
+
+    async def fetch(self, cam):
+        """Download a snapshot, answering a digest challenge at most once"""
+        uri = cam.config["uri"]
+        auth = self.auth_for(cam)
+        timeout = aiohttp.ClientTimeout(total=cam.timeout)
+        for attempt in range(2):
+            headers = {}
+            if auth is not None and auth.params is not None:
+                headers["Authorization"] = auth.authorization("GET", uri)
+            async with self.session.get(uri, headers=headers, timeout=timeout) as resp:
+                if resp.status == 401 and auth is not None and attempt == 0:
+                    auth.challenge(resp.headers.get("WWW-Authenticate", ""))
+                    # read the body so the connection goes back to the pool
+                    await resp.read()
+                    continue
+                resp.raise_for_status()
+                return await resp.read()
+
+    async def capture(self, cam):
+        loop = asyncio.get_event_loop()
+        if "uri" not in cam.config:
+            return await loop.run_in_executor(self.executor, cam.capture)
+        cam.begin_capture()
+        try:
+            async with self.semaphore:
+                start = timer()
+                data = await self.fetch(cam)
+                metrics.observe("capture", timer() - start, camera=cam.name)
+            await loop.run_in_executor(self.executor, cam.process_snapshot, data)
+        except Exception as e:
+            await loop.run_in_executor(self.executor, cam.capture_failed, e)
+        return cam
+
+    def submit(self, cam):
+        """Capture a camera, returning a concurrent.futures.Future of it"""
+        return asyncio.run_coroutine_threadsafe(self.capture(cam), self.loop)
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+import asyncio
+import re
+import time
+
+import pytest
+
+from capture import AsyncCaptureEngine, DigestAuth
+from fakes import FakeSnapshotServer
+
+
+def parse(header):
+    return {
+        k: q or v
+        for k, q, v in re.findall(r'(\w+)=(?:"([^"]*)"|([^,\s]*))', header[7:])
+    }
+
+
+class FakeCamera:
+    def __init__(self, uri, password="secret", timeout=5):
+        self.name = "fake"
+        self.config = {"uri": uri, "user": "admin", "password": password}
+        self.timeout = timeout
+        self.snapshots = []
+        self.errors = []
+
+    def begin_capture(self):
+        return True
+
+    def process_snapshot(self, data):
+        self.snapshots.append(data)
+
+    def capture_failed(self, error):
+        self.errors.append(error)
+
+
+@pytest.fixture
+def server():
+    server = FakeSnapshotServer()
+    yield server
+    server.close()
+
+
+def test_digest_nonce_reused(server):
+    engine = AsyncCaptureEngine()
+    try:
+        cam = FakeCamera(server.uri)
+        for _ in range(3):
+            assert engine.submit(cam).result(5) is cam
+    finally:
+        engine.close()
+    assert cam.snapshots == [b"jpeg"] * 3
+    assert cam.errors == []
+    assert server.challenges == 1
+    assert server.requests == 4
+    # kept alive between snapshots
+    assert len(server.peers) == 1
+
+
+def test_bad_password(server):
+    engine = AsyncCaptureEngine()
+    try:
+        cam = FakeCamera(server.uri, password="wrong")
+        engine.submit(cam).result(5)
+    finally:
+        engine.close()
+    assert cam.snapshots == []
+    assert len(cam.errors) == 1
+    assert server.challenges == 2
+
+
+def test_timeout_and_concurrency():
+    server = FakeSnapshotServer(delay=0.3)
+    engine = AsyncCaptureEngine(concurrency=4, limit_per_host=4)
+    try:
+        slow = FakeCamera(server.uri, timeout=0.1)
+        engine.submit(slow).result(5)
+        assert len(slow.errors) == 1
+        assert isinstance(slow.errors[0], asyncio.TimeoutError)
+
+        cams = [FakeCamera(server.uri) for _ in range(4)]
+        start = time.monotonic()
+        for f in [engine.submit(cam) for cam in cams]:
+            f.result(5)
+        # one challenge each at most, then the snapshots overlap
+        assert time.monotonic() - start < 0.3 * 4
+        assert all(cam.snapshots == [b"jpeg"] for cam in cams)
+    finally:
+        engine.close()
+        server.close()
+
+
+def test_authorization_format():
+    auth = DigestAuth("admin", "secret")
+    assert auth.authorization("GET", "http://cam/a.jpg") is None
+    auth.challenge('Digest realm="cam", nonce="n", qop="auth,auth-int"')
+    first = parse(auth.authorization("GET", "http://cam/cgi-bin/snapshot.cgi?c=1"))
+    second = parse(auth.authorization("GET", "http://cam/cgi-bin/snapshot.cgi?c=1"))
+    assert first["uri"] == "/cgi-bin/snapshot.cgi?c=1"
+    assert (first["nc"], second["nc"]) == ("00000001", "00000002")
+    with pytest.raises(ValueError):
+        auth.challenge('Basic realm="cam"')
@@ -1,18 +1,24 @@
 #!/usr/bin/env python3
 """CodeProject AI Server ALPR integration."""
+
+import concurrent.futures
 import json
 import logging
 import sys
+import threading
+import time
 
 import requests
 
+import metrics
+
 logger = logging.getLogger(__name__)
 
 # Default CodeProject AI Server endpoint (can be overridden via config)
 DEFAULT_CODEPROJECT_URL = "http://localhost:32168/v1/image/alpr"
 
 
-def enrich(image_bytes, save_json=None, url=None):
+def enrich(image_bytes, save_json=None, url=None, timeout=10, camera=""):
     """
     Send image to CodeProject AI ALPR and extract license plate info.
 
@@ -20,17 +26,20 @@ def enrich(image_bytes, save_json=None, url=None):
         image_bytes: Raw image bytes
         save_json: Optional path to save raw API response
         url: Optional CodeProject API URL (defaults to DEFAULT_CODEPROJECT_URL)
+        timeout: Seconds to wait for the server
+        camera: Camera name the lookup's latency is labelled with
 
     Returns:
         dict with keys: message, plates, count
     """
     codeproject_url = url or DEFAULT_CODEPROJECT_URL
     try:
-        response = requests.post(
-            codeproject_url,
-            files={"image": ("image.jpg", image_bytes, "image/jpeg")},
-            timeout=10,
-        )
+        with metrics.time("alpr", camera=camera):
+            response = requests.post(
+                codeproject_url,
+                files={"image": ("image.jpg", image_bytes, "image/jpeg")},
+                timeout=timeout,
+            )
         response.raise_for_status()
         result = response.json()
     except requests.exceptions.RequestException as e:
@@ -59,6 +68,126 @@ def enrich(image_bytes, save_json=None, url=None):
     }
 
 
+class PlateReader(object):
+    """ALPR lookups on a bounded pool of threads, cached per tracked vehicle.
+
+    read() returns a Future of enrich()'s result for a key, the tracks of the
+    vehicles in the image. While a key's lookup is running, or once it found
+    plates, the same Future is returned, so a parked car is looked up once.
+    A result without plates is looked up again on a later frame, up to
+    lookups times, as the plate may come into view. Results are kept for ttl
+    seconds. When queue lookups are already waiting for a worker, read()
+    returns None. when_late() registers one callback per lookup for callers
+    which stopped waiting on it.
+    """
+
+    def __init__(self, url=None, workers=2, queue=8, lookups=3, ttl=3600, timeout=10):
+        self.url = url
+        self.workers = workers
+        self.queue = queue
+        self.lookups = lookups
+        self.ttl = ttl
+        self.timeout = timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        # key: (future, lookups, time of the last lookup)
+        self.cache = {}
+        # key: the future whose late callback is registered
+        self.late = {}
+        self.pending = 0
+        self.requests = 0
+        self.hits = 0
+        self.coalesced = 0
+        self.rejected = 0
+
+    def read(self, key, image_bytes, save_json=None, camera=""):
+        now = time.monotonic()
+        with self.lock:
+            for k in [k for k, (_, _, t) in self.cache.items() if now - t > self.ttl]:
+                del self.cache[k]
+                self.late.pop(k, None)
+            lookups = 0
+            if key in self.cache:
+                future, lookups, _ = self.cache[key]
+                if not future.done():
+                    self.coalesced += 1
+                    return future
+                found = future.exception() is None and future.result()["plates"]
+                if found or lookups >= self.lookups:
+                    self.hits += 1
+                    return future
+            if self.pending >= self.workers + self.queue:
+                self.rejected += 1
+                return None
+            self.pending += 1
+            self.requests += 1
+            future = self.executor.submit(self.lookup, image_bytes, save_json, camera)
+            self.cache[key] = (future, lookups + 1, now)
+            return future
+
+    def when_late(self, key, future, callback):
+        """Call callback(future) once it is done, unless already registered for it"""
+        with self.lock:
+            if self.late.get(key) is future:
+                return False
+            self.late[key] = future
+        future.add_done_callback(callback)
+        return True
+
+    def lookup(self, image_bytes, save_json, camera=""):
+        try:
+            return enrich(
+                image_bytes,
+                save_json,
+                url=self.url,
+                timeout=self.timeout,
+                camera=camera,
+            )
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def close(self, wait=False):
+        self.executor.shutdown(wait=wait)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": self.pending,
+                "cached": len(self.cache),
+                "requests": self.requests,
+                "hits": self.hits,
+                "coalesced": self.coalesced,
+                "rejected": self.rejected,
+            }
+
+
+_reader = None
+
+
+def set_reader(reader):
+    """Use reader for read(), or look up synchronously when it is None"""
+    global _reader
+    _reader = reader
+
+
+def read(key, image_bytes, save_json=None, url=None, camera=""):
+    """A Future of the plates in image_bytes, from the reader if there is one"""
+    if _reader is not None:
+        return _reader.read(key, image_bytes, save_json, camera)
+    future = concurrent.futures.Future()
+    future.set_result(enrich(image_bytes, save_json, url=url, camera=camera))
+    return future
+
+
+def when_late(key, future, callback):
+    """Call callback(future) when it is done, once per lookup with a reader"""
+    if _reader is not None:
+        return _reader.when_late(key, future, callback)
+    future.add_done_callback(callback)
+    return True
+
+
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         f = sys.argv[1]
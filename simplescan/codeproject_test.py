@@ -0,0 +1,93 @@
+import concurrent.futures
+import json
+
+import pytest
+
+from codeproject import PlateReader, enrich
+from fakes import FakeCodeProject
+
+
+@pytest.fixture
+def server():
+    server = FakeCodeProject(plates=["ABC123"], delay=0.2)
+    yield server
+    server.close()
+
+
+def test_enrich(server, tmp_path):
+    save_json = tmp_path / "codeproject.txt"
+    result = enrich(b"jpeg", str(save_json), url=server.alpr_url)
+    assert result == {
+        "message": "Vehicle with plate ABC123",
+        "plates": ["ABC123"],
+        "count": 1,
+    }
+    assert json.loads(save_json.read_text())["success"]
+
+
+def test_enrich_unreachable():
+    result = enrich(b"jpeg", url="http://127.0.0.1:9/v1/image/alpr", timeout=1)
+    assert result == {"message": "", "plates": [], "count": 0}
+
+
+def test_parked_car_read_once(server):
+    reader = PlateReader(url=server.alpr_url)
+    try:
+        first = reader.read("car", b"jpeg")
+        # while the lookup runs
+        assert reader.read("car", b"jpeg") is first
+        assert first.result(5)["plates"] == ["ABC123"]
+        assert reader.read("car", b"jpeg") is first
+        other = reader.read("other car", b"jpeg")
+        assert other is not first
+        other.result(5)
+    finally:
+        reader.close(wait=True)
+    assert server.requests == 2
+    stats = reader.stats()
+    assert stats["coalesced"] == 1
+    assert stats["hits"] == 1
+    assert stats["pending"] == 0
+
+
+def test_read_again_until_plate_found(server):
+    server.plates = []
+    reader = PlateReader(url=server.alpr_url, lookups=2)
+    try:
+        first = reader.read("car", b"jpeg")
+        assert first.result(5)["plates"] == []
+        second = reader.read("car", b"jpeg")
+        assert second is not first
+        second.result(5)
+        assert reader.read("car", b"jpeg") is second
+    finally:
+        reader.close(wait=True)
+    assert server.requests == 2
+
+
+def test_bounded_queue(server):
+    reader = PlateReader(url=server.alpr_url, workers=1, queue=1)
+    try:
+        futures = [reader.read(n, b"jpeg") for n in range(3)]
+        assert futures[2] is None
+        assert [f.result(5)["count"] for f in futures[:2]] == [1, 1]
+    finally:
+        reader.close(wait=True)
+    assert reader.stats()["rejected"] == 1
+
+
+def test_late_lookup_announced_once(server):
+    reader = PlateReader(url=server.alpr_url)
+    announced = []
+    try:
+        # two notifications of the same vehicles, both giving up waiting
+        for _ in range(2):
+            future = reader.read("car", b"jpeg")
+            with pytest.raises(concurrent.futures.TimeoutError):
+                future.result(0.01)
+            reader.when_late("car", future, announced.append)
+        future.result(5)
+    finally:
+        reader.close(wait=True)
+    assert announced == [future]
+    assert server.requests == 1
@@ -0,0 +1,61 @@
+"""Static exclusion boxes of a camera, matched against all of a frame's predictions at once."""
+
+import numpy as np
+
+from utils import boxes_array, iou_matrix
+
+
+class ExcludeIndex(object):
+    """The excludes.json entries of one camera as a box array per class.
+
+    "*" excludes apply to every class. A prediction is ignored when its IoU
+    with an exclude box is over threshold; the first matching box, in file
+    order, gives the reason.
+    """
+
+    def __init__(self, excludes, threshold=0.5):
+        self.threshold = threshold
+        self.boxes = {}
+        self.comments = {}
+        for tag, entries in excludes.items():
+            self.boxes[tag] = boxes_array(entries)
+            self.comments[tag] = [e.get("comment") for e in entries]
+
+    def __len__(self):
+        return sum(len(boxes) for boxes in self.boxes.values())
+
+    def matches(self, tag, boxes):
+        """(index of the first matching exclude or -1, its IoU) for each box"""
+        excludes = self.boxes.get(tag)
+        if excludes is None or len(excludes) == 0 or len(boxes) == 0:
+            return np.full(len(boxes), -1), np.zeros(len(boxes))
+        iou = iou_matrix(boxes, excludes)
+        over = iou > self.threshold
+        first = over.argmax(axis=1)
+        best = iou[np.arange(len(boxes)), first]
+        return np.where(over.any(axis=1), first, -1), best
+
+    def apply(self, predictions):
+        """Set ignore on predictions which match an exclude box"""
+        predictions = [p for p in predictions if p.ignore is None]
+        if not predictions or not self.boxes:
+            return
+        boxes = boxes_array(p.boundingBox for p in predictions)
+        index, _ = self.matches("*", boxes)
+        for p, i in zip(predictions, index):
+            if i >= 0:
+                comment = self.comments["*"][i]
+                p.ignore = "static" if comment is None else comment
+        # a match for the prediction's class takes precedence
+        tags = np.array([p.tagName for p in predictions])
+        for tag in set(tags.tolist()) & set(self.boxes):
+            if tag == "*":
+                continue
+            rows = np.flatnonzero(tags == tag)
+            index, iou = self.matches(tag, boxes[rows])
+            for row, i, value in zip(rows, index, iou):
+                if i >= 0:
+                    comment = self.comments[tag][i]
+                    if comment is None:
+                        comment = "static iou {}".format(float(value))
+                    predictions[row].ignore = comment
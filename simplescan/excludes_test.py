@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import json
+
+import numpy as np
+import pytest
+
+from excludes import ExcludeIndex
+from prediction import Prediction
+from utils import bb_intersection_over_union
+
+
+def box(left, top, width=0.1, height=0.1):
+    return {"left": left, "top": top, "width": width, "height": height}
+
+
+def prediction(tag, bbox):
+    return Prediction(0.9, 0, tag, bbox)
+
+
+def apply_pairwise(excludes, predictions):
+    """The matching detect() did before ExcludeIndex"""
+    for p in filter(lambda p: "ignore" not in p, predictions):
+        if "*" in excludes:
+            for e in excludes["*"]:
+                iou = bb_intersection_over_union(e, p["boundingBox"])
+                if iou > 0.5:
+                    p["ignore"] = e.get("comment", "static")
+                    break
+        if p["tagName"] in excludes:
+            for i, e in enumerate(excludes[p["tagName"]]):
+                iou = bb_intersection_over_union(e, p["boundingBox"])
+                if iou > 0.5:
+                    p["ignore"] = e.get("comment", "static iou {}".format(iou))
+                    break
+
+
+def test_comments_and_precedence():
+    excludes = {
+        "*": [dict(box(0.1, 0.1), comment="tree")],
+        "person": [box(0.5, 0.5), dict(box(0.1, 0.1), comment="flag")],
+        "deer": [box(0.8, 0.8)],
+    }
+    predictions = [
+        prediction("person", box(0.1, 0.1)),
+        prediction("dog", box(0.11, 0.1)),
+        prediction("person", box(0.5, 0.5)),
+        prediction("deer", box(0.3, 0.3)),
+        prediction("deer", box(0.8, 0.8)),
+    ]
+    predictions[-1].ignore = "road"
+    ExcludeIndex(excludes).apply(predictions)
+    assert [p.ignore for p in predictions] == [
+        "flag",
+        "tree",
+        "static iou 1.0",
+        None,
+        "road",
+    ]
+
+
+def test_matches_pairwise_on_excludes_file():
+    with open("excludes.json") as f:
+        cameras = json.load(f)
+    rng = np.random.RandomState(0)
+    for excludes in cameras.values():
+        tags = list(excludes) + ["vehicle"]
+        boxes = [e for entries in excludes.values() for e in entries]
+        predictions = []
+        for _ in range(50):
+            base = boxes[rng.randint(len(boxes))] if boxes else box(0.5, 0.5)
+            jitter = rng.normal(0, 0.02, 2)
+            predictions.append(
+                prediction(
+                    tags[rng.randint(len(tags))],
+                    dict(
+                        box(base["left"] + jitter[0], base["top"] + jitter[1]),
+                        width=base["width"],
+                        height=base["height"],
+                    ),
+                )
+            )
+        expected = [dict(p) for p in predictions]
+        apply_pairwise(excludes, expected)
+        ExcludeIndex(excludes).apply(predictions)
+        for p, e in zip(predictions, expected):
+            if "ignore" in e and e["ignore"].startswith("static iou "):
+                assert p["ignore"].startswith("static iou ")
+                assert float(p["ignore"][11:]) == pytest.approx(float(e["ignore"][11:]))
+            else:
+                assert p.get("ignore") == e.get("ignore")
+
+
+def test_empty():
+    index = ExcludeIndex({})
+    assert len(index) == 0
+    predictions = [prediction("person", box(0.1, 0.1))]
+    index.apply(predictions)
+    assert "ignore" not in predictions[0]
@@ -0,0 +1,643 @@
+"""Local stand-ins for the services simplescan talks to, for tests and offline runs.
+
+Each server runs an aiohttp application on its own event loop thread, bound
+to an unused port on localhost. FakeBroker is an MQTT broker on a plain
+asyncio server, FakeMqttClient stands in for a broker connection without a
+server, and FakeFtpUploads for cameras uploading over FTP.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+
+import cv2
+import numpy as np
+from aiohttp import WSMsgType, web
+
+# Home Assistant in home mode, with every detector on
+HOME_STATES = {
+    "input_boolean.night_mode": "off",
+    "group.egge": "home",
+    "input_boolean.person_detector": "on",
+    "input_boolean.vehicle_detector": "on",
+    "input_boolean.vacation_mode": "off",
+    "sensor.rufus_status": "outside",
+    "binary_sensor.is_dark": "off",
+}
+
+
+def synthetic_frames(size, count=8, seed=0):
+    """count different colour JPEGs of size (width, height), like a busy camera"""
+    width, height = size
+    rng = np.random.RandomState(seed)
+    frames = []
+    for _ in range(count):
+        image = np.empty((height, width, 3), dtype=np.uint8)
+        image[:] = rng.randint(0, 256, 3)
+        for _ in range(4):
+            x, y = rng.randint(0, width), rng.randint(0, height)
+            color = tuple(int(c) for c in rng.randint(0, 256, 3))
+            cv2.rectangle(image, (x, y), (x + width // 8, y + height // 8), color, -1)
+        frames.append(cv2.imencode(".jpg", image)[1].tobytes())
+    return frames
+
+
+def write_yolo_model(path, boxes, confs, channels=3, size=608):
+    """An ONNX model of YOLOv4's shape, returning the same boxes and confs for any input.
+
+    boxes is (n, 4) x1, y1, x2, y2 and confs (n, classes). The outputs still
+    depend on the input, so they come back once per image of a batch.
+    """
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+
+    box_const = numpy_helper.from_array(
+        np.asarray(boxes, dtype=np.float32).reshape(1, -1, 1, 4), "box_const"
+    )
+    conf_const = numpy_helper.from_array(
+        np.asarray(confs, dtype=np.float32).reshape(1, len(boxes), -1), "conf_const"
+    )
+    zero = numpy_helper.from_array(np.zeros((1,), dtype=np.float32), "zero")
+    shape = numpy_helper.from_array(np.array([-1, 1, 1], dtype=np.int64), "shape")
+    nodes = [
+        helper.make_node("ReduceMean", ["input"], ["mean"], axes=[1, 2, 3]),
+        helper.make_node("Mul", ["mean", "zero"], ["nothing"]),
+        helper.make_node("Add", ["nothing", "box_const"], ["boxes"]),
+        helper.make_node("Reshape", ["nothing", "shape"], ["nothing3"]),
+        helper.make_node("Add", ["nothing3", "conf_const"], ["confs"]),
+    ]
+    graph = helper.make_graph(
+        nodes,
+        "fake-yolov4",
+        [
+            helper.make_tensor_value_info(
+                "input", TensorProto.FLOAT, ["batch", channels, size, size]
+            )
+        ],
+        [
+            helper.make_tensor_value_info("boxes", TensorProto.FLOAT, None),
+            helper.make_tensor_value_info("confs", TensorProto.FLOAT, None),
+        ],
+        [box_const, conf_const, zero, shape],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 7
+    onnx.save(model, str(path))
+    return str(path)
+
+
+class FakeServer(object):
+    """An aiohttp application served from a background thread"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.call(self.start())
+
+    def call(self, coro):
+        """Run a coroutine on the server's loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(10)
+
+    def routes(self, app):
+        raise NotImplementedError
+
+    async def start(self):
+        app = web.Application()
+        self.routes(app)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", self.port).start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/".format(self.port)
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self.call(self.runner.cleanup())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FakeSnapshotServer(FakeServer):
+    """A camera answering digest authenticated snapshot requests"""
+
+    realm = "cam"
+    nonce = "abc123"
+
+    def __init__(self, user="admin", password="secret", delay=0, body=b"jpeg"):
+        self.user = user
+        self.password = password
+        self.delay = delay
+        self.body = body
+        self.challenges = 0
+        self.requests = 0
+        self.peers = set()
+        super().__init__()
+
+    def routes(self, app):
+        app.router.add_get("/snapshot.jpg", self.snapshot)
+
+    def valid(self, header):
+        if not header.startswith("Digest "):
+            return False
+        p = {
+            k: q or v
+            for k, q, v in re.findall(r'(\w+)=(?:"([^"]*)"|([^,\s]*))', header[7:])
+        }
+
+        def md5(s):
+            return hashlib.md5(s.encode()).hexdigest()
+
+        ha1 = md5("{}:{}:{}".format(self.user, self.realm, self.password))
+        ha2 = md5("GET:{}".format(p["uri"]))
+        expected = md5(
+            "{}:{}:{}:{}:auth:{}".format(ha1, self.nonce, p["nc"], p["cnonce"], ha2)
+        )
+        return p["nonce"] == self.nonce and p["response"] == expected
+
+    async def snapshot(self, request):
+        self.requests += 1
+        self.peers.add(request.transport.get_extra_info("peername"))
+        if not self.valid(request.headers.get("Authorization", "")):
+            self.challenges += 1
+            return web.Response(
+                status=401,
+                headers={
+                    "WWW-Authenticate": 'Digest realm="{}", qop="auth", nonce="{}", '
+                    'opaque="x"'.format(self.realm, self.nonce)
+                },
+            )
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return web.Response(body=self.body, content_type="image/jpeg")
+
+    @property
+    def uri(self):
+        return self.url + "snapshot.jpg"
+
+
+class FakeHomeAssistant(FakeServer):
+    """The parts of the Home Assistant REST and websocket APIs simplescan uses.
+
+    Service calls for input_boolean and the pause_person_detector script
+    change states, and every state change is pushed to websocket subscribers.
+    """
+
+    def __init__(self, states=None, token="fake-token-for-testing", delay=0):
+        self.token = token
+        self.delay = delay
+        self.states = {}
+        self.service_calls = []
+        self.state_requests = 0
+        self.sockets = set()
+        for entity, state in (states or {}).items():
+            self.states[entity] = self.new_state(entity, state)
+        super().__init__()
+
+    @property
+    def api(self):
+        return self.url + "api/"
+
+    def new_state(self, entity, state):
+        now = datetime.now(timezone.utc).isoformat()
+        return {
+            "entity_id": entity,
+            "state": state,
+            "attributes": {"friendly_name": entity},
+            "last_changed": now,
+            "last_updated": now,
+        }
+
+    def routes(self, app):
+        app.router.add_get("/api/", self.api_status)
+        app.router.add_get("/api/states", self.get_states)
+        app.router.add_get("/api/states/{entity}", self.get_state)
+        app.router.add_post("/api/services/{domain}/{service}", self.call_service)
+        app.router.add_get("/api/websocket", self.websocket)
+
+    def authorized(self, request):
+        return request.headers.get("Authorization") == "Bearer " + self.token
+
+    async def api_status(self, request):
+        if not self.authorized(request):
+            return web.json_response({"message": "Unauthorized"}, status=401)
+        return web.json_response({"message": "API running."})
+
+    async def get_states(self, request):
+        return web.json_response(list(self.states.values()))
+
+    async def get_state(self, request):
+        self.state_requests += 1
+        state = self.states.get(request.match_info["entity"])
+        if state is None:
+            return web.json_response({"message": "Entity not found."}, status=404)
+        return web.json_response(state)
+
+    async def call_service(self, request):
+        domain = request.match_info["domain"]
+        service = request.match_info["service"]
+        data = await request.json()
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.service_calls.append((domain, service, data))
+        entity = data.get("entity_id")
+        if domain == "input_boolean" and service in ("turn_on", "turn_off"):
+            await self.change(entity, "on" if service == "turn_on" else "off")
+        elif entity == "script.pause_person_detector":
+            await self.change("input_boolean.person_detector", "off")
+        return web.json_response([])
+
+    async def change(self, entity, state):
+        old = self.states.get(entity)
+        new = self.new_state(entity, state)
+        self.states[entity] = new
+        event = {
+            "type": "event",
+            "event": {
+                "event_type": "state_changed",
+                "data": {"entity_id": entity, "old_state": old, "new_state": new},
+            },
+        }
+        for ws, subscription in list(self.sockets):
+            event["id"] = subscription
+            await ws.send_json(event)
+
+    def set_state(self, entity, state):
+        """Change a state from outside the server, as a device would"""
+        self.call(self.change(entity, state))
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({"type": "auth_required", "ha_version": "fake"})
+        msg = await ws.receive_json()
+        if msg.get("access_token") != self.token:
+            await ws.send_json({"type": "auth_invalid", "message": "Invalid access"})
+            await ws.close()
+            return ws
+        await ws.send_json({"type": "auth_ok", "ha_version": "fake"})
+        subscribed = None
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    break
+                command = json.loads(msg.data)
+                if command["type"] == "subscribe_events":
+                    subscribed = (ws, command["id"])
+                    self.sockets.add(subscribed)
+                    result = None
+                elif command["type"] == "get_states":
+                    result = list(self.states.values())
+                else:
+                    await ws.send_json(
+                        {
+                            "id": command["id"],
+                            "type": "result",
+                            "success": False,
+                            "error": {"code": "unknown_command"},
+                        }
+                    )
+                    continue
+                await ws.send_json(
+                    {
+                        "id": command["id"],
+                        "type": "result",
+                        "success": True,
+                        "result": result,
+                    }
+                )
+        finally:
+            self.sockets.discard(subscribed)
+        return ws
+
+    def disconnect_websockets(self):
+        """Drop websocket clients, as a Home Assistant restart would"""
+
+        async def close():
+            for ws, _ in list(self.sockets):
+                await ws.close()
+
+        self.call(close())
+
+
+class FakePushover(FakeServer):
+    """The Pushover messages API, recording each message it is sent.
+
+    Responses carry Pushover's X-Limit-App headers, counting down from limit,
+    and are 429 once none are left. The first fail requests get a 500.
+    """
+
+    def __init__(self, limit=10000, fail=0, delay=0):
+        self.messages = []
+        self.limit = limit
+        self.remaining = limit
+        self.reset = int(time.time()) + 30 * 86400
+        self.fail = fail
+        self.delay = delay
+        self.requests = 0
+        super().__init__()
+
+    def routes(self, app):
+        app.router.add_post("/1/messages.json", self.post_message)
+
+    def headers(self):
+        return {
+            "X-Limit-App-Limit": str(self.limit),
+            "X-Limit-App-Remaining": str(self.remaining),
+            "X-Limit-App-Reset": str(self.reset),
+        }
+
+    async def post_message(self, request):
+        self.requests += 1
+        form = await request.post()
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.fail > 0:
+            self.fail -= 1
+            return web.json_response({"status": 0}, status=500)
+        if self.remaining <= 0:
+            return web.json_response(
+                {"status": 0, "errors": ["application over quota"]},
+                status=429,
+                headers=self.headers(),
+            )
+        message = {k: v for k, v in form.items() if isinstance(v, str)}
+        attachment = form.get("attachment")
+        if attachment is not None and not isinstance(attachment, str):
+            message["attachment"] = len(attachment.file.read())
+        self.messages.append(message)
+        self.remaining -= 1
+        return web.json_response(
+            {"status": 1, "request": str(len(self.messages))}, headers=self.headers()
+        )
+
+    @property
+    def messages_url(self):
+        return self.url + "1/messages.json"
+
+
+class FakeCodeProject(FakeServer):
+    """CodeProject AI's ALPR endpoint, finding the same plates in every image"""
+
+    def __init__(self, plates=(), delay=0):
+        self.plates = list(plates)
+        self.delay = delay
+        self.requests = 0
+        super().__init__()
+
+    def routes(self, app):
+        app.router.add_post("/v1/image/alpr", self.alpr)
+
+    async def alpr(self, request):
+        self.requests += 1
+        await request.post()
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return web.json_response(
+            {
+                "success": True,
+                "predictions": [
+                    {"label": "Plate: " + plate, "plate": plate, "confidence": 0.9}
+                    for plate in self.plates
+                ],
+            }
+        )
+
+    @property
+    def alpr_url(self):
+        return self.url + "v1/image/alpr"
+
+
+class FakeMqttClient(object):
+    """An in-process stand-in for a connected paho client, keeping what is published"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = []
+        self.retained = {}
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        with self.lock:
+            self.messages.append((topic, payload))
+            if retain:
+                self.retained[topic] = payload
+
+    def disconnect(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+
+class FakeBroker(FakeServer):
+    """Enough of an MQTT 3.1.1 broker for paho clients, keeping what is published.
+
+    Answers CONNECT, PUBLISH at QoS 0 and 1, SUBSCRIBE (without forwarding
+    anything), PINGREQ and DISCONNECT. drop() closes every connection, as a
+    broker restart would.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.retained = {}
+        self.connections = 0
+        self.writers = set()
+        super().__init__()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, "127.0.0.1", self.port)
+
+    async def packet(self, reader):
+        header = (await reader.readexactly(1))[0]
+        length = 0
+        shift = 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return header, await reader.readexactly(length)
+
+    async def serve(self, reader, writer):
+        self.connections += 1
+        self.writers.add(writer)
+        try:
+            while True:
+                header, body = await self.packet(reader)
+                kind = header >> 4
+                if kind == 1:
+                    writer.write(b"\x20\x02\x00\x00")
+                elif kind == 3:
+                    qos = (header >> 1) & 3
+                    n = int.from_bytes(body[:2], "big")
+                    topic = body[2 : 2 + n].decode()
+                    payload = body[2 + n :]
+                    if qos:
+                        writer.write(b"\x40\x02" + payload[:2])
+                        payload = payload[2:]
+                    payload = payload.decode()
+                    self.messages.append((topic, payload))
+                    if header & 1:
+                        self.retained[topic] = payload
+                elif kind == 8:
+                    i = 2
+                    topics = 0
+                    while i < len(body):
+                        i += 2 + int.from_bytes(body[i : i + 2], "big") + 1
+                        topics += 1
+                    writer.write(bytes([0x90, 2 + topics]) + body[:2] + bytes(topics))
+                elif kind == 12:
+                    writer.write(b"\xd0\x00")
+                elif kind == 14:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    def drop(self):
+        """Close the client connections"""
+
+        async def drop():
+            for writer in list(self.writers):
+                writer.close()
+
+        self.call(drop())
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+
+        async def stop():
+            self.server.close()
+            for writer in list(self.writers):
+                writer.close()
+            await self.server.wait_closed()
+
+        self.call(stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class FakeCameraFarm(FakeServer):
+    """Snapshot cameras at /cam/<n>/snapshot.jpg, without auth.
+
+    Each snapshot takes latency seconds, fails with a 500 with probability
+    failure_rate, and repeats the camera's previous frame with probability
+    duplicate_rate. Successful snapshot times are kept per camera.
+    """
+
+    def __init__(
+        self,
+        cameras,
+        size=(1920, 1080),
+        latency=0.05,
+        failure_rate=0.0,
+        duplicate_rate=0.0,
+        seed=0,
+    ):
+        self.cameras = cameras
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.duplicate_rate = duplicate_rate
+        self.random = random.Random(seed)
+        self.frames = synthetic_frames(size, seed=seed)
+        self.last = {}
+        self.served = {n: [] for n in range(cameras)}
+        self.failures = 0
+        self.duplicates = 0
+        super().__init__()
+
+    def routes(self, app):
+        app.router.add_get("/cam/{n}/snapshot.jpg", self.snapshot)
+
+    async def snapshot(self, request):
+        n = int(request.match_info["n"])
+        if n >= self.cameras:
+            return web.Response(status=404)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.random.random() < self.failure_rate:
+            self.failures += 1
+            return web.Response(status=500)
+        if n in self.last and self.random.random() < self.duplicate_rate:
+            self.duplicates += 1
+            body = self.last[n]
+        else:
+            body = self.random.choice(
+                [f for f in self.frames if f is not self.last.get(n)]
+            )
+        self.last[n] = body
+        self.served[n].append(time.monotonic())
+        return web.Response(body=body, content_type="image/jpeg")
+
+    def uri(self, n):
+        return self.url + "cam/{}/snapshot.jpg".format(n)
+
+
+class FakeFtpUploads(object):
+    """Cameras uploading a JPEG into their directory every interval seconds.
+
+    Files are written under a temporary name, then renamed, as FTP servers
+    do. written keeps the upload time of each file, so the backlog of files
+    not yet read can be measured.
+    """
+
+    def __init__(self, directories, interval=1.0, size=(1920, 1080), seed=0):
+        self.directories = directories
+        self.interval = interval
+        self.frames = synthetic_frames(size, seed=seed)
+        self.written = {directory: {} for directory in directories}
+        self.stopped = threading.Event()
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name="ftp-uploads", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        i = 0
+        while not self.stopped.wait(self.interval if i else 0):
+            for directory in self.directories:
+                path = os.path.join(directory, "{:06d}.jpg".format(i))
+                with open(path + ".part", "wb") as f:
+                    f.write(self.frames[i % len(self.frames)])
+                os.rename(path + ".part", path)
+                self.written[directory][path] = time.monotonic()
+            i += 1
+
+    def backlog(self):
+        """{directory: (files not yet read, age in seconds of the oldest)}"""
+        now = time.monotonic()
+        backlog = {}
+        for directory, written in self.written.items():
+            waiting = [t for path, t in list(written.items()) if os.path.exists(path)]
+            backlog[directory] = (len(waiting), now - min(waiting) if waiting else 0.0)
+        return backlog
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
@@ -0,0 +1,95 @@
+"""Fingerprints for skipping duplicate frames before they are decoded."""
+
+import zlib
+
+import cv2
+import numpy as np
+
+
+class Fingerprint(object):
+    """Remember the last accepted frame and flag frames which match it"""
+
+    def __init__(self):
+        self.last = None
+        self.checks = 0
+        self.duplicates = 0
+
+    def compute(self, data):
+        raise NotImplementedError
+
+    def matches(self, a, b):
+        return a == b
+
+    def is_duplicate(self, data):
+        """Whether the JPEG bytes match the last frame which wasn't a duplicate"""
+        self.checks += 1
+        value = self.compute(data)
+        if (
+            value is not None
+            and self.last is not None
+            and self.matches(self.last, value)
+        ):
+            self.duplicates += 1
+            return True
+        self.last = value
+        return False
+
+    def reset(self):
+        self.last = None
+
+
+class ExactFingerprint(Fingerprint):
+    """CRC32 of the compressed bytes, for cameras re-serving the same snapshot"""
+
+    def compute(self, data):
+        return zlib.crc32(data)
+
+
+class PerceptualFingerprint(Fingerprint):
+    """Difference hash of a small greyscale thumbnail.
+
+    The thumbnail is decoded with libjpeg at 1/8 scale, so a near-duplicate
+    costs a fraction of a full decode. Frames within distance bits of the last
+    accepted frame are duplicates, comparing against that frame rather than
+    the previous one so slow changes still add up.
+    """
+
+    def __init__(self, distance=4, size=8):
+        super().__init__()
+        self.distance = distance
+        self.size = size
+
+    def compute(self, data):
+        thumbnail = cv2.imdecode(
+            np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8
+        )
+        if thumbnail is None:
+            return None
+        return dhash(thumbnail, self.size)
+
+    def matches(self, a, b):
+        return bin(a ^ b).count("1") <= self.distance
+
+
+def dhash(image, size=8):
+    """size*size bit hash of whether each pixel is brighter than its right neighbour"""
+    small = cv2.resize(image, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def create_fingerprint(kind="exact", distance=4):
+    """Create a frame fingerprint.
+
+    Args:
+        kind: exact, perceptual or none.
+    """
+    if kind == "exact":
+        return ExactFingerprint()
+    if kind == "perceptual":
+        return PerceptualFingerprint(distance)
+    if kind == "none":
+        return None
+    raise ValueError(
+        "Unknown dedup {}, expected exact, perceptual or none".format(kind)
+    )
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+import cv2
+import numpy as np
+import pytest
+
+from fingerprint import (
+    ExactFingerprint,
+    PerceptualFingerprint,
+    create_fingerprint,
+    dhash,
+)
+
+
+def encode(image, quality=90):
+    ok, buf = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    assert ok
+    return buf.tobytes()
+
+
+def scene(seed=0):
+    rng = np.random.RandomState(seed)
+    small = rng.randint(0, 255, size=(12, 16, 3), dtype=np.uint8)
+    return cv2.resize(small, (640, 480), interpolation=cv2.INTER_CUBIC)
+
+
+def test_exact():
+    fingerprint = ExactFingerprint()
+    a = encode(scene(0))
+    assert not fingerprint.is_duplicate(a)
+    assert fingerprint.is_duplicate(a)
+    assert not fingerprint.is_duplicate(encode(scene(1)))
+    assert not fingerprint.is_duplicate(encode(scene(1), quality=80))
+    assert fingerprint.duplicates == 1 and fingerprint.checks == 4
+
+
+def test_perceptual_near_duplicate():
+    fingerprint = PerceptualFingerprint(distance=4)
+    assert not fingerprint.is_duplicate(encode(scene(0)))
+    # re-encoded, and with sensor noise
+    noisy = scene(0).astype(np.int16) + np.random.RandomState(5).randint(
+        -3, 4, size=(480, 640, 3)
+    )
+    assert fingerprint.is_duplicate(encode(scene(0), quality=70))
+    assert fingerprint.is_duplicate(encode(np.clip(noisy, 0, 255).astype(np.uint8)))
+    assert not fingerprint.is_duplicate(encode(scene(1)))
+
+
+def test_perceptual_undecodable():
+    fingerprint = PerceptualFingerprint()
+    assert not fingerprint.is_duplicate(b"junk")
+    assert not fingerprint.is_duplicate(b"junk")
+
+
+def test_dhash_bits():
+    gradient = np.tile(np.arange(9, dtype=np.uint8) * 20, (8, 1))
+    assert dhash(gradient) == 2**64 - 1
+    assert dhash(gradient[:, ::-1]) == 0
+
+
+def test_create_fingerprint():
+    assert isinstance(create_fingerprint(), ExactFingerprint)
+    assert create_fingerprint("perceptual", 6).distance == 6
+    assert create_fingerprint("none") is None
+    with pytest.raises(ValueError):
+        create_fingerprint("md5")
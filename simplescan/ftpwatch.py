@@ -0,0 +1,229 @@
+"""Find completed FTP uploads for Camera.poll.
+
+InotifyWatcher queues files as the FTP server closes them, so polling an
+idle camera costs one non-blocking read. FileScanner is the original
+recursive glob, used when inotify is not available.
+"""
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import subprocess
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from utils import cleanup
+
+logger = logging.getLogger(__name__)
+
+# Files older than this are stale and removed without being read
+MAX_AGE = timedelta(minutes=5)
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT = struct.Struct("iIII")
+
+
+def is_open(path):
+    """Whether another process still has path open, e.g. the FTP server"""
+    # requires SUID on fuser
+    # sudo chmod u+s /bin/fuser
+    completedProc = subprocess.run(["/bin/fuser", str(path)])
+    return completedProc.returncode == 0
+
+
+def is_stale(path):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return True
+    return datetime.fromtimestamp(mtime) < datetime.now() - MAX_AGE
+
+
+class FileScanner(object):
+    """Scan the whole FTP tree on every poll"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def next_file(self):
+        try:
+            files = sorted(
+                ((os.path.getmtime(f), f) for f in Path(self.path).glob("**/*.jpg")),
+            )
+            if len(files) == 0:
+                cleanup(self.path)
+                return None
+        except OSError as e:
+            logger.error(f"Error scanning {self.path}: {e}\n{e.args}")
+            return None
+        good_files = []
+        for mtime, f in files:
+            if datetime.fromtimestamp(mtime) < datetime.now() - MAX_AGE:
+                logger.warning(f"Skipping old file {f}")
+                os.remove(f)
+                continue
+            else:
+                good_files.append(f)
+        if len(good_files) == 0:
+            return None
+        f = good_files[0]
+        if is_open(f):
+            logger.debug(f"{f} is open for writing")
+            return None
+        return f
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Queue files which are closed after writing, or moved into the tree"""
+
+    def __init__(self, path):
+        self.fd = -1
+        if not os.path.isdir(path):
+            raise OSError(errno.ENOENT, "No such directory", path)
+        self.path = path
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.queue = collections.deque()
+        self.queued = set()
+        self.watch_tree(path)
+
+    def watch(self, directory):
+        wd = self.libc.inotify_add_watch(
+            self.fd,
+            os.fsencode(directory),
+            IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF,
+        )
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                logger.error(
+                    "Out of inotify watches, raise fs.inotify.max_user_watches"
+                )
+            raise OSError(err, "inotify_add_watch {} failed".format(directory))
+        self.watches[wd] = directory
+
+    def watch_tree(self, root):
+        """Watch root and every directory under it, queueing files already there.
+
+        Files found by the walk were not announced by an event, so they may
+        still be being written. They are queued in modification time order and
+        checked with fuser before they are read.
+        """
+        existing = []
+        for directory, _, files in os.walk(root):
+            self.watch(directory)
+            for name in files:
+                path = os.path.join(directory, name)
+                if name.endswith(".jpg"):
+                    try:
+                        existing.append((os.path.getmtime(path), path))
+                    except OSError:
+                        pass
+        for _, path in sorted(existing):
+            self.enqueue(path, complete=False)
+
+    def enqueue(self, path, complete=True):
+        if path not in self.queued:
+            self.queued.add(path)
+            self.queue.append((path, complete))
+
+    def read_events(self):
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = _EVENT.unpack_from(buf, offset)
+                offset += _EVENT.size
+                name = buf[offset : offset + length].rstrip(b"\0")
+                offset += length
+                self.handle(wd, mask, os.fsdecode(name))
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning(f"inotify queue overflow on {self.path}, rescanning")
+            for wd in list(self.watches):
+                self.libc.inotify_rm_watch(self.fd, wd)
+            self.watches = {}
+            self.watch_tree(self.path)
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        directory = self.watches.get(wd)
+        if directory is None or not name:
+            return
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # the FTP server creates a dated directory per upload
+                try:
+                    self.watch_tree(path)
+                except OSError as e:
+                    logger.warning(f"Failed to watch {path}: {e}")
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and name.endswith(".jpg"):
+            self.enqueue(path)
+
+    def next_file(self):
+        self.read_events()
+        while self.queue:
+            f, complete = self.queue.popleft()
+            self.queued.discard(f)
+            if not os.path.exists(f):
+                continue
+            if is_stale(f):
+                logger.warning(f"Skipping old file {f}")
+                os.remove(f)
+                continue
+            if not complete and is_open(f):
+                # its IN_CLOSE_WRITE event will queue it again
+                logger.debug(f"{f} is open for writing")
+                return None
+            return Path(f)
+        return None
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __del__(self):
+        self.close()
+
+
+def create_source(path, mode="auto"):
+    """Create the file source for an FTP path.
+
+    Args:
+        mode: inotify, scan, or auto to use inotify when it is available.
+    """
+    if mode != "scan":
+        try:
+            return InotifyWatcher(path)
+        except (AttributeError, OSError, TypeError) as e:
+            if mode == "inotify":
+                raise
+            logger.warning(f"inotify unavailable for {path} ({e}), scanning instead")
+    return FileScanner(path)
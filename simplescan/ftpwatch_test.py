@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import os
+import time
+
+import pytest
+
+from ftpwatch import FileScanner, InotifyWatcher, create_source
+
+
+@pytest.fixture
+def watcher(tmp_path):
+    try:
+        w = InotifyWatcher(str(tmp_path))
+    except (AttributeError, OSError) as e:
+        pytest.skip(f"inotify unavailable: {e}")
+    yield w
+    w.close()
+
+
+def test_close_write_is_queued(tmp_path, watcher):
+    assert watcher.next_file() is None
+    with open(tmp_path / "a.jpg", "wb") as f:
+        f.write(b"partial")
+        assert watcher.next_file() is None
+    assert watcher.next_file() == tmp_path / "a.jpg"
+    assert watcher.next_file() is None
+
+
+def test_moved_to_is_queued(tmp_path, watcher):
+    staging = tmp_path.parent / (tmp_path.name + "-staging.jpg")
+    staging.write_bytes(b"jpeg")
+    os.rename(staging, tmp_path / "moved.jpg")
+    assert watcher.next_file() == tmp_path / "moved.jpg"
+
+
+def test_new_directories_are_watched(tmp_path, watcher):
+    (tmp_path / "2024" / "01").mkdir(parents=True)
+    assert watcher.next_file() is None
+    (tmp_path / "2024" / "01" / "b.jpg").write_bytes(b"jpeg")
+    assert watcher.next_file() == tmp_path / "2024" / "01" / "b.jpg"
+
+
+def test_ignores_other_files_and_stale_files(tmp_path, watcher):
+    (tmp_path / "c.txt").write_bytes(b"text")
+    old = tmp_path / "old.jpg"
+    old.write_bytes(b"jpeg")
+    os.utime(old, (time.time() - 600, time.time() - 600))
+    assert watcher.next_file() is None
+    assert not old.exists()
+
+
+def test_create_source_falls_back_to_scanning(tmp_path):
+    assert isinstance(create_source(str(tmp_path / "missing")), FileScanner)
+    assert isinstance(create_source(str(tmp_path), "scan"), FileScanner)
@@ -0,0 +1,70 @@
+"""Detect IR (greyscale) frames from a sample of pixels."""
+
+from timeit import default_timer as timer
+
+import cv2
+
+
+class GreyDetector(object):
+    """Decide whether a camera is sending IR (greyscale) frames.
+
+    Only every step'th pixel in each direction is compared across channels,
+    instead of converting the whole frame to HSV. The decision changes once
+    hold consecutive frames disagree with it, so one odd frame at dusk doesn't
+    switch models back and forth.
+    """
+
+    def __init__(self, step=8, tolerance=0, hold=2):
+        self.step = step
+        self.tolerance = tolerance
+        self.hold = hold
+        self.grey = None
+        self.pending = 0
+        self.checks = 0
+        self.switches = 0
+        self.total_time = 0.0
+        self.last_time = 0.0
+
+    def is_grey(self, image):
+        """Whether the sampled pixels have no more than tolerance between channels"""
+        if len(image.shape) == 2 or image.shape[2] == 1:
+            return True
+        height, width = image.shape[:2]
+        # nearest neighbour picks pixels without blending, and is much faster
+        # than a strided numpy view of a large frame
+        sample = cv2.resize(
+            image,
+            (max(width // self.step, 1), max(height // self.step, 1)),
+            interpolation=cv2.INTER_NEAREST,
+        )
+        b, g, r = cv2.split(sample)[:3]
+        spread = max(cv2.norm(b, g, cv2.NORM_INF), cv2.norm(g, r, cv2.NORM_INF))
+        return spread <= self.tolerance
+
+    def update(self, image):
+        """Check a frame and return the, possibly unchanged, decision"""
+        start = timer()
+        grey = self.is_grey(image)
+        self.last_time = timer() - start
+        self.total_time += self.last_time
+        self.checks += 1
+        if self.grey is None:
+            self.grey = grey
+        elif grey != self.grey:
+            self.pending += 1
+            if self.pending >= self.hold:
+                self.grey = grey
+                self.pending = 0
+                self.switches += 1
+        else:
+            self.pending = 0
+        return self.grey
+
+    def stats(self):
+        return {
+            "grey": self.grey,
+            "checks": self.checks,
+            "switches": self.switches,
+            "last_ms": round(self.last_time * 1000, 3),
+            "mean_ms": round(self.total_time * 1000 / max(self.checks, 1), 3),
+        }
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+import numpy as np
+
+from greyscale import GreyDetector
+
+
+def color_frame():
+    frame = np.full((120, 160, 3), 90, dtype=np.uint8)
+    frame[:, :, 2] = 200
+    return frame
+
+
+def grey_frame():
+    return np.full((120, 160, 3), 90, dtype=np.uint8)
+
+
+def test_is_grey():
+    detector = GreyDetector(step=4)
+    assert detector.is_grey(grey_frame())
+    assert not detector.is_grey(color_frame())
+    assert detector.is_grey(np.zeros((120, 160), dtype=np.uint8))
+
+
+def test_tolerance():
+    frame = grey_frame()
+    frame[:, :, 1] += 2
+    assert not GreyDetector(step=1).is_grey(frame)
+    assert GreyDetector(step=1, tolerance=2).is_grey(frame)
+
+
+def test_hysteresis():
+    detector = GreyDetector(hold=2)
+    assert not detector.update(color_frame())
+    assert not detector.update(grey_frame())
+    assert not detector.update(color_frame())
+    assert not detector.update(grey_frame())
+    assert detector.update(grey_frame())
+    assert detector.switches == 1
+    stats = detector.stats()
+    assert stats["grey"] and stats["checks"] == 5
@@ -1,13 +1,340 @@
+import asyncio
+import collections
 import datetime
+import json
 import logging
-from typing import Any, Dict, Optional
-from urllib.parse import urljoin
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+from urllib.parse import urljoin, urlparse
 
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
 
 log = logging.getLogger(__name__)
 
 
+class StateCache:
+    """Entity states in memory, kept current by websocket events.
+
+    An entry is used while the websocket is subscribed (live), or for its TTL
+    after it was fetched or changed. Otherwise it is fetched again, and if
+    that fails the stale entry is used.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[str], Dict[str, Any]],
+        ttl: float = 30.0,
+        ttls: Optional[Dict[str, float]] = None,
+    ) -> None:
+        self.fetch = fetch
+        self.ttl = ttl
+        self.ttls: Dict[str, float] = ttls or {}
+        self.entries: Dict[str, Any] = {}
+        self.lock = threading.Lock()
+        self.live = False
+        self.hits = 0
+        self.fetches = 0
+        self.stale = 0
+
+    def put(self, entity: str, state: Optional[Dict[str, Any]]) -> None:
+        with self.lock:
+            if state is None:
+                self.entries.pop(entity, None)
+            else:
+                self.entries[entity] = (state, time.monotonic())
+
+    def assume(self, entity: str, state: str) -> None:
+        """Expect entity to change to state, until an event or fetch says otherwise"""
+        with self.lock:
+            entry = self.entries.get(entity)
+            if entry is not None:
+                self.entries[entity] = (dict(entry[0], state=state), time.monotonic())
+
+    def invalidate(self, entity: str) -> None:
+        """Fetch entity on the next read, e.g. after a service call changed it"""
+        with self.lock:
+            entry = self.entries.get(entity)
+            if entry is not None:
+                self.entries[entity] = (entry[0], float("-inf"))
+
+    def get(self, entity: str) -> Dict[str, Any]:
+        with self.lock:
+            entry = self.entries.get(entity)
+            ttl = self.ttls.get(entity, self.ttl)
+            if entry is not None and (
+                (self.live and entry[1] > float("-inf"))
+                or time.monotonic() - entry[1] < ttl
+            ):
+                self.hits += 1
+                return entry[0]
+        try:
+            self.fetches += 1
+            state = self.fetch(entity)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if entry is None:
+                raise RuntimeError(
+                    f"Failed to fetch {entity} and no cached response available"
+                ) from e
+            log.warning(f"Failed to fetch {entity}. Using cached response")
+            self.stale += 1
+            return entry[0]
+        if "state" in state:
+            self.put(entity, state)
+        return state
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "live": self.live,
+                "entities": len(self.entries),
+                "hits": self.hits,
+                "fetches": self.fetches,
+                "stale": self.stale,
+            }
+
+
+class StateListener:
+    """Push state_changed events from the Home Assistant websocket API into a cache"""
+
+    def __init__(self, url: str, token: str, cache: StateCache, retry: float = 5.0) -> None:
+        self.url = url
+        self.token = token
+        self.cache = cache
+        self.retry = retry
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="ha-websocket", daemon=True
+        )
+        self.thread.start()
+        self.task = asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+
+    async def start(self) -> "asyncio.Future[None]":
+        return asyncio.ensure_future(self.listen())
+
+    async def listen(self) -> None:
+        delay = self.retry
+        while True:
+            try:
+                await self.connect()
+                log.warning("Home Assistant websocket closed")
+                delay = self.retry
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(f"Home Assistant websocket failed: {e}")
+            finally:
+                self.cache.live = False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    async def connect(self) -> None:
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(self.url, heartbeat=30) as ws:
+                msg = await ws.receive_json()
+                if msg.get("type") != "auth_required":
+                    raise ValueError(f"Unexpected message {msg}")
+                await ws.send_json({"type": "auth", "access_token": self.token})
+                msg = await ws.receive_json()
+                if msg.get("type") != "auth_ok":
+                    raise ValueError(f"Authentication failed {msg}")
+                # subscribe before the snapshot so no change is missed in between
+                await ws.send_json(
+                    {"id": 1, "type": "subscribe_events", "event_type": "state_changed"}
+                )
+                await ws.send_json({"id": 2, "type": "get_states"})
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    self.handle(msg.json())
+
+    def handle(self, msg: Dict[str, Any]) -> None:
+        if msg.get("type") == "event":
+            data = msg["event"]["data"]
+            self.cache.put(data["entity_id"], data.get("new_state"))
+        elif msg.get("type") == "result":
+            if not msg.get("success"):
+                raise ValueError(f"Command failed {msg}")
+            if msg["id"] == 2:
+                for state in msg["result"]:
+                    self.cache.put(state["entity_id"], state)
+                self.cache.live = True
+                log.info(f"Subscribed to Home Assistant states, {len(msg['result'])} entities")
+
+    def close(self) -> None:
+        if self.loop.is_closed():
+            return
+
+        async def stop() -> None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+        asyncio.run_coroutine_threadsafe(stop(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class ServiceDispatcher:
+    """Call Home Assistant services from a thread pool, off the detection path.
+
+    Calls share the session's keep-alive connections. At most max_pending
+    calls wait or run at once; beyond that calls are dropped, so a hung Home
+    Assistant can't pile up work. A call identical to one made less than
+    window seconds ago, with no other call to the same entity in between,
+    is coalesced into it. Calls to the same entity are made in order.
+    """
+
+    def __init__(
+        self,
+        session: requests.Session,
+        api: str,
+        timeout: float = 10.0,
+        concurrency: int = 4,
+        max_pending: int = 64,
+        window: float = 10.0,
+    ) -> None:
+        self.session = session
+        self.api = api
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.window = window
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="ha-service"
+        )
+        self.cond = threading.Condition()
+        self.pending = 0
+        self.dropped = 0
+        self.recent: Dict[str, Tuple[float, Future]] = {}
+        self.last_call: Dict[str, Tuple[str, Future]] = {}
+        self.calls: Dict[str, int] = collections.Counter()
+        self.errors: Dict[str, int] = collections.Counter()
+        self.coalesced: Dict[str, int] = collections.Counter()
+        self.latencies: Dict[str, Deque[float]] = collections.defaultdict(
+            lambda: collections.deque(maxlen=100)
+        )
+
+    def call(self, domain: str, service: str, data: Dict[str, Any]) -> Future:
+        """Queue a service call, returning a future for its response"""
+        name = f"{domain}.{service}"
+        key = f"{name} {json.dumps(data, sort_keys=True)}"
+        entity = data.get("entity_id", name)
+        now = time.monotonic()
+        with self.cond:
+            recent = self.recent.get(key)
+            if (
+                recent is not None
+                and now - recent[0] < self.window
+                and self.last_call.get(entity, ("",))[0] == key
+            ):
+                self.coalesced[name] += 1
+                log.debug(f"Coalesced {key}")
+                return recent[1]
+            if self.pending >= self.max_pending:
+                self.dropped += 1
+                log.warning(f"Dropped {key}, {self.pending} service calls pending")
+                future: Future = Future()
+                future.set_exception(RuntimeError("Too many pending service calls"))
+                return future
+            self.pending += 1
+            for k, (t, _) in list(self.recent.items()):
+                if now - t >= self.window:
+                    del self.recent[k]
+            previous = self.last_call.get(entity, (None, None))[1]
+            future = self.executor.submit(
+                self.post, name, domain, service, data, previous
+            )
+            self.recent[key] = (now, future)
+            self.last_call[entity] = (key, future)
+        return future
+
+    def post(
+        self,
+        name: str,
+        domain: str,
+        service: str,
+        data: Dict[str, Any],
+        previous: Optional[Future],
+    ) -> requests.Response:
+        if previous is not None:
+            # started before this one, so it can't be waiting on this worker
+            previous.exception()
+        start = time.monotonic()
+        try:
+            r = self.session.post(
+                f"{self.api}services/{domain}/{service}",
+                json=data,
+                timeout=self.timeout,
+            )
+            r.raise_for_status()
+            return r
+        except Exception as e:
+            with self.cond:
+                self.errors[name] += 1
+            log.warning(f"Service {name} {data} failed: {e}")
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            metrics.observe("ha", elapsed, service=name)
+            with self.cond:
+                self.pending -= 1
+                self.calls[name] += 1
+                self.latencies[name].append(elapsed)
+                self.cond.notify_all()
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every queued call has finished"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.cond:
+            services = {}
+            for name in set(self.calls) | set(self.coalesced):
+                latencies = sorted(self.latencies.get(name, ()))
+                services[name] = {
+                    "calls": self.calls[name],
+                    "errors": self.errors[name],
+                    "coalesced": self.coalesced[name],
+                    "latency_ms": (
+                        round(latencies[len(latencies) // 2] * 1000, 1)
+                        if latencies
+                        else 0.0
+                    ),
+                    "max_latency_ms": (
+                        round(latencies[-1] * 1000, 1) if latencies else 0.0
+                    ),
+                }
+            return {
+                "pending": self.pending,
+                "dropped": self.dropped,
+                "services": services,
+            }
+
+
+def websocket_url(api: str) -> str:
+    """ws://host:8123/api/websocket for an api of http://host:8123/api/"""
+    parsed = urlparse(urljoin(api, "websocket"))
+    return parsed._replace(scheme="wss" if parsed.scheme == "https" else "ws").geturl()
+
+
 class HomeAssistant:
     """interface with HomeAssistant"""
 
@@ -17,8 +344,28 @@ class HomeAssistant:
             "Authorization": f"Bearer {self.config['token']}"
         }
         self.api: str = self.config.get("api", "http://homeassistant.home:8123/api/")
+        self.timeout = float(self.config.get("timeout", 10))
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        concurrency = int(self.config.get("service-concurrency", 4))
+        adapter = HTTPAdapter(pool_maxsize=concurrency + 2)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.services = ServiceDispatcher(
+            self.session,
+            self.api,
+            self.timeout,
+            concurrency,
+            window=float(self.config.get("service-window", 10)),
+        )
+        ttls = {
+            k[len("ttl.") :]: float(v) for k, v in config.items() if k.startswith("ttl.")
+        }
+        self.states = StateCache(
+            self.fetch_state, float(self.config.get("state-ttl", 30)), ttls
+        )
         try:
-            response: requests.Response = requests.get(self.api, headers=self.headers, timeout=10)
+            response: requests.Response = self.session.get(self.api, timeout=self.timeout)
             message: str = response.json().get("message", "")
             log.debug(f"Home Assistant {message}")
             if message != "API running.":
@@ -27,36 +374,60 @@ class HomeAssistant:
             log.warning(f"Failed to connect to Home Assistant: {e}")
         self.names: Dict[str, Any] = {}
         try:
-            response = requests.get(urljoin(self.api, "states"), headers=self.headers, timeout=10)
+            response = self.session.get(urljoin(self.api, "states"), timeout=self.timeout)
             for entity in response.json():
+                self.states.put(entity["entity_id"], entity)
                 if "friendly_name" in entity["attributes"]:
                     self.names[entity["attributes"]["friendly_name"]] = entity
         except (requests.exceptions.RequestException, KeyError, ValueError) as e:
             log.warning(f"Failed to load HA states: {e}")
         self.last_house_cleaners_arrived: Optional[datetime.datetime] = None
-        self.cache: Dict[str, Any] = {}
+        self.listener: Optional[StateListener] = None
+        if self.config.getboolean("websocket", True):
+            self.listener = StateListener(
+                websocket_url(self.api), self.config["token"], self.states
+            )
+
+    def close(self) -> None:
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        self.services.close()
+        self.session.close()
+
+    def fetch_state(self, entity: str) -> Dict[str, Any]:
+        response = self.session.get(f"{self.api}states/{entity}", timeout=self.timeout)
+        return response.json()
 
-    def set_scene(self, scene: str) -> requests.Response:
-        r = requests.post(
-            f"{self.api}services/scene/turn_on",
-            json={"entity_id": f"scene.{scene}"},
-            headers=self.headers,
+    def call_service(
+        self, domain: str, service: str, data: Dict[str, Any], message: str
+    ) -> Future:
+        future = self.services.call(domain, service, data)
+
+        def done(f: Future) -> None:
+            if f.exception() is None:
+                log.info(f"{message}={f.result()}")
+
+        future.add_done_callback(done)
+        return future
+
+    def set_scene(self, scene: str) -> Future:
+        return self.call_service(
+            "scene",
+            "turn_on",
+            {"entity_id": f"scene.{scene}"},
+            f"Turned on scene {scene}",
         )
-        log.info(f"Turned on scene {scene}={r}")
-        return r
 
     def open_garage_door(self) -> None:
         raise NotImplementedError
 
-    def deer_alert(self, location: str) -> None:
+    def deer_alert(self, location: str) -> Future:
         json = {
             "entity_id": "script.deer",
             "variables": {"location": location},
         }
-        r = requests.post(
-            f"{self.api}services/script/turn_on", json=json, headers=self.headers
-        )
-        log.info(f"Deer alert={r}")
+        return self.call_service("script", "turn_on", json, "Deer alert")
 
     def get_device(self, name: str) -> Any:
         try:
@@ -65,46 +436,31 @@ class HomeAssistant:
             raise KeyError('No such device "{}"'.format(name))
 
     def get_state(self, entity: str) -> bool:
-        try:
-            response = requests.get(
-                f"{self.api}states/{entity}", headers=self.headers
-            ).json()
-            self.cache[entity] = response
-        except requests.exceptions.ConnectionError:
-            if entity not in self.cache:
-                raise RuntimeError(
-                    f"Failed to fetch {self.api}states/{entity} and no cached response available"
-                )
-            log.warning(
-                f"Failed to fetch {self.api}states/{entity}. Using cached response"
-            )
-            response = self.cache[entity]
+        response = self.states.get(entity)
         if "state" in response:
             return response["state"] == "on"
         log.debug(response)
         raise RuntimeError(f"Invalid response from entity {entity}={response}")
 
-    def set_input_boolean(self, switch: str, state: bool) -> requests.Response:
+    def set_input_boolean(self, switch: str, state: bool) -> Future:
         json = {
             "entity_id": switch,
         }
-        if state:
-            response = requests.post(
-                f"{self.api}services/input_boolean/turn_on",
-                json=json,
-                headers=self.headers,
-            )
-        else:
-            response = requests.post(
-                f"{self.api}services/input_boolean/turn_off",
-                json=json,
-                headers=self.headers,
-            )
-        if response.status_code != 200:
-            log.warning(f"Set input_boolean {switch} to {state}={response.content}")
-        return response
+        future = self.services.call(
+            "input_boolean", "turn_on" if state else "turn_off", json
+        )
+        # read back what was set, unless the call fails
+        self.states.assume(switch, "on" if state else "off")
+
+        def done(f: Future) -> None:
+            if f.exception() is not None:
+                log.warning(f"Set input_boolean {switch} to {state}={f.exception()}")
+                self.states.invalidate(switch)
 
-    def set_notify_vehicle(self, state: bool) -> requests.Response:
+        future.add_done_callback(done)
+        return future
+
+    def set_notify_vehicle(self, state: bool) -> Future:
         return self.set_input_boolean("input_boolean.vehicle_detector", state)
 
     def get_door_left(self) -> bool:
@@ -114,10 +470,7 @@ class HomeAssistant:
         return self.get_state("binary_sensor.konnected_198e05_zone_5")
 
     def get_presence(self, person: str) -> bool:
-        response = requests.get(
-            f"{self.api}states/{person}", headers=self.headers
-        ).json()
-        return response["state"] == "home"
+        return self.states.get(person)["state"] == "home"
 
     def should_notify_vehicle(self) -> bool:
         return self.get_state("input_boolean.vehicle_detector")
@@ -132,15 +485,12 @@ class HomeAssistant:
         if self.get_presence("group.egge"):
             log.info("Speaking {}".format(message))
             json = {"message": message, "data": {"type": "tts"}}
-            r = requests.post(
-                f"{self.api}services/notify/alexa_media_kitchen_ecobee4",
-                json=json,
-                headers=self.headers,
+            return self.call_service(
+                "notify", "alexa_media_kitchen_ecobee4", json, f"Spoke {message}"
             )
-            return r.content.decode("utf-8")
         else:
             log.info("Not speaking {}".format(message))
-            return True
+            return None
 
     def mode(self) -> str:
         if self.get_state("input_boolean.night_mode"):
@@ -151,20 +501,7 @@ class HomeAssistant:
             return "away"
 
     def is_dog_inside(self) -> bool:
-        entity = "sensor.rufus_status"
-        try:
-            response = requests.get(
-                f"{self.api}states/{entity}", headers=self.headers
-            ).json()
-            self.cache[entity] = response
-        except requests.exceptions.ConnectionError:
-            if entity not in self.cache:
-                raise RuntimeError(
-                    f"Failed to fetch {entity} and no cached response available"
-                )
-            log.warning(f"Failed to fetch {entity}. Using cached response")
-            response = self.cache[entity]
-        return response.get("state") == "inside"
+        return self.states.get("sensor.rufus_status").get("state") == "inside"
 
     def is_dark(self) -> bool:
         return self.get_state("binary_sensor.is_dark")
@@ -179,14 +516,18 @@ class HomeAssistant:
         else:
             return False
 
-    def suppress_notify_person(self) -> str:
+    def suppress_notify_person(self) -> Future:
         log.debug("Keep person notify suppressed")
-        r = requests.post(
-            f"{self.api}services/script/turn_on",
-            json={"entity_id": "script.pause_person_detector"},
-            headers=self.headers,
+        future = self.call_service(
+            "script",
+            "turn_on",
+            {"entity_id": "script.pause_person_detector"},
+            "Paused person detector",
+        )
+        future.add_done_callback(
+            lambda f: self.states.invalidate("input_boolean.person_detector")
         )
-        return r.content.decode("utf-8")
+        return future
 
     def house_cleaners_arrived(self) -> None:
         if (
@@ -194,12 +535,12 @@ class HomeAssistant:
             or datetime.datetime.now() - self.last_house_cleaners_arrived
             > datetime.timedelta(days=1)
         ):
-            r = requests.post(
-                f"{self.api}services/script/turn_on",
-                json={"entity_id": "script.house_cleaners_arrive"},
-                headers=self.headers,
+            self.call_service(
+                "script",
+                "turn_on",
+                {"entity_id": "script.house_cleaners_arrive"},
+                "Run script house cleaners arrive",
             )
-            log.info(f"Run script house cleaners arrive={r}")
             self.last_house_cleaners_arrived = datetime.datetime.now()
         else:
             log.info(f"House cleaners last arrrived {self.last_house_cleaners_arrived}")
@@ -1,70 +1,52 @@
 #!/usr/bin/env python3
 import configparser
-from unittest.mock import MagicMock, patch
+import time
 
 import pytest
 
+from fakes import FakeHomeAssistant
 from homeassistant import HomeAssistant
 
+STATES = {
+    "input_boolean.vehicle_detector": "on",
+    "input_boolean.person_detector": "on",
+    "binary_sensor.konnected_198e05_zone_4": "off",
+    "binary_sensor.konnected_198e05_zone_5": "off",
+    "input_boolean.night_mode": "off",
+    "input_boolean.vacation_mode": "off",
+    "binary_sensor.is_dark": "off",
+    "group.egge": "home",
+    "sensor.rufus_status": "outside",
+}
 
-config = configparser.ConfigParser()
-config.read("config-test.txt")
-
-
-class MockHAAPI:
-    """Stateful mock of the Home Assistant REST API."""
-
-    def __init__(self):
-        self.states = {
-            "input_boolean.vehicle_detector": "on",
-            "input_boolean.person_detector": "on",
-            "binary_sensor.konnected_198e05_zone_4": "off",
-            "binary_sensor.konnected_198e05_zone_5": "off",
-            "input_boolean.night_mode": "off",
-            "input_boolean.vacation_mode": "off",
-            "binary_sensor.is_dark": "off",
-            "group.egge": "home",
-        }
-
-    def get(self, url, **kwargs):
-        resp = MagicMock()
-        resp.status_code = 200
-        if url.endswith("/api/"):
-            resp.json.return_value = {"message": "API running."}
-        elif url.endswith("/api/states"):
-            resp.json.return_value = [
-                {"entity_id": k, "attributes": {"friendly_name": k}, "state": v}
-                for k, v in self.states.items()
-            ]
-        elif "/api/states/" in url:
-            entity = url.split("/api/states/")[-1]
-            state = self.states.get(entity, "unknown")
-            resp.json.return_value = {"state": state}
-        return resp
-
-    def post(self, url, json=None, **kwargs):
-        resp = MagicMock()
-        resp.status_code = 200
-        resp.content = b"ok"
-        if json and "entity_id" in json:
-            entity = json["entity_id"]
-            if "input_boolean/turn_on" in url:
-                self.states[entity] = "on"
-            elif "input_boolean/turn_off" in url:
-                self.states[entity] = "off"
-            elif entity == "script.pause_person_detector":
-                self.states["input_boolean.person_detector"] = "off"
-        return resp
+
+def ha_config(server, **options):
+    config = configparser.ConfigParser()
+    config.read("config-test.txt")
+    config["homeassistant"]["api"] = server.api
+    for k, v in options.items():
+        config["homeassistant"][k] = v
+    return config["homeassistant"]
 
 
 @pytest.fixture
-def ha():
-    mock_api = MockHAAPI()
-    with patch("homeassistant.requests") as mock_requests:
-        mock_requests.get = mock_api.get
-        mock_requests.post = mock_api.post
-        mock_requests.exceptions = __import__("requests").exceptions
-        yield HomeAssistant(config["homeassistant"])
+def server():
+    with FakeHomeAssistant(STATES) as server:
+        yield server
+
+
+@pytest.fixture
+def ha(server):
+    ha = HomeAssistant(ha_config(server))
+    yield ha
+    ha.close()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
 
 
 def test_should_notify_vehicle(ha):
@@ -80,6 +62,7 @@ def test_should_notify_vehicle(ha):
 def test_should_notify_person(ha):
     assert type(ha.should_notify_person()) == bool
     ha.suppress_notify_person()
+    assert ha.services.join(5)
     assert ha.should_notify_person() is False
 
 
@@ -105,13 +88,90 @@ def test_is_before_six(ha):
     assert result in [True, False]
 
 
+def test_websocket_pushes_changes(server, ha):
+    wait_for(lambda: ha.states.live)
+    assert ha.mode() == "home"
+    requests_before = server.state_requests
+    server.set_state("input_boolean.night_mode", "on")
+    wait_for(lambda: ha.mode() == "night")
+    server.set_state("sensor.rufus_status", "inside")
+    wait_for(ha.is_dog_inside)
+    assert server.state_requests == requests_before
+
+
+def test_ttl_without_websocket(server):
+    ha = HomeAssistant(ha_config(server, websocket="false", **{"state-ttl": "60"}))
+    try:
+        assert ha.is_dark() is False
+        server.set_state("binary_sensor.is_dark", "on")
+        # cached until the TTL expires
+        assert ha.is_dark() is False
+        ha.states.ttls["binary_sensor.is_dark"] = 0
+        assert ha.is_dark() is True
+    finally:
+        ha.close()
+
+
+def test_stale_state_when_unreachable(server):
+    ha = HomeAssistant(ha_config(server, websocket="false", **{"state-ttl": "0"}))
+    try:
+        assert ha.vacation_mode() is False
+        server.close()
+        assert ha.vacation_mode() is False
+        assert ha.states.stale == 1
+        with pytest.raises(RuntimeError):
+            ha.get_state("input_boolean.unknown")
+    finally:
+        ha.close()
+
+
+def test_service_calls_coalesced(server, ha):
+    for _ in range(3):
+        ha.deer_alert("driveway")
+    ha.deer_alert("backyard")
+    assert ha.services.join(5)
+    locations = [d["variables"]["location"] for _, _, d in server.service_calls]
+    assert locations == ["driveway", "backyard"]
+    stats = ha.services.stats()["services"]["script.turn_on"]
+    assert stats["calls"] == 2
+    assert stats["coalesced"] == 2
+
+
+def test_switch_toggles_not_coalesced(server, ha):
+    for state in (False, True, False):
+        ha.set_notify_vehicle(state)
+    assert ha.should_notify_vehicle() is False
+    assert ha.services.join(5)
+    assert [s for _, s, _ in server.service_calls] == [
+        "turn_off",
+        "turn_on",
+        "turn_off",
+    ]
+    assert server.states["input_boolean.vehicle_detector"]["state"] == "off"
+
+
+def test_hung_server_does_not_block():
+    with FakeHomeAssistant(STATES, delay=1) as server:
+        ha = HomeAssistant(
+            ha_config(server, timeout="0.5", **{"service-concurrency": "1"})
+        )
+        try:
+            start = time.monotonic()
+            for location in "abc":
+                ha.deer_alert(location)
+            ha.set_scene("night")
+            assert time.monotonic() - start < 0.1
+            assert ha.services.join(5)
+            stats = ha.services.stats()["services"]
+            assert stats["script.turn_on"]["errors"] == 3
+            assert stats["scene.turn_on"]["max_latency_ms"] >= 500
+        finally:
+            ha.close()
+
+
 def main():
-    mock_api = MockHAAPI()
-    with patch("homeassistant.requests") as mock_requests:
-        mock_requests.get = mock_api.get
-        mock_requests.post = mock_api.post
-        mock_requests.exceptions = __import__("requests").exceptions
-        ha = HomeAssistant(config["homeassistant"])
+    with FakeHomeAssistant(STATES) as server:
+        ha = HomeAssistant(ha_config(server))
         print("HomeAssistant Status:")
         print("-" * 30)
         print(f"Notify Vehicle: {ha.should_notify_vehicle()}")
@@ -124,6 +184,7 @@ def main():
         print(
             f"Time between midnight and 6AM: {ha.is_time_after_midnight_and_before_six()}"
         )
+        ha.close()
 
 
 if __name__ == "__main__":
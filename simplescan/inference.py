@@ -0,0 +1,108 @@
+"""Inference sessions which own their input and output buffers.
+
+A session is created once per model. The input and output buffers are
+allocated when the session is created and reused for every frame, so the
+per-frame cost is only the copy into the input buffer and the forward pass.
+"""
+
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceSession(object):
+    """Backend interface for a loaded model with preallocated I/O buffers.
+
+    Callers fill ``input_buffer`` (shape ``(max_batch_size, C, H, W)``) and
+    then call ``run`` with the number of images written. Outputs are views into
+    buffers owned by the session and are only valid until the next ``run``;
+    hold ``lock`` from filling the input until the outputs have been consumed.
+    """
+
+    def __init__(self, input_shape):
+        self.input_shape = tuple(input_shape)
+        self.lock = threading.RLock()
+
+    @property
+    def max_batch_size(self):
+        return self.input_shape[0]
+
+    @property
+    def input_buffer(self):
+        raise NotImplementedError
+
+    def run(self, batch_size=1):
+        """Run the model on the first ``batch_size`` images in ``input_buffer``.
+
+        Returns:
+            List of output arrays, batch first.
+        """
+        raise NotImplementedError
+
+
+class OnnxRuntimeSession(InferenceSession):
+    """CPU inference through ONNX Runtime using I/O binding.
+
+    Useful for testing and benchmarking the detection pipeline on a machine
+    without a GPU.
+    """
+
+    def __init__(self, model_filename, input_shape):
+        super(OnnxRuntimeSession, self).__init__(input_shape)
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(
+            model_filename, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [o.name for o in self.session.get_outputs()]
+        self.host_input = np.zeros(self.input_shape, dtype=np.float32)
+        # one full size run to discover the output shapes, then allocate them
+        outputs = self.session.run(None, {self.input_name: self.host_input})
+        self.host_outputs = [np.zeros_like(o) for o in outputs]
+        self.binding = self.session.io_binding()
+        self.bound_batch_size = None
+        logger.info(
+            "Loaded {} with input {} and outputs {}".format(
+                model_filename,
+                self.input_shape,
+                [o.shape for o in self.host_outputs],
+            )
+        )
+
+    @property
+    def input_buffer(self):
+        return self.host_input
+
+    def bind(self, batch_size):
+        self.binding.clear_binding_inputs()
+        self.binding.clear_binding_outputs()
+        self.binding.bind_input(
+            self.input_name,
+            "cpu",
+            0,
+            np.float32,
+            (batch_size,) + self.input_shape[1:],
+            self.host_input.ctypes.data,
+        )
+        for name, out in zip(self.output_names, self.host_outputs):
+            self.binding.bind_output(
+                name,
+                "cpu",
+                0,
+                out.dtype,
+                (batch_size,) + out.shape[1:],
+                out.ctypes.data,
+            )
+        self.bound_batch_size = batch_size
+
+    def run(self, batch_size=1):
+        assert 0 < batch_size <= self.max_batch_size
+        with self.lock:
+            if self.bound_batch_size != batch_size:
+                self.bind(batch_size)
+            self.session.run_with_iobinding(self.binding)
+            return [out[:batch_size] for out in self.host_outputs]
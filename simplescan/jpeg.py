@@ -0,0 +1,71 @@
+"""JPEG decoding at reduced resolution using libjpeg DCT scaling."""
+
+import struct
+
+import cv2
+import numpy as np
+
+REDUCED_COLOR = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# Start of frame markers, which hold the image size. C4, C8 and CC are not frames.
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_size(data):
+    """Read (width, height) from the JPEG header without decoding.
+
+    Returns:
+        None if data is not a JPEG or has no frame header.
+    """
+    data = memoryview(data).cast("B")
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # fill byte
+            i += 1
+            continue
+        if marker in _SOF_MARKERS:
+            height, width = struct.unpack(">HH", data[i + 5 : i + 9])
+            return width, height
+        if marker == 0xD8 or 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            # markers without a length
+            i += 2
+            continue
+        (length,) = struct.unpack(">H", data[i + 2 : i + 4])
+        i += 2 + length
+    return None
+
+
+def reduction_for(size, min_size):
+    """The largest DCT scale factor which still covers min_size (width, height)"""
+    if size is None or min_size is None:
+        return 1
+    width, height = size
+    min_width, min_height = min_size
+    for factor in (8, 4, 2):
+        if width // factor >= min_width and height // factor >= min_height:
+            return factor
+    return 1
+
+
+def decode(data, min_size=None, flags=cv2.IMREAD_COLOR):
+    """Decode a JPEG, at a reduced resolution if it still covers min_size.
+
+    Returns:
+        (image, factor), image is None if the data can't be decoded.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    factor = reduction_for(jpeg_size(data), min_size)
+    if factor == 1:
+        return cv2.imdecode(buf, flags), 1
+    return cv2.imdecode(buf, REDUCED_COLOR[factor]), factor
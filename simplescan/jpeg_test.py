@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+import cv2
+import numpy as np
+
+from jpeg import decode, jpeg_size, reduction_for
+
+
+def encode(width, height):
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    image[:, : width // 2] = (0, 0, 255)
+    ok, buf = cv2.imencode(".jpg", image)
+    assert ok
+    return buf.tobytes()
+
+
+def test_jpeg_size():
+    assert jpeg_size(encode(2688, 1520)) == (2688, 1520)
+    assert jpeg_size(b"not a jpeg") is None
+    assert jpeg_size(b"\xff\xd8\xff\xe0") is None
+
+
+def test_reduction_covers_model_size():
+    assert reduction_for((3840, 2160), (608, 608)) == 2
+    assert reduction_for((2688, 1520), (608, 608)) == 2
+    assert reduction_for((1280, 720), (608, 608)) == 1
+    assert reduction_for((5120, 5120), (608, 608)) == 8
+    assert reduction_for(None, (608, 608)) == 1
+    assert reduction_for((3840, 2160), None) == 1
+
+
+def test_decode_reduced():
+    data = encode(2688, 1520)
+    image, factor = decode(data, (608, 608))
+    assert factor == 2
+    assert image.shape == (760, 1344, 3)
+    image, factor = decode(data)
+    assert factor == 1
+    assert image.shape == (1520, 2688, 3)
+
+
+def test_decode_bad_data():
+    image, factor = decode(b"\xff\xd8garbage")
+    assert image is None
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""Load test the main loop with synthetic snapshot and FTP cameras.
+
+Usage: python loadgen.py [--cameras 4,8,16] [--ftp 0.25] [--duration 60]
+
+For each camera count, a FakeCameraFarm serves the snapshot cameras and
+FakeFtpUploads writes JPEGs into the ftp-path of the others. A config for
+them, fake Home Assistant and Pushover servers and ONNX Runtime models is
+written, and main() runs against it for duration seconds. Reports the main
+loop's cycle time, frames per second, how stale cameras got, and the
+process's threads and memory.
+"""
+
+import argparse
+import asyncio
+import collections
+import configparser
+import logging
+import os
+import resource
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+import main as aicam
+import metrics
+from camera import MODEL_SIZE
+from fakes import (
+    HOME_STATES,
+    FakeCameraFarm,
+    FakeFtpUploads,
+    FakeHomeAssistant,
+    FakeMqttClient,
+    FakePushover,
+    write_yolo_model,
+)
+
+logger = logging.getLogger(__name__)
+
+LABELS = ["person", "dog", "vehicle"]
+VEHICLE_LABELS = ["package", "vehicle"]
+
+
+def rss_mb():
+    """Resident memory of this process, the peak where /proc isn't available"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_models(directory, size=MODEL_SIZE[0]):
+    """Constant output models, {section: (onnx, channels)}, and their label files"""
+    for name, labels in [
+        ("labels.txt", LABELS),
+        ("vehicle-labels.txt", VEHICLE_LABELS),
+    ]:
+        with open(os.path.join(directory, name), "w") as f:
+            f.write("\n".join(labels))
+    person = [[0.1, 0.1, 0.3, 0.5]], [[0.9, 0.0, 0.0]]
+    vehicle = [[0.5, 0.5, 0.9, 0.9]], [[0.0, 0.9]]
+    return {
+        "color-model": (
+            write_yolo_model(os.path.join(directory, "color.onnx"), *person, 3, size),
+            3,
+        ),
+        "grey-model": (
+            write_yolo_model(os.path.join(directory, "grey.onnx"), *person, 1, size),
+            1,
+        ),
+        "vehicle-model": (
+            write_yolo_model(
+                os.path.join(directory, "vehicle.onnx"), *vehicle, 3, size
+            ),
+            3,
+        ),
+    }
+
+
+def write_config(
+    directory,
+    snapshot_uris,
+    ftp_paths,
+    ha_server,
+    pushover,
+    models,
+    models_directory,
+    size=MODEL_SIZE[0],
+    interval=1,
+    max_batch=8,
+):
+    """A config.txt for the cameras and fakes, returning its path"""
+    config = configparser.ConfigParser()
+    config["detector"] = {
+        "threshold": "0.5",
+        "save-path": os.path.join(directory, "save"),
+        "labelfile-path": os.path.join(models_directory, "labels.txt"),
+        "vehicle-labelfile-path": os.path.join(models_directory, "vehicle-labels.txt"),
+        "max-batch": str(max_batch),
+        "metrics-port": "0",
+    }
+    for section, (onnx, channels) in models.items():
+        config[section] = {
+            "backend": "onnxruntime",
+            "onnx": onnx,
+            "channels": str(channels),
+            "height": str(size),
+            "width": str(size),
+            "max-batch": str(max_batch),
+            "prob_threshold": "0.4",
+        }
+    for section in ["thresholds", "colors", "priority", "mqtt_icons"]:
+        config[section] = {}
+    config["sounds"] = {"departed": "pushover"}
+    config["mqtt"] = {"host": "localhost", "user": "", "password": ""}
+    config["homeassistant"] = {"api": ha_server.api, "token": ha_server.token}
+    config["pushover"] = {"token": "load", "user": "load", "url": pushover.messages_url}
+    i = 0
+    for n, uri in enumerate(snapshot_uris):
+        config["cam%d" % i] = {
+            "name": "snap%d" % n,
+            "uri": uri,
+            "async": "true",
+            "interval": str(interval),
+            "timeout": "10",
+        }
+        i += 1
+    for n, path in enumerate(ftp_paths):
+        config["cam%d" % i] = {"name": "ftp%d" % n, "ftp-path": path}
+        i += 1
+    path = os.path.join(directory, "config.txt")
+    with open(path, "w") as f:
+        config.write(f)
+    return path
+
+
+def staleness(times, start, end):
+    """The longest a camera went without a snapshot, counting from start to end"""
+    times = [start] + sorted(times) + [end]
+    return max(b - a for a, b in zip(times, times[1:]))
+
+
+def run(cameras, workdir, models, args):
+    """Run main() against cameras synthetic cameras, returning a report row"""
+    ftp_cameras = int(round(cameras * args.ftp))
+    directory = tempfile.mkdtemp(prefix="load-%d-" % cameras, dir=workdir)
+    size = tuple(int(v) for v in args.resolution.split("x"))
+    farm = FakeCameraFarm(
+        cameras - ftp_cameras,
+        size=size,
+        latency=args.latency,
+        failure_rate=args.failure_rate,
+        duplicate_rate=args.duplicate_rate,
+    )
+    ftp_paths = [os.path.join(directory, "ftp%d" % n) for n in range(ftp_cameras)]
+    ha_server = FakeHomeAssistant(HOME_STATES)
+    pushover = FakePushover()
+    config = write_config(
+        directory,
+        [farm.uri(n) for n in range(farm.cameras)],
+        ftp_paths,
+        ha_server,
+        pushover,
+        models,
+        workdir,
+        interval=args.interval,
+        max_batch=args.max_batch,
+    )
+    uploads = FakeFtpUploads(ftp_paths, interval=args.ftp_interval, size=size)
+    previous = metrics.get()
+    registry = metrics.Metrics()
+    metrics.set_metrics(registry)
+    # main() takes over SIGINT and SIGTERM
+    handlers = {s: signal.getsignal(s) for s in (signal.SIGINT, signal.SIGTERM)}
+    samples = collections.defaultdict(list)
+    ftp_stale = collections.defaultdict(float)
+    stopped = threading.Event()
+
+    def sample():
+        deadline = time.monotonic() + args.duration
+        while not stopped.wait(1.0):
+            samples["threads"].append(threading.active_count())
+            samples["rss"].append(rss_mb())
+            for path, (_, age) in uploads.backlog().items():
+                ftp_stale[path] = max(ftp_stale[path], age)
+            if time.monotonic() > deadline:
+                aicam.kill_now = True
+
+    sampler = threading.Thread(target=sample, name="loadgen", daemon=True)
+    aicam.kill_now = False
+    start = time.monotonic()
+    sampler.start()
+    loop = asyncio.new_event_loop()
+    try:
+        options = argparse.Namespace(config_file=config, sync=False, trt=False)
+        loop.run_until_complete(aicam.main(options, mqtt_client=FakeMqttClient()))
+    finally:
+        end = time.monotonic()
+        loop.close()
+        metrics.set_metrics(previous)
+        for s, handler in handlers.items():
+            signal.signal(s, handler)
+        stopped.set()
+        sampler.join()
+        uploads.close()
+        for server in (farm, ha_server, pushover):
+            server.close()
+        shutil.rmtree(directory, ignore_errors=True)
+    summary = registry.summary()
+    stale = sorted(
+        [staleness(farm.served[n], start, end) for n in range(farm.cameras)]
+        + list(ftp_stale.values())
+    )
+    cycle = summary["stages"].get("cycle", {"p50": 0.0, "p95": 0.0})
+    frames = summary["stages"].get("predict", {}).get("count", 0)
+    return {
+        "cameras": cameras,
+        "ftp": ftp_cameras,
+        "seconds": end - start,
+        "cycle_p50": cycle["p50"],
+        "cycle_p95": cycle["p95"],
+        "fps": frames / (end - start),
+        "stale_p50": stale[len(stale) // 2] if stale else 0.0,
+        "stale_max": stale[-1] if stale else 0.0,
+        "events": summary["events"],
+        "threads": max(samples["threads"], default=threading.active_count()),
+        "rss_mb": max(samples["rss"], default=rss_mb()),
+    }
+
+
+def print_report(rows):
+    columns = "{:>7} {:>4} {:>9} {:>9} {:>8} {:>9} {:>9} {:>7} {:>5} {:>6} {:>7} {:>7}"
+    print(
+        columns.format(
+            "cameras",
+            "ftp",
+            "cycle p50",
+            "cycle p95",
+            "frames/s",
+            "stale p50",
+            "stale max",
+            "dropped",
+            "dups",
+            "errors",
+            "threads",
+            "rss MB",
+        )
+    )
+    for row in rows:
+        print(
+            columns.format(
+                row["cameras"],
+                row["ftp"],
+                "%.0fms" % row["cycle_p50"],
+                "%.0fms" % row["cycle_p95"],
+                "%.2f" % row["fps"],
+                "%.1fs" % row["stale_p50"],
+                "%.1fs" % row["stale_max"],
+                row["events"]["dropped"],
+                row["events"]["dup"],
+                row["events"]["error"],
+                row["threads"],
+                "%.0f" % row["rss_mb"],
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cameras", default="4,8,16", help="camera counts to run")
+    parser.add_argument("--ftp", type=float, default=0.25, help="share of FTP cameras")
+    parser.add_argument("--duration", type=float, default=60, help="seconds per run")
+    parser.add_argument("--resolution", default="1920x1080")
+    parser.add_argument("--latency", type=float, default=0.05, help="snapshot seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--duplicate-rate", type=float, default=0.0)
+    parser.add_argument("--interval", type=int, default=1, help="camera interval")
+    parser.add_argument("--ftp-interval", type=float, default=2.0)
+    parser.add_argument("--max-batch", type=int, default=8)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix="loadgen-")
+    try:
+        models = write_models(workdir)
+        rows = []
+        for cameras in (int(n) for n in args.cameras.split(",")):
+            print("Running {} cameras for {}s".format(cameras, args.duration))
+            rows.append(run(cameras, workdir, models, args))
+        print_report(rows)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
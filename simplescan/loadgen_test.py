@@ -0,0 +1,50 @@
+import argparse
+
+import pytest
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+import loadgen  # noqa: E402
+from fakes import FakeCameraFarm  # noqa: E402
+
+
+def test_staleness():
+    assert loadgen.staleness([], 10.0, 15.0) == 5.0
+    assert loadgen.staleness([12.0, 11.0], 10.0, 15.0) == 3.0
+
+
+def test_camera_farm():
+    import requests
+
+    with FakeCameraFarm(2, size=(64, 48), latency=0, duplicate_rate=1.0) as farm:
+        first = requests.get(farm.uri(0), timeout=5).content
+        assert requests.get(farm.uri(0), timeout=5).content == first
+        assert requests.get(farm.uri(2), timeout=5).status_code == 404
+    assert len(farm.served[0]) == 2
+    assert farm.duplicates == 1
+    with FakeCameraFarm(1, size=(64, 48), latency=0, failure_rate=1.0) as farm:
+        assert requests.get(farm.uri(0), timeout=5).status_code == 500
+    assert farm.served[0] == []
+
+
+def test_run(tmp_path):
+    args = argparse.Namespace(
+        ftp=0.5,
+        duration=3,
+        resolution="320x240",
+        latency=0.01,
+        failure_rate=0.0,
+        duplicate_rate=0.0,
+        interval=1,
+        ftp_interval=0.5,
+        max_batch=4,
+    )
+    models = loadgen.write_models(str(tmp_path))
+    row = loadgen.run(2, str(tmp_path), models, args)
+    assert row["cameras"] == 2
+    assert row["ftp"] == 1
+    assert row["fps"] > 0
+    assert 0 < row["stale_max"] < row["seconds"]
+    assert row["threads"] > 1
+    assert row["rss_mb"] > 0
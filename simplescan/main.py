@@ -4,26 +4,38 @@ import asyncio
 import concurrent.futures
 import configparser
 import faulthandler
+import functools
 import json
 import logging
 import os
 import pathlib
+import queue
 import signal
 import subprocess
 import sys
 import time
 from datetime import datetime, timedelta
 from timeit import default_timer as timer
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 import paho.mqtt.client as paho
 import requests
 import sdnotify
 
+import artifacts
+import codeproject
+import metrics
+import pushover
+from batching import BatchPredictor
 from camera import Camera
+from capture import AsyncCaptureEngine
 from detect import detect
 from homeassistant import HomeAssistant
-from object_detection_rtv4 import ONNXTensorRTv4ObjectDetection
+from metrics import MetricsServer
+from object_detection_v4 import load_model
+from pipeline import DROP_OLDEST, Stage
+from publisher import Publisher
+from scheduler import Scheduler
 from utils import cleanup
 
 log: logging.Logger = logging.getLogger("aicam")
@@ -55,6 +67,15 @@ def device_info(version: str) -> dict:
     }
 
 
+def publish_metrics(publisher: Publisher, summary: Dict[str, Any]) -> None:
+    """Latency quantiles per stage and frame event totals for the diagnostic sensors"""
+    for stage, stats in summary["stages"].items():
+        publisher.publish(f"{DEVICE_ID}/metrics/{stage}", json.dumps(stats), retain=True)
+    publisher.publish(
+        f"{DEVICE_ID}/metrics/events", json.dumps(summary["events"]), retain=True
+    )
+
+
 def on_publish(client: paho.Client, userdata: Any, mid: int) -> None:
     mlog.debug("on_publish({},{})".format(userdata, mid))
 
@@ -89,15 +110,7 @@ class GracefulKiller:
         kill_now = True
 
 
-async def main(options: argparse.Namespace) -> None:
-    config: configparser.ConfigParser = configparser.ConfigParser()
-    config.read(options.config_file)
-    ha: HomeAssistant = HomeAssistant(config["homeassistant"])
-    detector_config: Dict[str, str] = config["detector"]
-    color_model_config: Dict[str, str] = config["color-model"]
-    grey_model_config: Dict[str, str] = config["grey-model"]
-    mqtt_icons: Dict[str, str] = config["mqtt_icons"]
-    lwt: str = "aicam/status"
+def connect_mqtt(mqtt_config: Dict[str, str], lwt: str) -> paho.Client:
     mqtt_client: paho.Client = paho.Client(client_id="aicam")
     mqtt_client.enable_logger(logger=mlog)
     mqtt_client.on_publish = on_publish
@@ -107,7 +120,6 @@ async def main(options: argparse.Namespace) -> None:
     mqtt_client.will_set(lwt, payload="offline", qos=0, retain=True)
     mqtt_client.reconnect_delay_set(min_delay=1, max_delay=30)
     mqtt_client._reconnect_deadline = None
-    mqtt_config = config["mqtt"]
     mqtt_client.username_pw_set(mqtt_config["user"], mqtt_config["password"])
     try:
         mqtt_client.connect(mqtt_config["host"], mqtt_config.getint("port", 1883), keepalive=60)
@@ -116,6 +128,37 @@ async def main(options: argparse.Namespace) -> None:
         raise
     mqtt_client.subscribe("test")  # get on connect messages
     mqtt_client.loop_start()
+    return mqtt_client
+
+
+async def main(
+    options: argparse.Namespace, mqtt_client: Optional[paho.Client] = None
+) -> None:
+    """Run the detection loop until killed.
+
+    mqtt_client is a connected client to use instead of connecting to the
+    broker in [mqtt], as for load tests.
+    """
+    config: configparser.ConfigParser = configparser.ConfigParser()
+    config.read(options.config_file)
+    ha: HomeAssistant = HomeAssistant(config["homeassistant"])
+    detector_config: Dict[str, str] = config["detector"]
+    color_model_config: Dict[str, str] = config["color-model"]
+    grey_model_config: Dict[str, str] = config["grey-model"]
+    mqtt_icons: Dict[str, str] = config["mqtt_icons"]
+    lwt: str = "aicam/status"
+    mqtt_config = config["mqtt"]
+    if mqtt_client is None:
+        mqtt_client = connect_mqtt(mqtt_config, lwt)
+    else:
+        mqtt_client._reconnect_deadline = None
+
+    # everything the cameras and main loop publish, on the one connection
+    publisher = Publisher(
+        mqtt_client,
+        maxsize=detector_config.getint("mqtt-queue", 1024),
+        batch_wait=detector_config.getfloat("mqtt-batch-wait", 0.05),
+    )
 
     # Load labels
     with open(detector_config["labelfile-path"], "r") as f:
@@ -133,30 +176,73 @@ async def main(options: argparse.Namespace) -> None:
     static_dir = os.path.join(config["detector"]["save-path"], "static")
     pathlib.Path(static_dir).mkdir(parents=True, exist_ok=True)
 
+    writer = artifacts.ArtifactWriter(
+        max_bytes=detector_config.getint("artifact-memory", 64) * 1024 * 1024,
+        fsync=detector_config.getboolean("artifact-fsync", True),
+    )
+    artifacts.set_writer(writer)
+    codeproject_config = config["codeproject"] if "codeproject" in config else {}
+    plate_reader = codeproject.PlateReader(
+        url=codeproject_config.get("url"),
+        workers=int(codeproject_config.get("workers", 2)),
+        queue=int(codeproject_config.get("queue", 8)),
+        lookups=int(codeproject_config.get("lookups", 3)),
+    )
+    codeproject.set_reader(plate_reader)
+    pushover_config = config["pushover"] if "pushover" in config else {}
+    pushover_queue = pushover.PushoverQueue(
+        workers=int(pushover_config.get("workers", 2)),
+        maxsize=int(pushover_config.get("queue", 32)),
+        retries=int(pushover_config.get("retries", 3)),
+        reserve=int(pushover_config.get("reserve", 50)),
+    )
+    pushover.set_queue(pushover_queue)
+
+    registry = metrics.get()
+    metrics_server = None
+    metrics_port = detector_config.getint("metrics-port", 9180)
+    if metrics_port > 0:
+        try:
+            metrics_server = MetricsServer(
+                registry, metrics_port, detector_config.get("metrics-host", "")
+            )
+            log.info("Serving metrics on port %d", metrics_server.port)
+        except OSError as e:
+            log.warning(f"Failed to serve metrics on port {metrics_port}: {e}")
+    metrics_interval = detector_config.getfloat("metrics-interval", 60)
+
     sd = sdnotify.SystemdNotifier()
     sd.notify("STATUS=Loading color model")
-    color_model = ONNXTensorRTv4ObjectDetection(color_model_config, labels)
+    color_model = load_model(color_model_config, labels)
     sd.notify("STATUS=Loading grey model")
-    grey_model = ONNXTensorRTv4ObjectDetection(grey_model_config, labels)
+    grey_model = load_model(grey_model_config, labels)
     sd.notify("STATUS=Loading vehicle/packages model")
-    vehicle_model = ONNXTensorRTv4ObjectDetection(
-        config["vehicle-model"], vehicle_labels
-    )
+    vehicle_model = load_model(config["vehicle-model"], vehicle_labels)
     sd.notify("STATUS=Loaded models")
 
     cams = []
     i = 0
     while "cam%d" % i in config.sections():
         cams.append(
-            Camera(config["cam%d" % i], excludes.get(config["cam%d" % i]["name"], {}), mqtt_config)
+            Camera(
+                config["cam%d" % i],
+                excludes.get(config["cam%d" % i]["name"], {}),
+                publisher,
+            )
         )
         i += 1
     log.info("Configured %i cams" % i)
     async_cameras = len(list(filter(lambda cam: cam.capture_async, cams)))
     # async_cameras = 4
     log.info("%i async workers" % async_cameras)
+    capture_engine = None
     if async_cameras > 0 and not options.sync:
         async_pool = concurrent.futures.ThreadPoolExecutor(max_workers=async_cameras)
+        # snapshots of async cameras share one connection pool and event loop
+        capture_engine = AsyncCaptureEngine(
+            executor=async_pool,
+            concurrency=detector_config.getint("capture-concurrency", async_cameras),
+        )
     else:
         async_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 
@@ -215,6 +301,45 @@ async def main(options: argparse.Namespace) -> None:
     )
     mqtt_client.publish(f"{DEVICE_ID}/camera_count", len(cams), retain=True)
 
+    for stage in metrics.STAGES:
+        mqtt_client.publish(
+            f"homeassistant/sensor/{DEVICE_ID}-latency-{stage}/config",
+            json.dumps(
+                {
+                    "name": f"{stage} Latency".title(),
+                    "state_topic": f"{DEVICE_ID}/metrics/{stage}",
+                    "value_template": "{{ value_json.p95 }}",
+                    "json_attributes_topic": f"{DEVICE_ID}/metrics/{stage}",
+                    "unit_of_measurement": "ms",
+                    "state_class": "measurement",
+                    "uniq_id": f"{DEVICE_ID}-latency-{stage}",
+                    "availability_topic": lwt,
+                    "icon": "mdi:timer-outline",
+                    "entity_category": "diagnostic",
+                    "device": dev,
+                }
+            ),
+            retain=True,
+        )
+    for event in metrics.EVENTS:
+        mqtt_client.publish(
+            f"homeassistant/sensor/{DEVICE_ID}-frames-{event}/config",
+            json.dumps(
+                {
+                    "name": f"Frames {event}".title(),
+                    "state_topic": f"{DEVICE_ID}/metrics/events",
+                    "value_template": "{{ value_json.%s }}" % event,
+                    "state_class": "total_increasing",
+                    "uniq_id": f"{DEVICE_ID}-frames-{event}",
+                    "availability_topic": lwt,
+                    "icon": "mdi:counter",
+                    "entity_category": "diagnostic",
+                    "device": dev,
+                }
+            ),
+            retain=True,
+        )
+
     for cam in cams:
         mqtt_client.publish(
             f"homeassistant/binary_sensor/show-{cam.ha_name}/config",
@@ -234,6 +359,43 @@ async def main(options: argparse.Namespace) -> None:
             retain=True,
         )
         mqtt_client.publish(f"{cam.ha_name}/show", False, retain=True)
+        mqtt_client.publish(
+            f"homeassistant/binary_sensor/ir-{cam.ha_name}/config",
+            json.dumps(
+                {
+                    "name": f"{cam.name} IR".title(),
+                    "state_topic": f"{cam.ha_name}/ir",
+                    "json_attributes_topic": f"{cam.ha_name}/ir/stats",
+                    "uniq_id": f"ir-{cam.ha_name}",
+                    "availability_topic": lwt,
+                    "payload_off": False,
+                    "payload_on": True,
+                    "icon": "mdi:weather-night",
+                    "entity_category": "diagnostic",
+                    "device": dev,
+                }
+            ),
+            retain=True,
+        )
+        if cam.motion_gate is not None:
+            mqtt_client.publish(
+                f"homeassistant/sensor/motion-{cam.ha_name}/config",
+                json.dumps(
+                    {
+                        "name": f"{cam.name} Motion Skipped".title(),
+                        "state_topic": f"{cam.ha_name}/motion",
+                        "value_template": "{{ (value_json.skip_ratio * 100) | round(1) }}",
+                        "json_attributes_topic": f"{cam.ha_name}/motion",
+                        "unit_of_measurement": "%",
+                        "uniq_id": f"motion-{cam.ha_name}",
+                        "availability_topic": lwt,
+                        "icon": "mdi:motion-pause",
+                        "entity_category": "diagnostic",
+                        "device": dev,
+                    }
+                ),
+                retain=True,
+            )
         for item in cam.mqtt:
             mqtt_client.publish(
                 f"homeassistant/sensor/{cam.ha_name}-{item}/config",
@@ -253,9 +415,118 @@ async def main(options: argparse.Namespace) -> None:
             )
             mqtt_client.publish(f"{cam.ha_name}/{item}/count", 0, retain=True)
 
+    batcher = BatchPredictor(
+        color_model,
+        grey_model,
+        vehicle_model,
+        max_batch=detector_config.getint("max-batch", 8),
+    )
+    batch_wait = detector_config.getfloat("batch-wait", 0.05)
+    results = queue.Queue()
+
+    scheduler = Scheduler(detector_config)
+    for cam in cams:
+        scheduler.add(cam)
+
+    def release(cam, fresh=False):
+        """The camera is done with its frame, fresh when it was a new one"""
+        cam.in_flight = None
+        scheduler.done(cam, fresh)
+
+    def drop_frame(cam):
+        cam.error = "dropped"
+        metrics.count("dropped", cam.name)
+        release(cam, True)
+
+    def detect_frames(batch):
+        """Rules, tracking, notifications and saving, off the inference thread"""
+        for cam, inference in batch:
+            try:
+                results.put(
+                    detect(
+                        cam,
+                        color_model,
+                        grey_model,
+                        vehicle_model,
+                        config,
+                        ha,
+                        inference=inference,
+                    )
+                )
+            except Exception:
+                log.exception("Error in detection pipeline")
+            finally:
+                release(cam, cam.has_image)
+
+    def infer_frames(cams):
+        try:
+            inferences = batcher.predict(cams)
+        except Exception:
+            log.exception("Batch prediction failed, predicting one by one")
+            inferences = {}
+        for cam in cams:
+            detect_stage.put((cam, inferences.get(cam)))
+
+    detect_stage = Stage(
+        "detect",
+        detect_frames,
+        workers=detector_config.getint("detect-workers", 2),
+        maxsize=detector_config.getint("detect-queue", 8),
+    )
+    # frames waiting for inference, the oldest are dropped when it falls behind
+    inference_stage = Stage(
+        "inference",
+        infer_frames,
+        maxsize=detector_config.getint("frame-queue", batcher.max_batch * 2),
+        policy=detector_config.get("frame-policy", DROP_OLDEST),
+        batch_size=batcher.max_batch,
+        max_wait=batch_wait,
+        on_drop=drop_frame,
+    )
+    registry.register("pipeline", inference_stage.stats, stage="inference")
+    registry.register("pipeline", detect_stage.stats, stage="detect")
+    registry.register("artifacts", writer.stats)
+    registry.register("mqtt", publisher.stats)
+    registry.register("alpr", plate_reader.stats)
+    registry.register("pushover", pushover_queue.stats)
+    registry.register("ha_services", ha.services.stats)
+    registry.register("ha_states", ha.states.stats)
+    for cam in cams:
+        registry.register("grey", cam.grey_detector.stats, camera=cam.name)
+        if cam.motion_gate is not None:
+            registry.register("motion", cam.motion_gate.stats, camera=cam.name)
+        registry.register(
+            "schedule", functools.partial(scheduler.stats, cam.name), camera=cam.name
+        )
+
+    def captured(cam, future):
+        try:
+            ready = future.result()
+        except Exception:
+            log.exception("Error in camera %s", cam.name)
+            ready = None
+        if ready:
+            inference_stage.put(cam)
+        else:
+            release(cam)
+
+    def submit(cam, future):
+        """Track a camera's capture, which joins the pipeline once it completes"""
+        future.add_done_callback(lambda f: captured(cam, f))
+        return future
+
+    def wait_in_flight(timeout=180):
+        deadline = time.monotonic() + timeout
+        while any(cam.in_flight is not None for cam in cams):
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
     sd.notify("READY=1")
     sd.notify("STATUS=Running")
     cleanup_time = datetime(1970, 1, 1, 0, 0, 0)
+    metrics_time = time.monotonic()
     GracefulKiller()
     global kill_now
     while not kill_now:
@@ -267,88 +538,48 @@ async def main(options: argparse.Namespace) -> None:
         start_time = timer()
         prediction_time = 0.0
         notify_time = 0.0
-        capture_futures = []
         messages = []
         log_line = ""
-        for cam in filter(lambda cam: cam.ftp_path, cams):
+        for cam in cams:
+            if cam.in_flight is not None and time.monotonic() - cam.in_flight > 180:
+                log.warning("Camera %s timed out after 180s, continuing", cam.name)
+                release(cam)
+        # FTP and snapshot cameras alike, the longest overdue first
+        for cam, snapshot in scheduler.due():
+            if cam.in_flight is not None:
+                # timed out earlier, it is rescheduled when released
+                continue
             try:
-                capture_futures.append(async_pool.submit(cam.poll))
+                cam.in_flight = time.monotonic()
+                if not snapshot:
+                    submit(cam, async_pool.submit(cam.poll))
+                    log_line = log_line or "Reading "
+                elif capture_engine is not None and cam.capture_async:
+                    submit(cam, capture_engine.submit(cam))
+                    log_line = "Snapshotting "
+                else:
+                    submit(cam, async_pool.submit(cam.capture))
+                    log_line = "Snapshotting "
             except KeyboardInterrupt:
                 return
             except requests.exceptions.ConnectionError:
-                log.warning("cam:%s poll: %s", cam.name, sys.exc_info()[1])
-
-        count = 0
-        try:
-            for f in concurrent.futures.as_completed(capture_futures, timeout=180):
-                try:
-                    cam = f.result()
-                    if cam:
-                        p, n, m = detect(
-                            cam,
-                            color_model,
-                            grey_model,
-                            vehicle_model,
-                            config,
-                            ha,
-                        )
-                        prediction_time += p
-                        notify_time += n
-                        messages.append(m)
-                        count += 1
-                except KeyboardInterrupt:
-                    return
-                except Exception:
-                    log.exception("Error in detection pipeline")
-        except concurrent.futures.TimeoutError:
-            log.warning("Camera poll timed out after 180s, continuing")
-
-        if count == 0:
-            # scan each camera
-            for cam in filter(
-                lambda cam: (datetime.now() - cam.prior_time).total_seconds()
-                > cam.interval,
-                cams,
-            ):
-                try:
-                    capture_futures.append(async_pool.submit(cam.capture))
-                    count += 1
-                except KeyboardInterrupt:
-                    return
-                except requests.exceptions.ConnectionError:
-                    log.warning(
-                        "cam:%s ConnectionError: %s", cam.name, sys.exc_info()[1]
-                    )
-            if count > 0:
-                log_line = "Snapshotting "
+                release(cam)
+                log.warning("cam:%s ConnectionError: %s", cam.name, sys.exc_info()[1])
 
+        if "once" in detector_config:
+            wait_in_flight()
+        while True:
             try:
-                for f in concurrent.futures.as_completed(capture_futures, timeout=180):
-                    try:
-                        cam = f.result()
-                        if cam:
-                            p, n, m = detect(
-                                cam,
-                                color_model,
-                                grey_model,
-                                vehicle_model,
-                                config,
-                                ha,
-                            )
-                            prediction_time += p
-                            notify_time += n
-                            messages.append(m)
-                    except KeyboardInterrupt:
-                        return
-                    except Exception:
-                        log.exception("Error in detection pipeline")
-            except concurrent.futures.TimeoutError:
-                log.warning("Camera capture timed out after 180s, continuing")
-        else:
-            log_line = "Reading "
+                p, n, m = results.get_nowait()
+            except queue.Empty:
+                break
+            prediction_time += p
+            notify_time += n
+            messages.append(m)
 
         end_time = timer()
-        if count > 0:
+        metrics.observe("cycle", end_time - start_time)
+        if len(messages) > 0:
             log_line += ",".join(sorted(messages))
             log_line += ".. completed in %.2fs, spent %.2fs predicting" % (
                 (end_time - start_time),
@@ -356,28 +587,65 @@ async def main(options: argparse.Namespace) -> None:
             )
             if notify_time > 0:
                 log_line += ", %.2fs notifying" % (notify_time)
-        if len(log_line) > 0:
+            writer_stats = writer.stats()
+            if writer_stats["depth"] > 0:
+                log_line += ", %d artifacts queued (%.0fms latency)" % (
+                    writer_stats["depth"],
+                    writer_stats["latency_ms"],
+                )
             log.info(log_line)
-        if prediction_time < 0.1:
-            if datetime.now() - cleanup_time > timedelta(minutes=15):
-                log.debug("Cleaning up")
-                for cam in filter(lambda cam: cam.ftp_path, cams):
-                    cleanup(cam.ftp_path)
-                    cam.globber = None
-                cleanup_time = datetime.now()
-            else:
-                time.sleep(1.0)
+        if time.monotonic() - metrics_time > metrics_interval:
+            publish_metrics(publisher, registry.summary())
+            metrics_time = time.monotonic()
+        if prediction_time < 0.1 and (
+            datetime.now() - cleanup_time > timedelta(minutes=15)
+        ):
+            log.debug("Cleaning up")
+            log.debug(
+                "Pipeline inference=%s detect=%s artifacts=%s",
+                inference_stage.stats(),
+                detect_stage.stats(),
+                writer.stats(),
+            )
+            log.debug("Home Assistant services=%s", ha.services.stats())
+            for cam in filter(lambda cam: cam.motion_gate is not None, cams):
+                log.debug("%s motion=%s", cam.name, cam.motion_gate.stats())
+            log.debug("Staleness=%s", scheduler.staleness())
+            for cam in filter(lambda cam: cam.ftp_path, cams):
+                cleanup(cam.ftp_path)
+            cleanup_time = datetime.now()
+        elif "once" not in detector_config:
+            scheduler.wait(1.0)
         if "once" in detector_config:
             break
 
+    if not wait_in_flight(timeout=30):
+        log.warning("Shutting down with frames still in flight")
+    inference_stage.close()
+    detect_stage.close()
+    artifacts.set_writer(None)
+    writer.close()
+    codeproject.set_reader(None)
+    plate_reader.close()
+    # notifications from the last frames are still worth sending
+    pushover.set_queue(None)
+    pushover_queue.close(timeout=30)
+    ha.close()
+    if metrics_server is not None:
+        metrics_server.close()
+
     # set item counts to unavailable
     for cam in cams:
         for item in cam.mqtt:
-            mqtt_client.publish(f"{cam.name}/{item}/count", None, retain=False)
-            mqtt_client.publish(f"{cam.ha_name}/{item}/count", None, retain=False)
+            publisher.publish(f"{cam.name}/{item}/count", None, retain=False)
+            publisher.publish(f"{cam.ha_name}/{item}/count", None, retain=False)
         del cam
+    publisher.close()
     # graceful shutdown
     log.info("Graceful shutdown initiated")
+    if capture_engine is not None:
+        capture_engine.close()
+    async_pool.shutdown(wait=False)
     mqtt_client.disconnect()  # disconnect gracefully
     mqtt_client.loop_stop()  # stops network loop
     # Models are cleaned up automatically at exit via atexit handler
@@ -0,0 +1,268 @@
+"""Latency histograms and counters of the detection pipeline, served on /metrics and MQTT."""
+
+import collections
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from timeit import default_timer as timer
+
+logger = logging.getLogger(__name__)
+
+# hot path stages, in pipeline order
+STAGES = [
+    "capture",
+    "decode",
+    "resize",
+    "preprocess",
+    "inference",
+    "postprocess",
+    "predict",
+    "rules",
+    "tracking",
+    "notify",
+    "write",
+    "ha",
+    "alpr",
+    "pushover",
+    # queued to published on the MQTT connection
+    "mqtt",
+    # one pass of the main loop
+    "cycle",
+]
+# per camera frame events
+EVENTS = ["dropped", "dup", "still", "skip", "error"]
+QUANTILES = (0.5, 0.95, 0.99)
+PREFIX = "aicam"
+
+
+class Histogram(object):
+    """The most recent size samples of a latency, with a count and sum of all of them"""
+
+    def __init__(self, size=1024):
+        self.samples = collections.deque(maxlen=size)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.sum += seconds
+
+    def quantiles(self):
+        """{quantile: seconds} over the recent samples, by nearest rank"""
+        samples = sorted(self.samples)
+        if not samples:
+            return {q: 0.0 for q in QUANTILES}
+        return {
+            q: samples[min(int(q * len(samples)), len(samples) - 1)] for q in QUANTILES
+        }
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, escape(v)) for k, v in labels) + "}"
+
+
+def sanitize(name):
+    return "".join(c if c.isalnum() else "_" for c in name)
+
+
+def gauges(prefix, stats, labels=()):
+    """(name, labels, value) for the numbers in a stats() dict.
+
+    Nested dicts extend the name, except a dict of dicts, such as stats per
+    service, whose keys become a name label.
+    """
+    for key, value in stats.items():
+        name = prefix + "_" + sanitize(key)
+        if isinstance(value, bool):
+            yield name, labels, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, labels, value
+        elif isinstance(value, dict):
+            if value and all(isinstance(v, dict) for v in value.values()):
+                for sub, v in value.items():
+                    yield from gauges(name, v, labels + (("name", sub),))
+            else:
+                yield from gauges(name, value, labels)
+
+
+class Metrics(object):
+    """Thread safe latency histograms per stage and labels, and event counters.
+
+    Stages are labelled with camera and model where they are known. Every
+    stage also keeps an unlabelled histogram over all cameras and models, for
+    the MQTT sensors, which /metrics only serves for stages without labels.
+    Objects with a stats() method can be registered to be exported as gauges.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = collections.Counter()
+        self.collectors = {}
+
+    def observe(self, stage, seconds, **labels):
+        keys = {(stage, ()), (stage, tuple(sorted(labels.items())))}
+        with self.lock:
+            for key in keys:
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram(self.size)
+                histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage, **labels):
+        start = timer()
+        try:
+            yield
+        finally:
+            self.observe(stage, timer() - start, **labels)
+
+    def count(self, event, camera="", n=1):
+        with self.lock:
+            self.counters[(event, camera)] += n
+
+    def register(self, name, stats, **labels):
+        """Export the numbers stats() returns as gauges named aicam_<name>_<key>"""
+        with self.lock:
+            self.collectors[(name, tuple(sorted(labels.items())))] = stats
+
+    def summary(self):
+        """Quantiles in ms and counts per stage over all cameras, and event totals"""
+        stages = {}
+        with self.lock:
+            for (stage, labels), histogram in self.histograms.items():
+                if labels:
+                    continue
+                quantiles = histogram.quantiles()
+                stages[stage] = {
+                    "p50": round(quantiles[0.5] * 1000, 1),
+                    "p95": round(quantiles[0.95] * 1000, 1),
+                    "p99": round(quantiles[0.99] * 1000, 1),
+                    "count": histogram.count,
+                }
+            events = collections.Counter()
+            for (event, _), n in self.counters.items():
+                events[event] += n
+        return {"stages": stages, "events": {e: events[e] for e in EVENTS}}
+
+    def render(self):
+        """The Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            # the unlabelled histogram only for stages recorded without labels,
+            # it would count the labelled ones twice
+            labelled = {stage for stage, labels in self.histograms if labels}
+            histograms = sorted(
+                (key, h.quantiles(), h.count, h.sum)
+                for key, h in self.histograms.items()
+                if key[1] or key[0] not in labelled
+            )
+            counters = sorted(self.counters.items())
+            collectors = sorted(self.collectors.items())
+        name = PREFIX + "_stage_seconds"
+        lines.append("# TYPE {} summary".format(name))
+        for (stage, labels), quantiles, count, total in histograms:
+            labels = (("stage", stage),) + labels
+            for q, value in sorted(quantiles.items()):
+                lines.append(
+                    "{}{} {}".format(
+                        name, format_labels(labels + (("quantile", q),)), value
+                    )
+                )
+            lines.append("{}_sum{} {}".format(name, format_labels(labels), total))
+            lines.append("{}_count{} {}".format(name, format_labels(labels), count))
+        name = PREFIX + "_events_total"
+        lines.append("# TYPE {} counter".format(name))
+        for (event, camera), n in counters:
+            labels = (("event", event),) + ((("camera", camera),) if camera else ())
+            lines.append("{}{} {}".format(name, format_labels(labels), n))
+        seen = set()
+        for (collector, labels), stats in collectors:
+            try:
+                values = list(
+                    gauges(PREFIX + "_" + sanitize(collector), stats(), labels)
+                )
+            except Exception:
+                logger.exception("Failed to collect %s", collector)
+                continue
+            for gauge, gauge_labels, value in values:
+                if gauge not in seen:
+                    seen.add(gauge)
+                    lines.append("# TYPE {} gauge".format(gauge))
+                lines.append(
+                    "{}{} {}".format(gauge, format_labels(gauge_labels), value)
+                )
+        return "\n".join(lines) + "\n"
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """Serve metrics on http://host:port/metrics from a background thread"""
+
+    def __init__(self, metrics, port, host=""):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.server = _Server((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="metrics", daemon=True
+        )
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+# the metrics the pipeline reports to
+_metrics = Metrics()
+
+
+def get():
+    return _metrics
+
+
+def set_metrics(metrics):
+    """Report to metrics from now on, e.g. a fresh Metrics for each load test run"""
+    global _metrics
+    _metrics = metrics
+
+
+def observe(stage, seconds, **labels):
+    _metrics.observe(stage, seconds, **labels)
+
+
+def time(stage, **labels):
+    """Context manager observing how long its block took"""
+    return _metrics.time(stage, **labels)
+
+
+def count(event, camera="", n=1):
+    _metrics.count(event, camera, n)
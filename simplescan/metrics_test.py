@@ -0,0 +1,95 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+from metrics import Histogram, Metrics, MetricsServer
+
+
+def test_histogram_quantiles():
+    h = Histogram(size=100)
+    for i in range(1, 201):
+        h.observe(i / 1000)
+    # only the last 100 samples are kept for quantiles
+    quantiles = h.quantiles()
+    assert quantiles[0.5] == pytest.approx(0.151)
+    assert quantiles[0.95] == pytest.approx(0.196)
+    assert quantiles[0.99] == pytest.approx(0.2)
+    assert h.count == 200
+    assert h.sum == pytest.approx(20.1)
+
+
+def test_summary_over_all_cameras():
+    m = Metrics()
+    for i in range(10):
+        m.observe("inference", 0.01, camera="deck", model="color")
+        m.observe("inference", 0.03, camera="yard", model="grey")
+    with m.time("tracking", camera="deck"):
+        pass
+    m.count("dup", "deck")
+    m.count("dup", "yard", 2)
+    summary = m.summary()
+    assert summary["stages"]["inference"]["count"] == 20
+    assert summary["stages"]["inference"]["p50"] == 30.0
+    assert summary["stages"]["inference"]["p95"] == 30.0
+    assert summary["stages"]["tracking"]["count"] == 1
+    assert summary["events"]["dup"] == 3
+    assert summary["events"]["dropped"] == 0
+
+
+def test_render():
+    m = Metrics()
+    m.observe("decode", 0.002, camera='front "entry"')
+    m.observe("cycle", 0.5)
+    m.count("still", "deck")
+    m.register(
+        "ha_services",
+        lambda: {
+            "pending": 1,
+            "services": {"light.turn_on": {"calls": 3, "latency_ms": 12.5}},
+        },
+    )
+    m.register("grey", lambda: {"grey": True, "checks": 4}, camera="deck")
+    text = m.render()
+    assert (
+        'aicam_stage_seconds{stage="decode",camera="front \\"entry\\"",quantile="0.95"} 0.002'
+        in text
+    )
+    assert (
+        'aicam_stage_seconds_count{stage="decode",camera="front \\"entry\\""} 1' in text
+    )
+    # the histogram over all cameras is only published on MQTT
+    assert 'aicam_stage_seconds_count{stage="decode"}' not in text
+    # unless nothing is labelled
+    assert 'aicam_stage_seconds_count{stage="cycle"} 1' in text
+    assert 'aicam_events_total{event="still",camera="deck"} 1' in text
+    assert "aicam_ha_services_pending 1" in text
+    assert 'aicam_ha_services_services_calls{name="light.turn_on"} 3' in text
+    assert 'aicam_grey_grey{camera="deck"} 1' in text
+    assert text.count("# TYPE aicam_ha_services_pending gauge") == 1
+
+
+def test_render_survives_failing_collector():
+    m = Metrics()
+
+    def broken():
+        raise RuntimeError("gone")
+
+    m.register("broken", broken)
+    m.register("ok", lambda: {"value": 2})
+    assert "aicam_ok_value 2" in m.render()
+
+
+def test_metrics_server():
+    m = Metrics()
+    m.observe("capture", 0.1, camera="deck")
+    server = MetricsServer(m, 0, "127.0.0.1")
+    try:
+        url = "http://127.0.0.1:{}/".format(server.port)
+        with urllib.request.urlopen(url + "metrics", timeout=5) as r:
+            assert r.headers["Content-Type"].startswith("text/plain")
+            assert 'stage="capture"' in r.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + "other", timeout=5)
+    finally:
+        server.close()
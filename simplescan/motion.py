@@ -0,0 +1,83 @@
+"""Skip inference on frames where nothing moved."""
+
+import time
+from timeit import default_timer as timer
+
+import cv2
+
+
+class MotionGate(object):
+    """Compare frames to a running average background of small greyscale thumbnails.
+
+    The share of thumbnail pixels differing from the background by more than
+    pixel_threshold is the changed area. A frame goes to inference when it is
+    at least threshold, or when no frame has for recheck seconds, so the
+    models still see a static scene now and then.
+    """
+
+    def __init__(
+        self, threshold=0.002, recheck=120.0, width=160, alpha=0.05, pixel_threshold=25
+    ):
+        self.threshold = threshold
+        self.recheck = recheck
+        self.width = width
+        self.alpha = alpha
+        self.pixel_threshold = pixel_threshold
+        self.background = None
+        self.last_run = None
+        self.changed = 0.0
+        self.frames = 0
+        self.skipped = 0
+        self.total_time = 0.0
+
+    def thumbnail(self, image):
+        height, width = image.shape[:2]
+        size = (self.width, max(height * self.width // width, 1))
+        if width > self.width * 4:
+            # area averaging a full frame is slow, so pick pixels down to 4x first
+            image = cv2.resize(
+                image,
+                (self.width * 4, size[1] * 4),
+                interpolation=cv2.INTER_NEAREST,
+            )
+        small = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        if len(small.shape) == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0)
+
+    def changed_area(self, small):
+        """Share of pixels which differ from the background, then update it"""
+        if self.background is None or self.background.shape != small.shape:
+            self.background = small.astype("float32")
+            return 1.0
+        diff = cv2.absdiff(small, cv2.convertScaleAbs(self.background))
+        _, mask = cv2.threshold(diff, self.pixel_threshold, 255, cv2.THRESH_BINARY)
+        cv2.accumulateWeighted(small, self.background, self.alpha)
+        return cv2.countNonZero(mask) / mask.size
+
+    def update(self, image, now=None):
+        """Whether the frame should be run through the models"""
+        if now is None:
+            now = time.monotonic()
+        start = timer()
+        self.changed = self.changed_area(self.thumbnail(image))
+        self.total_time += timer() - start
+        self.frames += 1
+        if (
+            self.changed >= self.threshold
+            or self.last_run is None
+            or now - self.last_run >= self.recheck
+        ):
+            self.last_run = now
+            return True
+        self.skipped += 1
+        return False
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "skipped": self.skipped,
+            "skip_ratio": round(self.skipped / max(self.frames, 1), 3),
+            "changed": round(self.changed, 4),
+            "mean_ms": round(self.total_time * 1000 / max(self.frames, 1), 3),
+        }
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+import configparser
+
+import cv2
+import numpy as np
+
+from camera import Camera
+from fakes import FakeMqttClient
+from motion import MotionGate
+
+
+def scene(box=None):
+    image = np.full((720, 1280, 3), 90, np.uint8)
+    image[400:, :] = 40
+    if box is not None:
+        x, y = box
+        image[y : y + 120, x : x + 80] = (30, 160, 220)
+    return image
+
+
+def test_still_frames_skipped():
+    gate = MotionGate(threshold=0.002, recheck=60)
+    assert gate.update(scene(), now=0)
+    for t in range(1, 10):
+        assert not gate.update(scene(), now=t)
+    stats = gate.stats()
+    assert stats["skipped"] == 9
+    assert stats["skip_ratio"] == 0.9
+
+
+def test_motion_runs_inference():
+    gate = MotionGate(threshold=0.002, recheck=60)
+    gate.update(scene(), now=0)
+    assert not gate.update(scene(), now=1)
+    assert gate.update(scene(box=(600, 300)), now=2)
+    assert gate.update(scene(box=(700, 300)), now=3)
+    assert gate.changed > 0.002
+
+
+def test_noise_below_threshold():
+    gate = MotionGate(threshold=0.002, recheck=60)
+    rng = np.random.RandomState(0)
+    gate.update(scene(), now=0)
+    for t in range(1, 5):
+        noisy = scene().astype(np.int16) + rng.randint(-8, 9, (720, 1280, 3))
+        assert not gate.update(noisy.clip(0, 255).astype(np.uint8), now=t)
+
+
+def test_recheck_interval():
+    gate = MotionGate(threshold=0.002, recheck=60)
+    gate.update(scene(), now=0)
+    assert not gate.update(scene(), now=59)
+    assert gate.update(scene(), now=60)
+    assert not gate.update(scene(), now=61)
+
+
+def test_background_adapts():
+    # a parked car becomes part of the background
+    gate = MotionGate(threshold=0.002, recheck=1000, alpha=0.2)
+    gate.update(scene(), now=0)
+    runs = [gate.update(scene(box=(600, 300)), now=t) for t in range(1, 40)]
+    assert runs[0]
+    assert not runs[-1]
+
+
+def test_grey_frames():
+    gate = MotionGate()
+    grey = scene()[:, :, 0]
+    assert gate.update(grey, now=0)
+    assert not gate.update(grey.copy(), now=1)
+
+
+def test_still_frames_clear_failures():
+    config = configparser.ConfigParser()
+    config["cam"] = {"name": "deck", "uri": "http://deck", "motion_threshold": "0.002"}
+    cam = Camera(config["cam"], {}, FakeMqttClient())
+    ok, data = cv2.imencode(".jpg", scene())
+    cam.process_snapshot(data.tobytes())
+    cam.capture_failed(OSError("timed out"))
+    assert cam.fails == 1
+    # same scene, newly encoded so it isn't a duplicate
+    ok, data = cv2.imencode(".jpg", scene(), [cv2.IMWRITE_JPEG_QUALITY, 90])
+    cam.process_snapshot(data.tobytes())
+    assert cam.error == "still"
+    assert cam.fails == 0
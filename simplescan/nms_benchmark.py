@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of YOLOv4 postprocessing against the per-class implementation.
+
+Usage: python nms_benchmark.py [--candidates 22743] [--classes 80] [--objects 30]
+"""
+
+import argparse
+from timeit import default_timer as timer
+
+import numpy as np
+
+from object_detection_v4 import YoloV4ObjectDetection, nms_cpu
+
+
+def legacy_post_processing(num_classes, conf_thresh, nms_thresh, output):
+    """The original per-class Python loop, kept as a reference"""
+    box_array = output[0][:, :, 0]
+    confs = output[1]
+    max_conf = np.max(confs, axis=2)
+    max_id = np.argmax(confs, axis=2)
+
+    bboxes_batch = []
+    for i in range(box_array.shape[0]):
+        argwhere = max_conf[i] > conf_thresh
+        l_box_array = box_array[i, argwhere, :]
+        l_max_conf = max_conf[i, argwhere]
+        l_max_id = max_id[i, argwhere]
+
+        bboxes = []
+        # nms for each class
+        for j in range(num_classes):
+            cls_argwhere = l_max_id == j
+            ll_box_array = l_box_array[cls_argwhere, :]
+            ll_max_conf = l_max_conf[cls_argwhere]
+            ll_max_id = l_max_id[cls_argwhere]
+
+            keep = nms_cpu(ll_box_array, ll_max_conf, nms_thresh)
+
+            if keep.size > 0:
+                ll_box_array = ll_box_array[keep, :]
+                ll_max_conf = ll_max_conf[keep]
+                ll_max_id = ll_max_id[keep]
+
+                for k in range(ll_box_array.shape[0]):
+                    bboxes.append(
+                        [
+                            ll_box_array[k, 0],
+                            ll_box_array[k, 1],
+                            ll_box_array[k, 2],
+                            ll_box_array[k, 3],
+                            ll_max_conf[k],
+                            ll_max_conf[k],
+                            ll_max_id[k],
+                        ]
+                    )
+        bboxes_batch.append(bboxes)
+    return bboxes_batch
+
+
+def legacy_postprocess(labels, output):
+    selected_boxes = legacy_post_processing(len(labels), 0.4, 0.6, output)[0]
+    return [
+        {
+            "probability": round(float(selected_boxes[i][4]), 8),
+            "tagId": int(selected_boxes[i][6]),
+            "tagName": labels[selected_boxes[i][6]],
+            "boundingBox": {
+                "left": round(float(selected_boxes[i][0]), 8),
+                "top": round(float(selected_boxes[i][1]), 8),
+                "width": round(
+                    float(selected_boxes[i][2]) - float(selected_boxes[i][0]), 8
+                ),
+                "height": round(
+                    float(selected_boxes[i][3]) - float(selected_boxes[i][1]), 8
+                ),
+            },
+        }
+        for i in range(len(selected_boxes))
+    ]
+
+
+def random_outputs(candidates, num_classes, objects=30, seed=0):
+    """Random YOLOv4 shaped outputs.
+
+    Most candidates are background below the confidence threshold, the rest
+    are clusters of overlapping boxes around a few objects, as for a real frame.
+    """
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(0.1, 0.9, size=(candidates, 2))
+    sizes = rng.uniform(0.02, 0.2, size=(candidates, 2))
+    confs = rng.uniform(0, 0.3, size=(candidates, num_classes))
+    per_object = 10
+    hits = rng.choice(candidates, size=objects * per_object, replace=False)
+    for k in range(objects):
+        rows = hits[k * per_object : (k + 1) * per_object]
+        centers[rows] = rng.uniform(0.1, 0.9, size=2) + rng.normal(
+            scale=0.005, size=(per_object, 2)
+        )
+        sizes[rows] = rng.uniform(0.05, 0.2, size=2)
+        confs[rows, rng.randint(num_classes)] = rng.uniform(0.4, 1.0, size=per_object)
+    boxes = np.concatenate([centers - sizes / 2, centers + sizes / 2], axis=1)
+    return [
+        boxes.astype(np.float32).reshape(1, -1, 1, 4),
+        confs.astype(np.float32).reshape(1, -1, num_classes),
+    ]
+
+
+class _Detector(YoloV4ObjectDetection):
+    """Postprocessing only, without a session"""
+
+    def __init__(self, labels):
+        self.labels = labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    # 22743 candidate boxes for a 608x608 YOLOv4 input
+    parser.add_argument("--candidates", type=int, default=22743)
+    parser.add_argument("--classes", type=int, default=80)
+    parser.add_argument("--objects", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    labels = ["class{}".format(i) for i in range(args.classes)]
+    output = random_outputs(args.candidates, args.classes, args.objects)
+    detector = _Detector(labels)
+    assert [p.to_dict() for p in detector.postprocess(output)] == legacy_postprocess(
+        labels, output
+    )
+
+    for name, fn in [
+        ("legacy", lambda: legacy_postprocess(labels, output)),
+        ("vectorized", lambda: detector.postprocess(output)),
+    ]:
+        fn()
+        start = timer()
+        for _ in range(args.repeat):
+            detections = fn()
+        elapsed = (timer() - start) / args.repeat
+        print(
+            "{:>10}: {:8.3f}ms per frame, {} detections".format(
+                name, elapsed * 1000, len(detections)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
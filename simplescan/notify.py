@@ -1,66 +1,74 @@
-import json
+import concurrent.futures
 import logging
 import os
 import uuid
 from datetime import date, datetime
-from io import BytesIO
 from pprint import pformat
 
-import cv2
-import requests
-from PIL import Image
-
+import artifacts
 import codeproject
+import pushover
+from plates import PlateFile
+from pushover import PUSHOVER_URL
 
 logger = logging.getLogger(__name__)
 
-license_plates = {}
-# Maps variant strings (exact + edits1) of known plates to their original plate key.
-# At query time, checking edits1(query) against this dict covers edit distance <= 2.
-_plate_variants = {}
-
-
-def _edits1(word):
-    "All edits that are one edit away from `word`."
-    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
-    splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
-    deletes = [L + R[1:] for L, R in splits if R]
-    replaces = [L + c + R[1:] for L, R in splits if R for c in letters]
-    inserts = [L + c + R for L, R in splits for c in letters]
-    return set(deletes + replaces + inserts)
+# known plates, reloaded when license-plates.json changes
+_plate_file = None
 
 
-def _load_license_plates():
-    global license_plates, _plate_variants
-    if not license_plates:
-        try:
-            with open("license-plates.json") as f:
-                license_plates = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-            logger.warning(f"Could not load license-plates.json: {e}")
-            license_plates = {}
-        # Pre-expand known plates so detection-time lookup is O(edits1) not O(edits2)
-        for plate_key in license_plates:
-            _plate_variants[plate_key] = plate_key
-            for variant in _edits1(plate_key):
-                _plate_variants.setdefault(variant, plate_key)
-    return license_plates
-
+def _load_license_plates(max_distance=2):
+    global _plate_file
+    if _plate_file is None or _plate_file.index.max_distance != max_distance:
+        _plate_file = PlateFile("license-plates.json", max_distance)
+    return _plate_file.load()
 
-def _match_plate(plate):
-    """Find the best matching known plate within edit distance 2.
 
-    Checks: exact match, then edits1(query) against pre-computed edits1(known).
-    edits1(query) ∩ edits1(known) covers all pairs within edit distance 2.
-    """
-    # Distance 0 or 1: query itself may be in the pre-expanded variants
-    if plate in _plate_variants:
-        return _plate_variants[plate]
-    # Distance 1-2: check edits1(query) against pre-expanded variants
-    for variant in _edits1(plate):
-        if variant in _plate_variants:
-            return _plate_variants[variant]
-    return None
+def _announce_plates(enrichments, cam, ha, notify_vehicle, max_distance=2):
+    """Announce the known vehicles among the plates ALPR read, returning message lines"""
+    message = ""
+    vehicle_message = ""
+    if enrichments["count"] == 0:
+        # Don't announce if ALPR can't find a vehicle
+        notify_vehicle = False
+    known = _load_license_plates(max_distance)
+    house_cleaner_found = False
+    for plate in enrichments["plates"]:
+        match = known.match(plate)
+        if match:
+            r = match[2]
+            if len(vehicle_message) > 0:
+                vehicle_message += " and "
+            if "owner" in r:
+                vehicle_message += r["owner"] + "'s "
+                if r["owner"].lower() == "house cleaner":
+                    house_cleaner_found = True
+            if "color" in r:
+                vehicle_message += r["color"] + " "
+            if "make" in r:
+                vehicle_message += r["make"] + " "
+                if "model" in r:
+                    vehicle_message += r["model"]
+            else:
+                vehicle_message += "vehicle"
+            if r.get("announce", True) is False:
+                logging.info(
+                    "Ignoring {}'s vehicle with plate {}".format(r["owner"], plate)
+                )
+                vehicle_message = None
+        if vehicle_message is not None:
+            if vehicle_message == "":
+                vehicle_message = "Vehicle"
+            if notify_vehicle:
+                if cam.name == "shed":
+                    ha.echo_speaks(f"{vehicle_message} in front of garage")
+                else:
+                    ha.echo_speaks(f"{vehicle_message} in driveway")
+            # don't announce plate
+            message += "\n" + vehicle_message + " " + plate
+    if house_cleaner_found:
+        ha.house_cleaners_arrived()
+    return message
 
 
 def notify(cam, message, image, predictions, config, ha, model_name="color", original_image=None):
@@ -74,37 +82,37 @@ def notify(cam, message, image, predictions, config, ha, model_name="color", ori
     priority = None
     has_dog = False
     vehicles = list(
-        filter(lambda p: p["tagName"] == "vehicle" and "ignore" not in p, predictions)
+        filter(lambda p: p.tagName == "vehicle" and p.ignore is None, predictions)
     )
     has_vehicles = len(vehicles) > 0
     has_visible_vehicles = len(
         list(
             filter(
-                lambda p: p["tagName"] == "vehicle"
-                and "ignore" not in p
-                and "departed" not in p
-                and p["age"] < 3,  # Run ALPR on first 3 frames to catch plates that become visible
+                lambda p: p.tagName == "vehicle"
+                and p.ignore is None
+                and p.departed is None
+                and p.age < 3,  # Run ALPR on first 3 frames to catch plates that become visible
                 predictions,
             )
         )
     )
     people = list(
         filter(
-            lambda p: p["tagName"] == "person" and "ignore" not in p,
+            lambda p: p.tagName == "person" and p.ignore is None,
             predictions,
         )
     )
     has_person = len(people) > 0
-    has_dog = len(list(filter(lambda p: p["tagName"] == "dog", predictions))) > 0
+    has_dog = len(list(filter(lambda p: p.tagName == "dog", predictions))) > 0
     has_person_road = (
-        len(list(filter(lambda p: p["tagName"] == "person_road", predictions))) > 0
+        len(list(filter(lambda p: p.tagName == "person_road", predictions))) > 0
     )
     has_dog_road = (
-        len(list(filter(lambda p: p["tagName"] == "dog_road", predictions))) > 0
+        len(list(filter(lambda p: p.tagName == "dog_road", predictions))) > 0
     )
     dog_inside = ha.is_dog_inside() if (has_dog or has_dog_road) else False
     packages = list(
-        filter(lambda p: p["tagName"] == "package" and "departed" not in p, predictions)
+        filter(lambda p: p.tagName == "package" and p.departed is None, predictions)
     )
     has_package = len(packages) > 0
     if has_vehicles and cam.name != "mailbox":
@@ -137,11 +145,11 @@ def notify(cam, message, image, predictions, config, ha, model_name="color", ori
     #    # If person detection is off, override night or away mode
     #    mode = "home"
     sound = "pushover"
-    for p in list(filter(lambda p: "ignore" in p or "iou" in p, predictions)):
-        p["priority"] = -4
-    for p in list(filter(lambda p: "priority" not in p, predictions)):
-        tagName = p["tagName"]
-        probability = p["probability"]
+    for p in list(filter(lambda p: p.ignore is not None or p.iou is not None, predictions)):
+        p.priority = -4
+    for p in list(filter(lambda p: p.priority is None, predictions)):
+        tagName = p.tagName
+        probability = p.probability
         i_type = None
         if tagName == "person_road":
             if mode == "night" and ha.is_time_after_midnight_and_before_six():
@@ -180,10 +188,10 @@ def notify(cam, message, image, predictions, config, ha, model_name="color", ori
             i = -4
             i_type = "vehicle detection off"
         elif tagName in mode_priorities:
-            i = mode_priorities.getint(p["tagName"])
+            i = mode_priorities.getint(p.tagName)
             i_type = mode_key
         elif tagName in priorities:
-            i = priorities.getint(p["tagName"])
+            i = priorities.getint(p.tagName)
             i_type = "class {}".format(tagName)
         else:
             i_type = "default"
@@ -191,7 +199,7 @@ def notify(cam, message, image, predictions, config, ha, model_name="color", ori
         if cam.name == "peach tree" and mode == "night" and i < 1:
             i = 1
             i_type = "fruit robber"
-        if "departed" in p:
+        if p.departed is not None:
             sound = config["sounds"]["departed"]
         elif tagName in config["sounds"]:
             sound = config["sounds"][tagName]
@@ -200,7 +208,7 @@ def notify(cam, message, image, predictions, config, ha, model_name="color", ori
         #    i_type = "maybe dog rule"
         if (
             tagName == "dog"
-            and (p["camName"] == "garage")
+            and (p.camName == "garage")
             and probability > 0.9
             and not has_person
             and dog_inside
@@ -210,12 +218,12 @@ def notify(cam, message, image, predictions, config, ha, model_name="color", ori
         # elif tagName == "dog" and p["camName"] == "deck" and i > -3:
         #    i = -3
         #    i_type = f"{tagName} on {p['camName']}"
-        if tagName in ["fox", "coyote"] and p["camName"] == "deck" and i < 1:
+        if tagName in ["fox", "coyote"] and p.camName == "deck" and i < 1:
             i = 1
-            i_type = f"{tagName} on {p['camName']}"
+            i_type = f"{tagName} on {p.camName}"
         if i is not None:
-            p["priority"] = i
-            p["priority_type"] = i_type
+            p.priority = i
+            p.priority_type = i_type
             if priority is None:
                 priority = i
             else:
@@ -225,8 +233,8 @@ def notify(cam, message, image, predictions, config, ha, model_name="color", ori
         priority = 1
     if priority is None:
         for p in predictions:
-            if "priority" in p:
-                priority = p["priority"]
+            if p.priority is not None:
+                priority = p.priority
                 logging.info(f"Using prior priority={priority}")
     if priority is None:
         priority = 0
@@ -238,18 +246,18 @@ def notify(cam, message, image, predictions, config, ha, model_name="color", ori
 
     # crop to area of interest
     width, height = image.size
-    left = min(p["boundingBox"]["left"] - 0.05 for p in predictions) * width
+    left = min(p.boundingBox["left"] - 0.05 for p in predictions) * width
     right = (
         max(
-            p["boundingBox"]["left"] + p["boundingBox"]["width"] + 0.05
+            p.boundingBox["left"] + p.boundingBox["width"] + 0.05
             for p in predictions
         )
         * width
     )
-    top = min(p["boundingBox"]["top"] - 0.05 for p in predictions) * height
+    top = min(p.boundingBox["top"] - 0.05 for p in predictions) * height
     bottom = (
         max(
-            p["boundingBox"]["top"] + p["boundingBox"]["height"] + 0.05
+            p.boundingBox["top"] + p.boundingBox["height"] + 0.05
             for p in predictions
         )
         * height
@@ -271,27 +279,31 @@ def notify(cam, message, image, predictions, config, ha, model_name="color", ori
     # logging.info("Cropping to %d,%d,%d,%d" % crop_rectangle)
     cropped_image = image.crop(crop_rectangle)
 
+    # encoded once for the static images and the notification
+    cropped_jpeg = artifacts.encode(cropped_image)
     static_dir = os.path.join(config["detector"]["save-path"], "static")
     for p in predictions:
-        cropped_image.save(os.path.join(static_dir, f"{p['tagName']}.jpg"))
+        artifacts.save(
+            os.path.join(static_dir, f"{p.tagName}.jpg"), cropped_jpeg, camera=cam.name
+        )
 
     # Run ALPR for vehicles regardless of notification priority
     if has_visible_vehicles and len(vehicles) > 0:
         logging.info(pformat(vehicles))
-        left = max(0, min(p["boundingBox"]["left"] - 0.05 for p in vehicles) * width)
+        left = max(0, min(p.boundingBox["left"] - 0.05 for p in vehicles) * width)
         right = min(
             width,
             max(
-                p["boundingBox"]["left"] + p["boundingBox"]["width"] + 0.05
+                p.boundingBox["left"] + p.boundingBox["width"] + 0.05
                 for p in vehicles
             )
             * width,
         )
-        top = max(0, min(p["boundingBox"]["top"] - 0.05 for p in vehicles) * height)
+        top = max(0, min(p.boundingBox["top"] - 0.05 for p in vehicles) * height)
         bottom = min(
             height,
             max(
-                p["boundingBox"]["top"] + p["boundingBox"]["height"] + 0.05
+                p.boundingBox["top"] + p.boundingBox["height"] + 0.05
                 for p in vehicles
             )
             * height,
@@ -305,69 +317,65 @@ def notify(cam, message, image, predictions, config, ha, model_name="color", ori
             save_dir,
             datetime.now().strftime("%H%M%S")
             + "-"
-            + vehicles[0]["camName"].replace(" ", "_")
+            + vehicles[0].camName.replace(" ", "_")
             + "-"
             + "codeproject.jpg",
         )
-        vehicle_image.save(save_vehicle)
-        vehicle_bytes = BytesIO()
-        vehicle_image.save(vehicle_bytes, "jpeg")
-        vehicle_bytes.seek(0)
+        vehicle_jpeg = artifacts.encode(vehicle_image)
+        artifacts.save(save_vehicle, vehicle_jpeg, camera=cam.name)
+        save_json = os.path.join(
+            save_dir,
+            datetime.now().strftime("%H%M%S")
+            + "-"
+            + vehicles[0].camName.replace(" ", "_")
+            + "-"
+            + "codeproject.txt",
+        )
+        codeproject_config = config["codeproject"] if "codeproject" in config else {}
+        # the vehicles' tracks, so a parked car is only looked up once
+        key = frozenset((p.camName, p.start_time) for p in vehicles)
+        wait = float(codeproject_config.get("wait", 2))
+        max_distance = int(codeproject_config.get("max-distance", 2))
         try:
-            save_json = os.path.join(
-                save_dir,
-                datetime.now().strftime("%H%M%S")
-                + "-"
-                + vehicles[0]["camName"].replace(" ", "_")
-                + "-"
-                + "codeproject.txt",
+            plates = codeproject.read(
+                key,
+                vehicle_jpeg,
+                save_json,
+                url=codeproject_config.get("url"),
+                camera=cam.name,
             )
-            codeproject_url = config["codeproject"]["url"] if "codeproject" in config else None
-            enrichments = codeproject.enrich(vehicle_bytes.read(), save_json, url=codeproject_url)
-            vehicle_message = ""
-            if enrichments["count"] == 0:
-                # Don't announce if ALPR can't find a vehicle
-                notify_vehicle = False
-            plates_db = _load_license_plates()
-            house_cleaner_found = False
-            for plate in enrichments["plates"]:
-                matched_key = _match_plate(plate) or _match_plate(plate.replace(" ", ""))
-                if matched_key:
-                    r = plates_db[matched_key]
-                    if len(vehicle_message) > 0:
-                        vehicle_message += " and "
-                    if "owner" in r:
-                        vehicle_message += r["owner"] + "'s "
-                        if r["owner"].lower() == "house cleaner":
-                            house_cleaner_found = True
-                    if "color" in r:
-                        vehicle_message += r["color"] + " "
-                    if "make" in r:
-                        vehicle_message += r["make"] + " "
-                        if "model" in r:
-                            vehicle_message += r["model"]
-                    else:
-                        vehicle_message += "vehicle"
-                    if r.get("announce", True) is False:
-                        logging.info(
-                            "Ignoring {}'s vehicle with plate {}".format(
-                                r["owner"], plate
-                            )
+            if plates is None:
+                logging.warning("Skipping ALPR, too many lookups waiting")
+            else:
+                message += _announce_plates(
+                    plates.result(wait), cam, ha, notify_vehicle, max_distance
+                )
+        except concurrent.futures.TimeoutError:
+
+            def announce_late(future):
+                try:
+                    late = _announce_plates(
+                        future.result(), cam, ha, notify_vehicle, max_distance
+                    )
+                    logging.info("ALPR done:%s", late)
+                    # the notification went without the plates, follow up quietly
+                    if late and "pushover" in config and ha.vacation_mode() is False:
+                        pushover.send(
+                            config["pushover"].get("url", PUSHOVER_URL),
+                            {
+                                "token": config["pushover"]["token"],
+                                "user": config["pushover"]["user"],
+                                "message": cam.name + late,
+                                "priority": -1,
+                            },
+                            camera=cam.name,
                         )
-                        vehicle_message = None
-                if vehicle_message is not None:
-                    if vehicle_message == "":
-                        vehicle_message = "Vehicle"
-                    if notify_vehicle:
-                        if cam.name == "shed":
-                            ha.echo_speaks(f"{vehicle_message} in front of garage")
-                        else:
-                            ha.echo_speaks(f"{vehicle_message} in driveway")
-                    # don't announce plate
-                    message += "\n" + vehicle_message + " " + plate
-            if house_cleaner_found:
-                ha.house_cleaners_arrived()
+                except Exception:
+                    logging.exception("Failed to enrich via codeproject")
 
+            # the lookup may be shared with other notifications, announce it once
+            if codeproject.when_late(key, plates, announce_late):
+                logging.info("ALPR took over %ss, announcing when it's done", wait)
         except Exception:
             logging.exception("Failed to enrich via codeproject")
 
@@ -402,9 +410,6 @@ def notify(cam, message, image, predictions, config, ha, model_name="color", ori
 
     if priority >= -3 and ha.vacation_mode() is False:
         # prepare post
-        output_bytes = BytesIO()
-        cropped_image.save(output_bytes, "jpeg")
-        output_bytes.seek(0)
         # send as -2 to generate no notification/alert, -1 to always send as a quiet notification, 1 to display as high-priority and bypass the user's quiet hours, or 2 to also require confirmation from the user
         pushover_data = {
             "token": config["pushover"]["token"],
@@ -421,11 +426,13 @@ def notify(cam, message, image, predictions, config, ha, model_name="color", ori
                 review_id = uuid.uuid4().hex[:8]
                 review_file = "%s.jpg" % review_id
                 review_image = original_image if original_image is not None else image
-                if not isinstance(review_image, Image.Image):
-                    review_image = Image.fromarray(cv2.cvtColor(review_image, cv2.COLOR_BGR2RGB))
-                review_image.save(os.path.join(review_dir, review_file))
+                artifacts.save(
+                    os.path.join(review_dir, review_file),
+                    review_image,
+                    camera=cam.name,
+                )
                 webhook_url = config["roboflow"]["webhook-url"]
-                detection_tags = set(p["tagName"] for p in predictions if "ignore" not in p)
+                detection_tags = set(p.tagName for p in predictions if p.ignore is None)
                 pushover_data["url"] = "%s?file=%s&model=%s&cam=%s&tags=%s" % (
                     webhook_url, review_file, model_name,
                     cam.name.replace(" ", "_"),
@@ -434,16 +441,12 @@ def notify(cam, message, image, predictions, config, ha, model_name="color", ori
                 pushover_data["url_title"] = "Flag for Review"
             except Exception:
                 logger.exception("Failed to save review image")
-        try:
-            r = requests.post(
-                "https://api.pushover.net/1/messages.json",
-                data=pushover_data,
-                files={"attachment": ("image.jpg", output_bytes, "image/jpeg")},
-            )
-            if r.status_code != 200:
-                logging.warning(pformat(r))
-                logging.warning(pformat(r.headers))
-        except Exception:
-            logger.exception("Failed to call Pushover")
+        # queued, so frame processing doesn't wait on Pushover
+        pushover.send(
+            config["pushover"].get("url", PUSHOVER_URL),
+            pushover_data,
+            cropped_jpeg,
+            camera=cam.name,
+        )
 
     return priority
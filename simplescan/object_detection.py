@@ -7,6 +7,8 @@ import math
 
 import numpy as np
 
+from prediction import Prediction
+
 
 class ObjectDetection(object):
     """Class for Custom Vision's exported object detection model"""
@@ -191,16 +193,16 @@ class ObjectDetection(object):
         )
 
         return [
-            {
-                "probability": round(float(selected_probs[i]), 8),
-                "tagId": int(selected_classes[i]),
-                "tagName": self.labels[selected_classes[i]],
-                "boundingBox": {
+            Prediction(
+                round(float(selected_probs[i]), 8),
+                int(selected_classes[i]),
+                self.labels[selected_classes[i]],
+                {
                     "left": round(float(selected_boxes[i][0]), 8),
                     "top": round(float(selected_boxes[i][1]), 8),
                     "width": round(float(selected_boxes[i][2]), 8),
                     "height": round(float(selected_boxes[i][3]), 8),
                 },
-            }
+            )
             for i in range(len(selected_boxes))
         ]
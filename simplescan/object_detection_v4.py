@@ -0,0 +1,306 @@
+import logging
+
+import numpy as np
+from PIL import Image
+
+import metrics
+from object_detection import ObjectDetection
+from prediction import Prediction
+
+logger = logging.getLogger(__name__)
+
+# Compact per-image detections, converted to dicts only at the API boundary
+DETECTION_DTYPE = np.dtype(
+    [
+        ("x1", np.float32),
+        ("y1", np.float32),
+        ("x2", np.float32),
+        ("y2", np.float32),
+        ("score", np.float32),
+        ("class_id", np.int32),
+    ]
+)
+
+
+class YoloV4ObjectDetection(ObjectDetection):
+    """YOLOv4 pre- and postprocessing on top of an InferenceSession"""
+
+    # label of the model's latencies in metrics, from its config section
+    name = "model"
+
+    def __init__(self, session, labels, prob_threshold=0.10):
+        super(YoloV4ObjectDetection, self).__init__(labels, prob_threshold)
+        self.session = session
+        _, self.channels, self.model_height, self.model_width = session.input_shape
+
+    @property
+    def max_batch_size(self):
+        return self.session.max_batch_size
+
+    def predict_image(self, image):
+        return self.predict_images([image])[0]
+
+    def predict_images(self, images):
+        """Run a list of images through the model in as few batches as possible
+
+        Returns:
+            A list of predictions for each image.
+        """
+        results = []
+        for start in range(0, len(images), self.max_batch_size):
+            batch = images[start : start + self.max_batch_size]
+            with self.session.lock:
+                with metrics.time("preprocess", model=self.name):
+                    for i, image in enumerate(batch):
+                        self.preprocess(image, out=self.session.input_buffer[i])
+                with metrics.time("inference", model=self.name):
+                    prediction_outputs = self.predict(len(batch))
+                with metrics.time("postprocess", model=self.name):
+                    results += self.postprocess_batch(prediction_outputs)
+        return results
+
+    def preprocess(self, image, out=None):
+        """Convert an RGB or greyscale image to a normalized CHW float array.
+
+        Args:
+            image: PIL image or HxW(xC) uint8 array of the model size.
+            out: Optional (C, H, W) float32 array to write into, such as a
+                slot of the session input buffer.
+        """
+        if isinstance(image, Image.Image):
+            if image.size != (self.model_width, self.model_height):
+                logger.debug(
+                    "Resizing from {} to {}".format(
+                        image.size, (self.model_width, self.model_height)
+                    )
+                )
+                image = image.resize(
+                    (self.model_width, self.model_height), Image.BILINEAR
+                )
+        img_in = np.asarray(image)
+        if self.channels == 3:
+            # channels first
+            img_in = np.transpose(img_in, (2, 0, 1))
+        else:
+            # add channel dimension
+            img_in = np.expand_dims(img_in, axis=0)
+        assert (
+            self.channels,
+            self.model_height,
+            self.model_width,
+        ) == img_in.shape, "Image must be resized to model shape"
+        if out is None:
+            out = np.empty(img_in.shape, dtype=np.float32)
+        np.divide(img_in, 255.0, out=out, casting="unsafe")
+        return out
+
+    def predict(self, batch_size=1):
+        """Run the session on the images already in its input buffer"""
+        outputs = self.session.run(batch_size)
+        num_classes = len(self.labels)
+        return [
+            outputs[0].reshape(batch_size, -1, 1, 4),
+            outputs[1].reshape(batch_size, -1, num_classes),
+        ]
+
+    def postprocess(self, prediction_outputs):
+        """Extract bounding boxes from the model outputs of a single image.
+
+        Args:
+            prediction_outputs: Output from the object detection model. (H x W x C)
+        """
+        return self.postprocess_batch(prediction_outputs)[0]
+
+    def postprocess_batch(self, prediction_outputs):
+        """Extract bounding boxes for every image in a batch of model outputs"""
+        return [
+            self.to_predictions(selected_boxes)
+            for selected_boxes in self.post_processing(0.4, 0.6, prediction_outputs)
+        ]
+
+    def to_predictions(self, detections):
+        """Convert a DETECTION_DTYPE array to the Predictions used by the rules"""
+        x1 = detections["x1"].astype(np.float64)
+        y1 = detections["y1"].astype(np.float64)
+        return [
+            Prediction(
+                round(probability, 8),
+                tag_id,
+                self.labels[tag_id],
+                {
+                    "left": round(left, 8),
+                    "top": round(top, 8),
+                    "width": round(width, 8),
+                    "height": round(height, 8),
+                },
+            )
+            for probability, tag_id, left, top, width, height in zip(
+                detections["score"].astype(np.float64).tolist(),
+                detections["class_id"].tolist(),
+                x1.tolist(),
+                y1.tolist(),
+                (detections["x2"] - x1).tolist(),
+                (detections["y2"] - y1).tolist(),
+            )
+        ]
+
+    def post_processing(self, conf_thresh, nms_thresh, output):
+        """Threshold and class aware NMS over the raw model outputs.
+
+        Returns:
+            A DETECTION_DTYPE array per image, sorted by class and then by
+            descending score.
+        """
+        # [batch, num, 1, 4]
+        box_array = output[0]
+        # [batch, num, num_classes]
+        confs = output[1]
+
+        if type(box_array).__name__ != "ndarray":
+            box_array = box_array.cpu().detach().numpy()
+            confs = confs.cpu().detach().numpy()
+
+        assert len(self.labels) == confs.shape[2]
+
+        # [batch, num, 4]
+        box_array = box_array[:, :, 0]
+
+        detections_batch = []
+        for i in range(box_array.shape[0]):
+            # only look for the best class of candidates over the threshold
+            argwhere = np.flatnonzero((confs[i] > conf_thresh).any(axis=1))
+            boxes = box_array[i, argwhere, :]
+            l_confs = confs[i, argwhere]
+            class_ids = l_confs.argmax(axis=1)
+            scores = l_confs[np.arange(len(argwhere)), class_ids]
+
+            keep = batched_nms(boxes, scores, class_ids, nms_thresh)
+            keep = keep[np.lexsort((-scores[keep], class_ids[keep]))]
+
+            detections = np.empty(len(keep), dtype=DETECTION_DTYPE)
+            detections["x1"] = boxes[keep, 0]
+            detections["y1"] = boxes[keep, 1]
+            detections["x2"] = boxes[keep, 2]
+            detections["y2"] = boxes[keep, 3]
+            detections["score"] = scores[keep]
+            detections["class_id"] = class_ids[keep]
+            detections_batch.append(detections)
+
+        return detections_batch
+
+
+def batched_nms(boxes, confs, class_ids, nms_thresh=0.5, max_matrix=512):
+    """Greedy class aware NMS over all classes at once.
+
+    The IoU of every pair of boxes is computed in one go and masked so boxes
+    only suppress lower scoring boxes of the same class. The remaining loop
+    only does a boolean OR for each box that is kept. Above max_matrix boxes
+    the boxes are shifted by class id so they can never overlap and a single
+    nms_cpu pass is used instead, to bound memory.
+
+    Returns:
+        Indices of the boxes to keep, highest score first.
+    """
+    n = len(boxes)
+    if n == 0:
+        return np.empty(0, dtype=np.intp)
+    if n > max_matrix:
+        shifted = boxes.astype(np.float64)
+        offsets = class_ids * (shifted.max() - shifted.min() + 1)
+        return nms_cpu(shifted + offsets[:, np.newaxis], confs, nms_thresh)
+    order = confs.argsort()[::-1]
+    boxes = boxes[order]
+    class_ids = class_ids[order]
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+
+    w = np.maximum(
+        0.0, np.minimum(x2[:, None], x2[None, :]) - np.maximum(x1[:, None], x1[None, :])
+    )
+    h = np.maximum(
+        0.0, np.minimum(y2[:, None], y2[None, :]) - np.maximum(y1[:, None], y1[None, :])
+    )
+    inter = w * h
+    with np.errstate(divide="ignore", invalid="ignore"):
+        over = inter / (areas[:, None] + areas[None, :] - inter)
+    # same comparison as nms_cpu, so degenerate boxes behave the same
+    suppresses = ~(over <= nms_thresh) & (class_ids[:, None] == class_ids[None, :])
+    suppresses = np.triu(suppresses, 1)
+
+    suppressed = np.zeros(n, dtype=bool)
+    keep = []
+    for i in range(n):
+        if not suppressed[i]:
+            keep.append(i)
+            suppressed |= suppresses[i]
+    return order[keep]
+
+
+def nms_cpu(boxes, confs, nms_thresh=0.5, min_mode=False):
+    # logger.debug(boxes.shape)
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+
+    areas = (x2 - x1) * (y2 - y1)
+    order = confs.argsort()[::-1]
+
+    keep = []
+    while order.size > 0:
+        idx_self = order[0]
+        idx_other = order[1:]
+
+        keep.append(idx_self)
+
+        xx1 = np.maximum(x1[idx_self], x1[idx_other])
+        yy1 = np.maximum(y1[idx_self], y1[idx_other])
+        xx2 = np.minimum(x2[idx_self], x2[idx_other])
+        yy2 = np.minimum(y2[idx_self], y2[idx_other])
+
+        w = np.maximum(0.0, xx2 - xx1)
+        h = np.maximum(0.0, yy2 - yy1)
+        inter = w * h
+
+        if min_mode:
+            over = inter / np.minimum(areas[order[0]], areas[order[1:]])
+        else:
+            over = inter / (areas[order[0]] + areas[order[1:]] - inter)
+
+        inds = np.where(over <= nms_thresh)[0]
+        order = order[inds + 1]
+
+    return np.array(keep)
+
+
+def load_model(config, labels):
+    """Create a detector for a model config section.
+
+    The ``backend`` key selects ``tensorrt`` (default, Jetson) or
+    ``onnxruntime`` (CPU).
+    """
+    backend = config.get("backend", "tensorrt")
+    prob_threshold = float(config.get("prob_threshold"))
+    if backend == "tensorrt":
+        from object_detection_rtv4 import ONNXTensorRTv4ObjectDetection
+
+        model = ONNXTensorRTv4ObjectDetection(config, labels)
+    elif backend == "onnxruntime":
+        from inference import OnnxRuntimeSession
+
+        input_shape = (
+            int(config.get("max-batch", 1)),
+            int(config.get("channels")),
+            int(config.get("height")),
+            int(config.get("width")),
+        )
+        session = OnnxRuntimeSession(config.get("onnx"), input_shape)
+        model = YoloV4ObjectDetection(session, labels, prob_threshold)
+    else:
+        raise ValueError("Unknown inference backend {}".format(backend))
+    # color-model is color
+    model.name = getattr(config, "name", model.name).replace("-model", "")
+    return model
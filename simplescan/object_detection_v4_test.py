@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import numpy as np
+import pytest
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from fakes import write_yolo_model  # noqa: E402
+from inference import OnnxRuntimeSession  # noqa: E402
+from object_detection_v4 import YoloV4ObjectDetection  # noqa: E402
+
+LABELS = ["person", "dog", "deer"]
+# x1, y1, x2, y2 per candidate box
+BOXES = np.array(
+    [
+        [0.10, 0.10, 0.30, 0.50],
+        [0.11, 0.10, 0.31, 0.50],
+        [0.60, 0.60, 0.90, 0.95],
+        [0.00, 0.00, 0.05, 0.05],
+    ],
+    dtype=np.float32,
+)
+CONFS = np.array(
+    [
+        [0.90, 0.01, 0.01],
+        [0.80, 0.01, 0.01],
+        [0.01, 0.70, 0.01],
+        [0.01, 0.01, 0.20],
+    ],
+    dtype=np.float32,
+)
+
+
+def make_model(path, channels=3, size=32):
+    """Constant YOLOv4 shaped outputs which still depend on the input batch"""
+    return write_yolo_model(path, BOXES, CONFS, channels, size)
+
+
+@pytest.fixture
+def detector(tmp_path):
+    model = make_model(tmp_path / "fake.onnx")
+    session = OnnxRuntimeSession(model, (1, 3, 32, 32))
+    return YoloV4ObjectDetection(session, LABELS, 0.4)
+
+
+def test_predict_image(detector):
+    image = np.full((32, 32, 3), 128, dtype=np.uint8)
+    predictions = detector.predict_image(image)
+    assert [p["tagName"] for p in sorted(predictions, key=lambda p: p["tagId"])] == [
+        "person",
+        "dog",
+    ]
+    person = next(p for p in predictions if p["tagName"] == "person")
+    assert person["probability"] == pytest.approx(0.9)
+    assert person["boundingBox"]["width"] == pytest.approx(0.2)
+
+
+def test_buffers_are_reused(detector):
+    session = detector.session
+    input_buffer = session.input_buffer
+    outputs = [o.ctypes.data for o in session.host_outputs]
+    image = np.zeros((32, 32, 3), dtype=np.uint8)
+    for _ in range(3):
+        detector.predict_image(image)
+    assert session.input_buffer is input_buffer
+    assert [o.ctypes.data for o in session.host_outputs] == outputs
+
+
+def test_preprocess_writes_into_buffer(detector):
+    image = np.full((32, 32, 3), 255, dtype=np.uint8)
+    out = detector.session.input_buffer[0]
+    assert detector.preprocess(image, out=out) is out
+    assert np.all(detector.session.input_buffer == 1.0)
+
+
+def test_predict_images_in_batches(tmp_path):
+    model = make_model(tmp_path / "fake.onnx")
+    detector = YoloV4ObjectDetection(
+        OnnxRuntimeSession(model, (2, 3, 32, 32)), LABELS, 0.4
+    )
+    images = [np.zeros((32, 32, 3), dtype=np.uint8) for _ in range(3)]
+    results = detector.predict_images(images)
+    assert len(results) == 3
+    assert all(len(predictions) == 2 for predictions in results)
+
+
+@pytest.mark.parametrize("objects", [0, 5, 30, 80])
+def test_postprocess_matches_per_class_nms(objects):
+    from nms_benchmark import legacy_postprocess, random_outputs
+
+    labels = ["class{}".format(i) for i in range(80)]
+    output = random_outputs(5000, len(labels), objects=objects, seed=objects)
+    detector = YoloV4ObjectDetection.__new__(YoloV4ObjectDetection)
+    detector.labels = labels
+    predictions = [p.to_dict() for p in detector.postprocess(output)]
+    assert predictions == legacy_postprocess(labels, output)
+
+
+def test_batched_nms_is_class_aware():
+    from object_detection_v4 import batched_nms
+
+    boxes = np.array(
+        [[0, 0, 1, 1], [0, 0, 1, 1], [0.01, 0, 1, 1], [2, 2, 3, 3]], dtype=np.float32
+    )
+    confs = np.array([0.9, 0.8, 0.7, 0.6], dtype=np.float32)
+    class_ids = np.array([0, 1, 0, 0])
+    assert list(batched_nms(boxes, confs, class_ids, 0.5)) == [0, 1, 3]
+    assert list(batched_nms(boxes, confs, class_ids, 0.5, max_matrix=0)) == [0, 1, 3]
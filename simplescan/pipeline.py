@@ -0,0 +1,150 @@
+"""Bounded queues between the capture, inference and detect stages of the main loop."""
+
+import collections
+import logging
+import threading
+import time
+from timeit import default_timer as timer
+
+logger = logging.getLogger(__name__)
+
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+
+
+class Stage(object):
+    """A bounded queue served by a pool of worker threads.
+
+    handler is called with a list of up to batch_size items. After the first
+    item is taken, workers wait up to max_wait seconds for the batch to fill.
+    When the queue is full, put() either blocks until there is room, which
+    pushes back on the stage before, or drops the oldest item and passes it to
+    on_drop.
+    """
+
+    def __init__(
+        self,
+        name,
+        handler,
+        workers=1,
+        maxsize=8,
+        policy=BLOCK,
+        batch_size=1,
+        max_wait=0.0,
+        on_drop=None,
+    ):
+        if policy not in (BLOCK, DROP_OLDEST):
+            raise ValueError(
+                "Unknown policy {}, expected {} or {}".format(
+                    policy, BLOCK, DROP_OLDEST
+                )
+            )
+        self.name = name
+        self.handler = handler
+        self.maxsize = maxsize
+        self.policy = policy
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.on_drop = on_drop
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.active = 0
+        self.closed = False
+        self.processed = 0
+        self.dropped = 0
+        self.busy_time = 0.0
+        self.threads = [
+            threading.Thread(
+                target=self.work, name="{}-{}".format(name, i), daemon=True
+            )
+            for i in range(workers)
+        ]
+        for t in self.threads:
+            t.start()
+
+    def put(self, item):
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("Stage {} is closed".format(self.name))
+            dropped = None
+            if len(self.queue) >= self.maxsize:
+                if self.policy == DROP_OLDEST:
+                    dropped = self.queue.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self.queue) >= self.maxsize and not self.closed:
+                        self.cond.wait()
+            self.queue.append(item)
+            self.cond.notify_all()
+        if dropped is not None:
+            logger.warning("%s queue full, dropped the oldest item", self.name)
+            if self.on_drop is not None:
+                self.on_drop(dropped)
+
+    def take(self):
+        """Wait for the next batch, None once closed and empty"""
+        with self.cond:
+            while not self.queue and not self.closed:
+                self.cond.wait()
+            if not self.queue:
+                return None
+            batch = [self.queue.popleft()]
+            # busy from here, so join() doesn't return while the batch fills
+            self.active += 1
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                if not self.queue:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self.closed:
+                        break
+                    self.cond.wait(remaining)
+                    continue
+                batch.append(self.queue.popleft())
+            self.cond.notify_all()
+            return batch
+
+    def work(self):
+        while True:
+            batch = self.take()
+            if batch is None:
+                return
+            start = timer()
+            try:
+                self.handler(batch)
+            except Exception:
+                logger.exception("Error in %s stage", self.name)
+            finally:
+                with self.cond:
+                    self.active -= 1
+                    self.processed += len(batch)
+                    self.busy_time += timer() - start
+                    self.cond.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until the queue is empty and no worker is busy"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.queue or self.active:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def close(self):
+        """Let the workers finish what is queued, then stop them"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
+
+    def stats(self):
+        with self.cond:
+            return {
+                "depth": len(self.queue),
+                "active": self.active,
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "busy": round(self.busy_time, 3),
+            }
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import threading
+import time
+
+import pytest
+
+from pipeline import BLOCK, DROP_OLDEST, Stage
+
+
+def test_batches_up_to_batch_size():
+    batches = []
+    gate = threading.Event()
+
+    def handler(batch):
+        gate.wait(5)
+        batches.append(batch)
+
+    stage = Stage("test", handler, maxsize=10, batch_size=2, max_wait=0.5)
+    for i in range(5):
+        stage.put(i)
+    gate.set()
+    assert stage.join(5)
+    stage.close()
+    assert sorted(i for b in batches for i in b) == list(range(5))
+    assert max(len(b) for b in batches) == 2
+
+
+def test_flushes_after_max_wait():
+    batches = []
+    stage = Stage("test", batches.append, batch_size=8, max_wait=0.05)
+    stage.put("fast")
+    time.sleep(0.3)
+    stage.put("slow")
+    assert stage.join(5)
+    stage.close()
+    assert batches == [["fast"], ["slow"]]
+
+
+def test_drop_oldest():
+    gate = threading.Event()
+    seen = []
+    dropped = []
+
+    def handler(batch):
+        gate.wait(5)
+        seen.extend(batch)
+
+    stage = Stage(
+        "test", handler, maxsize=2, policy=DROP_OLDEST, on_drop=dropped.append
+    )
+    stage.put(0)
+    while stage.stats()["active"] == 0:
+        time.sleep(0.01)
+    for i in range(1, 5):
+        stage.put(i)
+    gate.set()
+    assert stage.join(5)
+    stage.close()
+    assert seen == [0, 3, 4]
+    assert dropped == [1, 2]
+    assert stage.stats()["dropped"] == 2
+
+
+def test_block_applies_backpressure():
+    gate = threading.Event()
+    stage = Stage("test", lambda batch: gate.wait(5), maxsize=1, policy=BLOCK)
+    stage.put(0)
+    while stage.stats()["active"] == 0:
+        time.sleep(0.01)
+    stage.put(1)
+    blocked = threading.Thread(target=stage.put, args=(2,))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+    gate.set()
+    blocked.join(5)
+    assert stage.join(5)
+    stage.close()
+    assert stage.stats()["processed"] == 3
+
+
+def test_workers_run_concurrently():
+    barrier = threading.Barrier(3, timeout=5)
+    stage = Stage("test", lambda batch: barrier.wait(), workers=3)
+    for i in range(3):
+        stage.put(i)
+    assert stage.join(5)
+    stage.close()
+
+
+def test_errors_are_logged_and_work_continues():
+    seen = []
+
+    def handler(batch):
+        if batch == [0]:
+            raise ValueError("boom")
+        seen.extend(batch)
+
+    stage = Stage("test", handler)
+    stage.put(0)
+    stage.put(1)
+    assert stage.join(5)
+    stage.close()
+    assert seen == [1]
+    with pytest.raises(RuntimeError):
+        stage.put(2)
@@ -0,0 +1,161 @@
+"""Fuzzy matching of the plates ALPR reads against the known license plates."""
+
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(plate):
+    """Upper case letters and digits only, as ALPR reads may add spaces and dashes"""
+    return "".join(c for c in plate.upper() if c.isalnum())
+
+
+def deletes(word, max_distance):
+    """word with up to max_distance of its characters deleted"""
+    result = level = {word}
+    for _ in range(max_distance):
+        level = {w[:i] + w[i + 1 :] for w in level for i in range(len(w))}
+        result = result | level
+    return result
+
+
+def distance(a, b, max_distance):
+    """Levenshtein distance of a and b, max_distance + 1 once it is over"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(
+                min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb))
+            )
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return min(previous[-1], max_distance + 1)
+
+
+class PlateIndex(object):
+    """Known plates, indexed by their deletes for approximate lookups.
+
+    Each plate is stored under every string left by deleting up to
+    max_distance of its characters, about 30 keys for a 7 character plate
+    at distance 2. Two plates within max_distance edits share a delete, so
+    a lookup only checks the plates under the query's own deletes. Memory
+    grows linearly with the plates, and update() only indexes the plates
+    which were added or removed.
+    """
+
+    def __init__(self, max_distance=2):
+        self.max_distance = max_distance
+        self.lock = threading.Lock()
+        # plate: its record from license-plates.json
+        self.plates = {}
+        # plate: its position in the file, for ties
+        self.rank = {}
+        self.normalized = {}
+        # delete: plates it was left by
+        self.index = {}
+
+    def __len__(self):
+        return len(self.plates)
+
+    def add(self, plate):
+        key = normalize(plate)
+        self.normalized[plate] = key
+        for d in deletes(key, self.max_distance):
+            self.index.setdefault(d, []).append(plate)
+
+    def remove(self, plate):
+        key = self.normalized.pop(plate)
+        for d in deletes(key, self.max_distance):
+            plates = self.index[d]
+            plates.remove(plate)
+            if not plates:
+                del self.index[d]
+
+    def update(self, plates):
+        """Replace the known plates with plates, returning (added, removed)"""
+        with self.lock:
+            added = [p for p in plates if p not in self.plates]
+            removed = [p for p in self.plates if p not in plates]
+            for plate in removed:
+                self.remove(plate)
+            for plate in added:
+                self.add(plate)
+            self.plates = dict(plates)
+            self.rank = {plate: i for i, plate in enumerate(self.plates)}
+            return added, removed
+
+    def match(self, plate):
+        """The nearest known plate as (plate, distance, record), or None
+
+        Ties go to the plate listed first. The record is taken under the lock
+        with the match, as a reload may remove the plate right after.
+        """
+        query = normalize(plate)
+        best = None
+        with self.lock:
+            candidates = set()
+            for d in deletes(query, self.max_distance):
+                candidates.update(self.index.get(d, ()))
+            for candidate in candidates:
+                n = distance(query, self.normalized[candidate], self.max_distance)
+                if n > self.max_distance:
+                    continue
+                rank = (n, self.rank[candidate])
+                if best is None or rank < best[0]:
+                    best = (rank, candidate)
+            if best is None:
+                return None
+            return best[1], best[0][0], self.plates[best[1]]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "plates": len(self.plates),
+                "keys": len(self.index),
+                "entries": sum(len(plates) for plates in self.index.values()),
+            }
+
+
+class PlateFile(object):
+    """license-plates.json, reloaded into a PlateIndex when it changes"""
+
+    def __init__(self, path, max_distance=2):
+        self.path = path
+        self.index = PlateIndex(max_distance)
+        self.mtime = None
+
+    def load(self):
+        """The index, after reloading the file if its modification time changed"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as e:
+            if self.mtime != -1:
+                logger.warning(f"Could not load {self.path}: {e}")
+                self.index.update({})
+                self.mtime = -1
+            return self.index
+        if mtime == self.mtime:
+            return self.index
+        try:
+            with open(self.path) as f:
+                plates = json.load(f)
+        except (OSError, ValueError) as e:
+            # keep the plates from before, the file may be half written
+            logger.warning(f"Could not load {self.path}: {e}")
+            return self.index
+        self.mtime = mtime
+        added, removed = self.index.update(plates)
+        logger.info(
+            "Loaded %d license plates, %d added and %d removed",
+            len(self.index),
+            len(added),
+            len(removed),
+        )
+        return self.index
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Benchmark of the plate index against the original edits1 expansion.
+
+Usage: python plates_benchmark.py [--plates 100,1000,10000] [--queries 2000]
+"""
+
+import argparse
+import random
+import string
+import tracemalloc
+from timeit import default_timer as timer
+
+from plates import PlateIndex
+
+LETTERS = string.ascii_uppercase + string.digits
+
+
+def legacy_edits1(word):
+    "All edits that are one edit away from `word`."
+    splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
+    deletes = [L + R[1:] for L, R in splits if R]
+    replaces = [L + c + R[1:] for L, R in splits if R for c in LETTERS]
+    inserts = [L + c + R for L, R in splits for c in LETTERS]
+    return set(deletes + replaces + inserts)
+
+
+class LegacyIndex(object):
+    """The original pre-expansion of every plate into its edits1 variants"""
+
+    def __init__(self, plates):
+        self.variants = {}
+        for plate in plates:
+            self.variants[plate] = plate
+            for variant in legacy_edits1(plate):
+                self.variants.setdefault(variant, plate)
+
+    def match(self, plate):
+        if plate in self.variants:
+            return self.variants[plate]
+        for variant in legacy_edits1(plate):
+            if variant in self.variants:
+                return self.variants[variant]
+        return None
+
+
+def random_plates(n, rng):
+    return [
+        "".join(rng.choice(LETTERS) for _ in range(rng.randint(5, 7))) for _ in range(n)
+    ]
+
+
+def misread(plate, edits, rng):
+    """plate with edits random substitutions, deletions or insertions"""
+    for _ in range(edits):
+        i = rng.randrange(len(plate))
+        kind = rng.randrange(3)
+        if kind == 0:
+            plate = plate[:i] + rng.choice(LETTERS) + plate[i + 1 :]
+        elif kind == 1 and len(plate) > 1:
+            plate = plate[:i] + plate[i + 1 :]
+        else:
+            plate = plate[:i] + rng.choice(LETTERS) + plate[i:]
+    return plate
+
+
+def measure(build, queries):
+    """(seconds to build, bytes allocated, the index, seconds per query)"""
+    tracemalloc.start()
+    start = timer()
+    index = build()
+    built = timer() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = timer()
+    for q in queries:
+        index.match(q)
+    return built, memory, index, (timer() - start) / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--plates", default="100,1000,10000")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--max-distance", type=int, default=2)
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+
+    print(
+        "{:>7} {:>7} {:>10} {:>10} {:>12}".format(
+            "plates", "index", "build", "memory", "per lookup"
+        )
+    )
+    for n in (int(n) for n in args.plates.split(",")):
+        rng = random.Random(n)
+        plates = random_plates(n, rng)
+        # a third read right, the rest one or two characters off, some unknown
+        queries = [
+            misread(rng.choice(plates), rng.randint(0, 2), rng)
+            for _ in range(args.queries)
+        ] + random_plates(args.queries // 4, rng)
+        candidates = [
+            ("deletes", lambda: PlateIndex(args.max_distance)),
+        ]
+        if not args.skip_legacy:
+            candidates.append(("legacy", lambda: LegacyIndex(plates)))
+        for name, build in candidates:
+
+            def built():
+                index = build()
+                if isinstance(index, PlateIndex):
+                    index.update({p: {} for p in plates})
+                return index
+
+            seconds, memory, _, lookup = measure(built, queries)
+            print(
+                "{:>7} {:>7} {:>9.2f}s {:>8.1f}MB {:>10.1f}us".format(
+                    n, name, seconds, memory / 1e6, lookup * 1e6
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
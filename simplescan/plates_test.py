@@ -0,0 +1,92 @@
+import json
+import os
+import random
+
+from plates import PlateFile, PlateIndex, deletes, distance, normalize
+from plates_benchmark import LegacyIndex, misread, random_plates
+
+KNOWN = {
+    "ABC123": {"owner": "Brian", "make": "Subaru"},
+    "XYZ789": {"owner": "House Cleaner"},
+    "ABC124": {"owner": "Neighbour"},
+}
+
+
+def test_distance():
+    assert distance("ABC123", "ABC123", 2) == 0
+    assert distance("ABC123", "ABX123", 2) == 1
+    assert distance("ABC123", "BC1234", 2) == 2
+    assert distance("ABC123", "XYZ789", 2) == 3
+    assert distance("A", "ABCDEF", 2) == 3
+
+
+def test_deletes():
+    assert deletes("ABC", 1) == {"ABC", "BC", "AC", "AB"}
+    assert len(deletes("ABC1234", 2)) == 1 + 7 + 21
+
+
+def test_match():
+    index = PlateIndex()
+    index.update(KNOWN)
+    assert index.match("ABC123") == ("ABC123", 0, KNOWN["ABC123"])
+    assert index.match("abc 123") == ("ABC123", 0, KNOWN["ABC123"])
+    assert index.match("XYZ-78") == ("XYZ789", 1, KNOWN["XYZ789"])
+    # as near to both, the one listed first
+    assert index.match("ABC125") == ("ABC123", 1, KNOWN["ABC123"])
+    assert index.match("AB124") == ("ABC124", 1, KNOWN["ABC124"])
+    assert index.match("QQQ999") is None
+
+
+def test_max_distance():
+    index = PlateIndex(max_distance=1)
+    index.update(KNOWN)
+    assert index.match("XYZ78") == ("XYZ789", 1, KNOWN["XYZ789"])
+    assert index.match("XY78") is None
+
+
+def test_incremental_update():
+    index = PlateIndex()
+    index.update(KNOWN)
+    entries = index.stats()["entries"]
+    added, removed = index.update(
+        {"ABC123": {"owner": "Brian", "color": "blue"}, "NEW555": {}}
+    )
+    assert added == ["NEW555"] and sorted(removed) == ["ABC124", "XYZ789"]
+    assert index.match("NEW55") == ("NEW555", 1, {})
+    assert index.match("XYZ789") is None
+    assert index.plates["ABC123"]["color"] == "blue"
+    index.update(KNOWN)
+    assert index.stats()["entries"] == entries
+
+
+def test_same_matches_as_legacy():
+    rng = random.Random(1)
+    plates = random_plates(300, rng)
+    index = PlateIndex()
+    index.update({p: {} for p in plates})
+    legacy = LegacyIndex(plates)
+    for _ in range(500):
+        query = misread(rng.choice(plates), rng.randint(0, 3), rng)
+        match = index.match(query)
+        found = legacy.match(query)
+        assert (match is None) == (found is None)
+        if match is not None:
+            assert match[1] == distance(query, found, 2)
+
+
+def test_plate_file_reload(tmp_path):
+    path = tmp_path / "license-plates.json"
+    path.write_text(json.dumps(KNOWN))
+    plate_file = PlateFile(str(path))
+    assert plate_file.load().match("XYZ789") == ("XYZ789", 0, KNOWN["XYZ789"])
+    path.write_text(json.dumps({"NEW555": {}}))
+    os.utime(str(path), (0, 0))
+    index = plate_file.load()
+    assert len(index) == 1 and index.match("XYZ789") is None
+    # a half written file keeps the plates
+    path.write_text("{")
+    os.utime(str(path), (1, 1))
+    assert plate_file.load().match("NEW555") == ("NEW555", 0, {})
+    path.unlink()
+    assert len(plate_file.load()) == 0
+    assert normalize(" ab-12 ") == "AB12"
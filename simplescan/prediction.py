@@ -0,0 +1,134 @@
+"""The detections the models return and the rules, tracker and notifications work on."""
+
+FIELDS = (
+    "probability",
+    "tagId",
+    "tagName",
+    "boundingBox",
+    "center",
+    "camName",
+    "road_y",
+    "ignore",
+    "iou",
+    "priority",
+    "priority_type",
+    "age",
+    "start_time",
+    "last_time",
+    "msg",
+    "departed",
+)
+OPTIONAL = FIELDS[4:]
+
+
+class Prediction(object):
+    """One detection, with the attributes rules and tracking add to it.
+
+    Attributes which aren't set are None. Predictions can also be used as
+    the dicts they replace: p["tagName"], "ignore" in p, p.get("age") and
+    dict(p) only see the attributes which are set, and keys which aren't
+    attributes are kept in extra.
+    """
+
+    __slots__ = FIELDS + ("extra",)
+
+    def __init__(self, probability, tagId, tagName, boundingBox):
+        self.probability = probability
+        self.tagId = tagId
+        self.tagName = tagName
+        # {"left", "top", "width", "height"}, normalized to the frame
+        self.boundingBox = boundingBox
+        self.center = None
+        self.camName = None
+        self.road_y = None
+        self.ignore = None
+        self.iou = None
+        self.priority = None
+        self.priority_type = None
+        self.age = None
+        self.start_time = None
+        self.last_time = None
+        self.msg = None
+        self.departed = None
+        self.extra = None
+
+    @classmethod
+    def from_dict(cls, d):
+        p = cls(d["probability"], d.get("tagId"), d["tagName"], d["boundingBox"])
+        for k, v in d.items():
+            p[k] = v
+        return p
+
+    def __getitem__(self, key):
+        if key in FIELDS:
+            value = getattr(self, key)
+        elif self.extra is not None:
+            value = self.extra.get(key)
+        else:
+            value = None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in FIELDS:
+            setattr(self, key, None)
+        else:
+            del self.extra[key]
+
+    def __contains__(self, key):
+        if key in FIELDS:
+            return getattr(self, key) is not None
+        return self.extra is not None and key in self.extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [k for k in FIELDS if getattr(self, k) is not None]
+        if self.extra:
+            keys += list(self.extra)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def copy(self):
+        p = Prediction(self.probability, self.tagId, self.tagName, self.boundingBox)
+        for k in OPTIONAL:
+            setattr(p, k, getattr(self, k))
+        if self.extra:
+            p.extra = dict(self.extra)
+        return p
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+def json_default(o):
+    """json.dumps default for predictions in saved metadata and payloads"""
+    if isinstance(o, Prediction):
+        return o.to_dict()
+    return str(o)
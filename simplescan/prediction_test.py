@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+import json
+from datetime import datetime
+
+import pytest
+
+from prediction import Prediction, json_default
+
+
+def make():
+    return Prediction(
+        0.9, 3, "deer", {"left": 0.1, "top": 0.2, "width": 0.3, "height": 0.4}
+    )
+
+
+def test_mapping_protocol():
+    p = make()
+    assert p["tagName"] == "deer"
+    assert "ignore" not in p
+    with pytest.raises(KeyError):
+        p["ignore"]
+    assert p.get("age", 0) == 0
+    p["ignore"] = "road"
+    assert p.ignore == "road"
+    assert "ignore" in p
+    del p["ignore"]
+    assert p.ignore is None
+    p["plate"] = "ABC123"
+    assert p["plate"] == "ABC123"
+    assert list(p) == ["probability", "tagId", "tagName", "boundingBox", "plate"]
+    assert dict(p)["plate"] == "ABC123"
+
+
+def test_copy_is_independent():
+    p = make()
+    p.age = 2
+    q = p.copy()
+    q.age = 3
+    q["extra_key"] = 1
+    assert p.age == 2
+    assert "extra_key" not in p
+    assert q.boundingBox is p.boundingBox
+
+
+def test_json():
+    p = make()
+    p.start_time = datetime(2024, 6, 1, 12, 0)
+    p.ignore = ""
+    saved = json.loads(json.dumps({"predictions": [p]}, default=json_default))
+    assert saved["predictions"][0] == {
+        "probability": 0.9,
+        "tagId": 3,
+        "tagName": "deer",
+        "boundingBox": {"left": 0.1, "top": 0.2, "width": 0.3, "height": 0.4},
+        "ignore": "",
+        "start_time": "2024-06-01 12:00:00",
+    }
+    assert Prediction.from_dict(saved["predictions"][0]).start_time == (
+        "2024-06-01 12:00:00"
+    )
@@ -0,0 +1,174 @@
+"""One outbound queue for everything published on the shared MQTT connection."""
+
+import collections
+import logging
+import threading
+from timeit import default_timer as timer
+
+from paho.mqtt.client import MQTT_ERR_NO_CONN
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Publisher(object):
+    """Publishes on a shared paho client from a background thread.
+
+    publish() takes paho's arguments and returns at once. Messages wait in a
+    queue keyed by topic, so a newer payload for a topic which is still
+    queued replaces the older one in its place, as repeated counts and show
+    updates do. After the first message the thread waits up to batch_wait
+    seconds for more, then publishes up to batch_size at once. While the
+    client is disconnected messages are held, coalesced, and retried every
+    retry seconds until it reconnects. When maxsize topics are waiting, the
+    oldest is dropped.
+    """
+
+    def __init__(self, client, maxsize=1024, batch_size=64, batch_wait=0.05, retry=1.0):
+        self.client = client
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.retry = retry
+        # after the client said it had no connection
+        self.retry_at = 0.0
+        # topic: (payload, qos, retain, time first queued)
+        self.queue = collections.OrderedDict()
+        self.cond = threading.Condition()
+        self.active = 0
+        self.closed = False
+        self.published = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=256)
+        self.thread = threading.Thread(target=self.run, name="mqtt", daemon=True)
+        self.thread.start()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        with self.cond:
+            if topic in self.queue:
+                queued = self.queue[topic][3]
+                self.coalesced += 1
+            else:
+                queued = timer()
+                if len(self.queue) >= self.maxsize:
+                    self.queue.popitem(last=False)
+                    self.dropped += 1
+            self.queue[topic] = (payload, qos, retain, queued)
+            self.cond.notify_all()
+
+    def connected(self):
+        if timer() < self.retry_at:
+            return False
+        is_connected = getattr(self.client, "is_connected", None)
+        return is_connected is None or is_connected()
+
+    def requeue(self, batch):
+        """Put unpublished messages back in front, unless a newer one is queued"""
+        with self.cond:
+            self.retry_at = timer() + self.retry
+            for topic, message in reversed(batch):
+                if topic in self.queue:
+                    continue
+                if len(self.queue) >= self.maxsize:
+                    self.dropped += 1
+                    continue
+                self.queue[topic] = message
+                self.queue.move_to_end(topic, last=False)
+
+    def take(self):
+        """The next batch, None once closed"""
+        with self.cond:
+            while True:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    return None
+                deadline = timer() + self.batch_wait
+                while not self.closed and len(self.queue) < self.batch_size:
+                    remaining = deadline - timer()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                if self.connected():
+                    break
+                if self.closed:
+                    logger.warning(
+                        "Dropping %d MQTT messages, disconnected", len(self.queue)
+                    )
+                    self.dropped += len(self.queue)
+                    self.queue.clear()
+                    self.cond.notify_all()
+                    return None
+                self.cond.wait(self.retry)
+            n = min(len(self.queue), self.batch_size)
+            batch = [self.queue.popitem(last=False) for _ in range(n)]
+            self.active = len(batch)
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.take()
+            if batch is None:
+                return
+            published = 0
+            errors = 0
+            latencies = []
+            for i, (topic, (payload, qos, retain, queued)) in enumerate(batch):
+                try:
+                    info = self.client.publish(topic, payload, qos=qos, retain=retain)
+                except Exception:
+                    logger.exception("Failed to publish %s", topic)
+                    errors += 1
+                    continue
+                if getattr(info, "rc", 0) == MQTT_ERR_NO_CONN:
+                    logger.debug("MQTT disconnected, holding %d messages", len(batch))
+                    self.requeue(batch[i:])
+                    break
+                if getattr(info, "rc", 0):
+                    logger.warning("Failed to publish %s: rc=%s", topic, info.rc)
+                    errors += 1
+                    continue
+                published += 1
+                latencies.append(timer() - queued)
+            for latency in latencies:
+                metrics.observe("mqtt", latency)
+            with self.cond:
+                self.active = 0
+                self.published += published
+                self.errors += errors
+                self.latencies.extend(latencies)
+                self.cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait for everything queued to be published, True when it was"""
+        with self.cond:
+            return self.cond.wait_for(
+                lambda: not self.queue and self.active == 0, timeout
+            )
+
+    def close(self, timeout=10):
+        """Publish what is queued and stop the thread"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+
+    def stats(self):
+        with self.cond:
+            latencies = sorted(self.latencies)
+            return {
+                "depth": len(self.queue) + self.active,
+                "published": self.published,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "latency_ms": (
+                    round(latencies[len(latencies) // 2] * 1000, 1)
+                    if latencies
+                    else 0.0
+                ),
+                "max_latency_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+            }
@@ -0,0 +1,96 @@
+import threading
+import time
+
+import paho.mqtt.client as paho
+import pytest
+
+from fakes import FakeBroker, FakeMqttClient
+from publisher import Publisher
+
+
+class OfflineClient(FakeMqttClient):
+    def __init__(self):
+        super().__init__()
+        self.online = False
+
+    def is_connected(self):
+        return self.online
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def broker():
+    broker = FakeBroker()
+    yield broker
+    broker.close()
+
+
+def test_coalesces_queued_topics():
+    client = FakeMqttClient()
+    publisher = Publisher(client, batch_wait=0.5)
+    try:
+        for count in range(5):
+            publisher.publish("deck/person/count", count)
+        publisher.publish("deck/show", True, retain=True)
+        publisher.publish("deck/person/count", 7)
+        assert publisher.flush(5)
+    finally:
+        publisher.close()
+    # in the order topics were first queued, with the latest payload
+    assert client.messages == [("deck/person/count", 7), ("deck/show", True)]
+    assert client.retained == {"deck/show": True}
+    stats = publisher.stats()
+    assert stats["published"] == 2
+    assert stats["coalesced"] == 5
+    assert stats["depth"] == 0
+
+
+def test_held_while_disconnected():
+    client = OfflineClient()
+    publisher = Publisher(client, maxsize=2, batch_wait=0)
+    try:
+        for topic in ("a", "b", "c", "b"):
+            publisher.publish(topic, 1)
+        time.sleep(0.1)
+        assert client.messages == []
+        assert publisher.stats()["depth"] == 2
+        assert publisher.stats()["dropped"] == 1
+        client.online = True
+        assert publisher.flush(5)
+    finally:
+        publisher.close()
+    assert client.messages == [("b", 1), ("c", 1)]
+
+
+def test_shared_connection(broker):
+    client = paho.Client(client_id="aicam")
+    client.reconnect_delay_set(min_delay=1, max_delay=2)
+    disconnected = threading.Event()
+    client.on_disconnect = lambda client, userdata, rc: disconnected.set()
+    client.connect("127.0.0.1", broker.port, keepalive=60)
+    client.loop_start()
+    publisher = Publisher(client, batch_wait=0.01, retry=0.2)
+    try:
+        wait_for(client.is_connected)
+        for cam in ("deck", "yard", "porch"):
+            publisher.publish(cam + "/show", False, retain=True)
+        wait_for(lambda: len(broker.messages) == 3)
+        assert broker.retained["yard/show"] == "False"
+        # a broker restart, messages wait for the reconnect
+        broker.drop()
+        assert disconnected.wait(5)
+        publisher.publish("deck/person/count", 1)
+        publisher.publish("deck/person/count", 2)
+        wait_for(lambda: ("deck/person/count", "2") in broker.messages)
+        assert ("deck/person/count", "1") not in broker.messages
+        assert broker.connections == 2
+    finally:
+        publisher.close()
+        client.disconnect()
+        client.loop_stop()
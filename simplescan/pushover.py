@@ -0,0 +1,264 @@
+"""Pushover notifications, delivered from background threads."""
+
+import collections
+import itertools
+import logging
+import threading
+import time
+from timeit import default_timer as timer
+
+import requests
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# can be overridden with url in [pushover]
+PUSHOVER_URL = "https://api.pushover.net/1/messages.json"
+
+
+class Message(object):
+    """A notification waiting to be delivered"""
+
+    __slots__ = [
+        "url",
+        "data",
+        "attachment",
+        "camera",
+        "priority",
+        "seq",
+        "queued",
+        "attempts",
+        "not_before",
+    ]
+
+    def __init__(self, url, data, attachment, camera, seq):
+        self.url = url
+        self.data = data
+        self.attachment = attachment
+        self.camera = camera
+        self.priority = int(data.get("priority", 0))
+        self.seq = seq
+        self.queued = timer()
+        self.attempts = 0
+        self.not_before = 0.0
+
+
+def post(session, message, timeout):
+    files = None
+    if message.attachment is not None:
+        files = {"attachment": ("image.jpg", message.attachment, "image/jpeg")}
+    with metrics.time("pushover", camera=message.camera):
+        return session.post(
+            message.url, data=message.data, files=files, timeout=timeout
+        )
+
+
+class PushoverQueue(object):
+    """Delivers notifications in the background, highest priority first.
+
+    send() queues a message and returns at once. workers threads, each with
+    a keep-alive requests.Session, post the highest priority message which
+    is ready, the oldest first. Connection errors, 429 and 5xx responses are
+    retried after backoff, twice that, and so on, up to retries times. Other
+    4xx responses are dropped, as Pushover asks. The X-Limit-App-Remaining
+    header of responses is tracked: once fewer than reserve messages are
+    left this month, messages below priority 0 are dropped, and none are
+    sent while none are left, until X-Limit-App-Reset. When maxsize
+    messages are waiting, the oldest of the lowest priority is dropped.
+    """
+
+    def __init__(
+        self, workers=2, maxsize=32, retries=3, backoff=1.0, reserve=50, timeout=10
+    ):
+        self.maxsize = maxsize
+        self.retries = retries
+        self.backoff = backoff
+        self.reserve = reserve
+        self.timeout = timeout
+        self.queue = []
+        self.cond = threading.Condition()
+        self.counter = itertools.count()
+        self.active = 0
+        self.closed = False
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+        self.limited = 0
+        # from the last response's X-Limit-App-Remaining and X-Limit-App-Reset
+        self.remaining = None
+        self.reset = None
+        self.latencies = collections.deque(maxlen=256)
+        self.threads = [
+            threading.Thread(
+                target=self.work, name="pushover-{}".format(i), daemon=True
+            )
+            for i in range(workers)
+        ]
+        for t in self.threads:
+            t.start()
+
+    def send(self, url, data, attachment=None, camera=""):
+        """Queue a message, False when it was dropped for a higher priority one"""
+        with self.cond:
+            message = Message(url, data, attachment, camera, next(self.counter))
+            if len(self.queue) >= self.maxsize:
+                lowest = min(self.queue, key=lambda m: (m.priority, m.seq))
+                if lowest.priority > message.priority:
+                    logger.warning("Dropping notification, %d queued", len(self.queue))
+                    self.dropped += 1
+                    return False
+                logger.warning("Dropping the oldest lowest priority notification")
+                self.queue.remove(lowest)
+                self.dropped += 1
+            self.queue.append(message)
+            self.cond.notify()
+            return True
+
+    def take(self):
+        """The next message which is ready, None once closed and empty"""
+        with self.cond:
+            while True:
+                if self.closed and not self.queue:
+                    return None
+                now = timer()
+                ready = [m for m in self.queue if m.not_before <= now]
+                if ready:
+                    message = min(ready, key=lambda m: (-m.priority, m.seq))
+                    self.queue.remove(message)
+                    self.active += 1
+                    return message
+                wait = None
+                if self.queue:
+                    wait = min(m.not_before for m in self.queue) - now
+                self.cond.wait(wait)
+
+    def over_limit(self, message):
+        with self.cond:
+            if self.reset is not None and time.time() > self.reset:
+                self.remaining = None
+                self.reset = None
+            if self.remaining is None:
+                return False
+            if self.remaining <= 0:
+                return True
+            return self.remaining < self.reserve and message.priority < 0
+
+    def rate_limit(self, headers):
+        with self.cond:
+            if "X-Limit-App-Remaining" in headers:
+                self.remaining = int(headers["X-Limit-App-Remaining"])
+            if "X-Limit-App-Reset" in headers:
+                self.reset = float(headers["X-Limit-App-Reset"])
+
+    def deliver(self, session, message):
+        """Post a message, True when it should be retried"""
+        if self.over_limit(message):
+            logger.warning(
+                "Dropping priority %d notification, %s messages left this month",
+                message.priority,
+                self.remaining,
+            )
+            with self.cond:
+                self.limited += 1
+            return False
+        try:
+            r = post(session, message, self.timeout)
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Failed to call Pushover: {e}")
+            return True
+        self.rate_limit(r.headers)
+        if r.status_code == 200:
+            with self.cond:
+                self.sent += 1
+                self.latencies.append(timer() - message.queued)
+            return False
+        logger.warning("Pushover returned %d: %s", r.status_code, r.text[:200])
+        return r.status_code == 429 or r.status_code >= 500
+
+    def work(self):
+        session = requests.Session()
+        try:
+            while True:
+                message = self.take()
+                if message is None:
+                    return
+                try:
+                    retry = self.deliver(session, message)
+                except Exception:
+                    logger.exception("Failed to deliver notification")
+                    retry = False
+                with self.cond:
+                    self.active -= 1
+                    if retry and message.attempts < self.retries:
+                        message.attempts += 1
+                        message.not_before = timer() + self.backoff * 2 ** (
+                            message.attempts - 1
+                        )
+                        self.queue.append(message)
+                        self.retried += 1
+                    elif retry:
+                        self.failed += 1
+                    self.cond.notify_all()
+        finally:
+            session.close()
+
+    def flush(self, timeout=None):
+        """Wait for the queue to empty, True when it did"""
+        with self.cond:
+            return self.cond.wait_for(
+                lambda: not self.queue and self.active == 0, timeout
+            )
+
+    def close(self, timeout=30):
+        """Deliver what is queued, within timeout seconds, and stop the threads"""
+        deadline = timer() + timeout
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join(max(deadline - timer(), 0))
+
+    def stats(self):
+        with self.cond:
+            latencies = sorted(self.latencies)
+            return {
+                "depth": len(self.queue) + self.active,
+                "sent": self.sent,
+                "retried": self.retried,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "limited": self.limited,
+                "remaining": -1 if self.remaining is None else self.remaining,
+                "latency_ms": (
+                    round(latencies[len(latencies) // 2] * 1000, 1)
+                    if latencies
+                    else 0.0
+                ),
+                "max_latency_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+            }
+
+
+_queue = None
+
+
+def set_queue(queue):
+    """Use queue for send(), or post synchronously when it is None"""
+    global _queue
+    _queue = queue
+
+
+def send(url, data, attachment=None, camera=""):
+    """Send a notification with the background queue, if there is one"""
+    if _queue is not None:
+        return _queue.send(url, data, attachment, camera)
+    message = Message(url, data, attachment, camera, 0)
+    try:
+        r = post(requests, message, 10)
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Failed to call Pushover: {e}")
+        return False
+    if r.status_code != 200:
+        logger.warning("Pushover returned %d: %s", r.status_code, r.text[:200])
+    return r.status_code == 200
@@ -0,0 +1,126 @@
+import time
+
+import pytest
+
+from fakes import FakePushover
+from pushover import PushoverQueue
+
+
+@pytest.fixture
+def server():
+    server = FakePushover()
+    yield server
+    server.close()
+
+
+def taken(queue, timeout=5):
+    """Wait for the workers to take everything queued"""
+    deadline = time.monotonic() + timeout
+    while queue.queue:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def message(text, priority=0):
+    return {"token": "t", "user": "u", "message": text, "priority": priority}
+
+
+def test_highest_priority_first(server):
+    # one worker, held up by the first message while the rest are queued
+    server.delay = 0.3
+    queue = PushoverQueue(workers=1)
+    try:
+        queue.send(server.messages_url, message("first"), b"jpeg", camera="deck")
+        taken(queue)
+        for text, priority in [("quiet", -1), ("normal", 0), ("high", 1), ("next", 0)]:
+            queue.send(server.messages_url, message(text, priority))
+        assert queue.flush(10)
+    finally:
+        queue.close()
+    assert [m["message"] for m in server.messages] == [
+        "first",
+        "high",
+        "normal",
+        "next",
+        "quiet",
+    ]
+    assert server.messages[0]["attachment"] == 4
+    stats = queue.stats()
+    assert stats["sent"] == 5 and stats["depth"] == 0
+    assert stats["remaining"] == server.limit - 5
+
+
+def test_retries_server_errors(server):
+    server.fail = 2
+    queue = PushoverQueue(workers=1, backoff=0.05)
+    try:
+        queue.send(server.messages_url, message("retried"))
+        assert queue.flush(10)
+    finally:
+        queue.close()
+    assert [m["message"] for m in server.messages] == ["retried"]
+    assert server.requests == 3
+    stats = queue.stats()
+    assert stats["retried"] == 2 and stats["failed"] == 0
+
+
+def test_gives_up_after_retries(server):
+    server.fail = 10
+    queue = PushoverQueue(workers=1, retries=2, backoff=0.01)
+    try:
+        queue.send(server.messages_url, message("lost"))
+        assert queue.flush(10)
+    finally:
+        queue.close()
+    assert server.messages == [] and server.requests == 3
+    assert queue.stats()["failed"] == 1
+
+
+def test_keeps_reserve_for_important_messages(server):
+    server.remaining = 3
+    queue = PushoverQueue(workers=1, reserve=5)
+    try:
+        # the first response says how many are left, after that quiet ones wait
+        for text, priority in [("a", 0), ("b", -1), ("c", 1), ("d", 0), ("e", 0)]:
+            queue.send(server.messages_url, message(text, priority))
+            assert queue.flush(10)
+    finally:
+        queue.close()
+    assert [m["message"] for m in server.messages] == ["a", "c", "d"]
+    stats = queue.stats()
+    # e, as none are left, without asking Pushover
+    assert stats["limited"] == 2 and stats["remaining"] == 0
+    assert server.requests == 3
+
+
+def test_bounded_queue_drops_lowest_priority(server):
+    server.delay = 0.3
+    queue = PushoverQueue(workers=1, maxsize=2)
+    try:
+        queue.send(server.messages_url, message("sending"))
+        taken(queue)
+        assert queue.send(server.messages_url, message("quiet", -1))
+        assert queue.send(server.messages_url, message("normal"))
+        # full, the quiet one makes way
+        assert queue.send(server.messages_url, message("high", 1))
+        assert not queue.send(server.messages_url, message("quieter", -2))
+        assert queue.flush(10)
+    finally:
+        queue.close()
+    assert [m["message"] for m in server.messages] == ["sending", "high", "normal"]
+    assert queue.stats()["dropped"] == 2
+
+
+def test_full_queue_drops_oldest_of_lowest_priority(server):
+    server.delay = 0.3
+    queue = PushoverQueue(workers=1, maxsize=2)
+    try:
+        queue.send(server.messages_url, message("sending"))
+        taken(queue)
+        queue.send(server.messages_url, message("older", -1))
+        queue.send(server.messages_url, message("newer", -1))
+        assert queue.send(server.messages_url, message("normal"))
+        assert queue.flush(10)
+    finally:
+        queue.close()
+    assert [m["message"] for m in server.messages] == ["sending", "normal", "newer"]
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""Replay saved frames through Camera, detect() and notify(), against local fakes.
+
+Usage: python replay.py [--config config.txt] [--state entity=state] DIR [DIR ...]
+
+The frames are the HHMMSS-camera-objects.jpg files detect() saves under
+save-path/YYYYMMDD, next to their .txt metadata. Models run on ONNX Runtime
+on the CPU. Home Assistant, MQTT, Pushover and CodeProject are fakes, and
+everything is saved to a temporary save-path. Reports frames per second,
+latency per stage, and which frames notify() decided differently than when
+they were recorded.
+"""
+
+import argparse
+import collections
+import configparser
+import glob
+import json
+import logging
+import os
+import shutil
+import tempfile
+from timeit import default_timer as timer
+
+import artifacts
+import codeproject
+import metrics
+import pushover
+from camera import Camera
+from detect import detect
+from fakes import (
+    HOME_STATES,
+    FakeCodeProject,
+    FakeHomeAssistant,
+    FakeMqttClient,
+    FakePushover,
+)
+from homeassistant import HomeAssistant
+from object_detection_v4 import load_model
+from tracker import Tracker
+
+logger = logging.getLogger(__name__)
+
+MODELS = ["color-model", "grey-model", "vehicle-model"]
+
+
+def recorded_frames(directories):
+    """(jpg, metadata) of each frame detect() saved, in the order it saved them"""
+    frames = []
+    for directory in directories:
+        for jpg in sorted(glob.glob(os.path.join(directory, "*.jpg"))):
+            txt = os.path.splitext(jpg)[0] + ".txt"
+            if not os.path.exists(txt):
+                # prior, departed and annotated images
+                continue
+            try:
+                with open(txt) as f:
+                    metadata = json.load(f)
+            except ValueError:
+                continue
+            # not an ALPR response
+            if isinstance(metadata, dict) and "predictions" in metadata:
+                frames.append((jpg, metadata))
+    return frames
+
+
+def camera_of(jpg, metadata, cams):
+    """The camera a frame was saved for, by its predictions or file name"""
+    for p in metadata["predictions"]:
+        if p.get("camName") in cams:
+            return cams[p["camName"]]
+    # after HHMMSS-, the longest name first as names may contain -
+    name = os.path.basename(jpg)[7:]
+    for cam in sorted(cams.values(), key=lambda cam: -len(cam.ha_name)):
+        if name.startswith(cam.ha_name + "-"):
+            return cam
+    return None
+
+
+def decision(predictions):
+    """(tagName, priority) of the objects notify() decided on, not tracked or ignored"""
+    return sorted(
+        (p.get("tagName"), p.get("priority"))
+        for p in predictions
+        if p.get("priority") is not None
+        and p.get("ignore") is None
+        and p.get("iou") is None
+    )
+
+
+def first_sighting(cam):
+    """Forget what the camera saw before, as every saved frame was a new detection"""
+    cam.tracker = Tracker(cam.interval)
+    cam.objects = set()
+    cam.prior_priority = -4
+    # past the warm up
+    cam.age = max(cam.age, 3)
+
+
+def replay(config, directories, states=None):
+    """Run the saved frames under directories through the pipeline.
+
+    config is changed to use the fakes, ONNX Runtime and a temporary
+    save-path.
+
+    Returns:
+        dict with frames, replayed, skipped (by reason), unknown (no
+        configured camera), seconds, fps, matched and differed (jpg, recorded,
+        replayed) decisions, the pushover, alpr, service and mqtt message
+        counts, and stages, the latency summary.
+    """
+    frames = recorded_frames(directories)
+    save_path = tempfile.mkdtemp(prefix="replay-")
+    ha_server = FakeHomeAssistant(dict(HOME_STATES, **(states or {})))
+    pushover_server = FakePushover()
+    codeproject_server = FakeCodeProject()
+    mqtt = FakeMqttClient()
+    writer = artifacts.ArtifactWriter(fsync=False)
+    plate_reader = codeproject.PlateReader(url=codeproject_server.alpr_url)
+    pushover_queue = pushover.PushoverQueue()
+    ha = None
+    try:
+        config["detector"]["save-path"] = save_path
+        os.makedirs(os.path.join(save_path, "static"))
+        for section in MODELS:
+            if section in config:
+                config[section]["backend"] = "onnxruntime"
+        if "homeassistant" not in config:
+            config["homeassistant"] = {}
+        config["homeassistant"]["api"] = ha_server.api
+        config["homeassistant"]["token"] = ha_server.token
+        if "pushover" not in config:
+            config["pushover"] = {"token": "replay", "user": "replay"}
+        config["pushover"]["url"] = pushover_server.messages_url
+        config["codeproject"] = {"url": codeproject_server.alpr_url}
+
+        detector_config = config["detector"]
+        with open(detector_config["labelfile-path"]) as f:
+            labels = [line.strip() for line in f.readlines()]
+        vehicle_labels = []
+        if "vehicle-labelfile-path" in detector_config:
+            with open(detector_config["vehicle-labelfile-path"]) as f:
+                vehicle_labels = [line.strip() for line in f.readlines()]
+        models = {}
+        for section in MODELS:
+            if section in config:
+                models[section] = load_model(
+                    config[section],
+                    vehicle_labels if section == "vehicle-model" else labels,
+                )
+        excludes = {}
+        if "excludes-file" in detector_config:
+            with open(detector_config["excludes-file"]) as f:
+                excludes = json.load(f)
+        cams = {}
+        i = 0
+        while "cam%d" % i in config.sections():
+            section = config["cam%d" % i]
+            cams[section["name"]] = Camera(
+                section, excludes.get(section["name"], {}), mqtt
+            )
+            i += 1
+
+        artifacts.set_writer(writer)
+        codeproject.set_reader(plate_reader)
+        pushover.set_queue(pushover_queue)
+        ha = HomeAssistant(config["homeassistant"])
+        skipped = collections.Counter()
+        unknown = 0
+        matched = 0
+        differed = []
+        start = timer()
+        for jpg, metadata in frames:
+            cam = camera_of(jpg, metadata, cams)
+            if cam is None:
+                unknown += 1
+                continue
+            with open(jpg, "rb") as f:
+                data = f.read()
+            first_sighting(cam)
+            cam.begin_capture()
+            if not cam.process_file(data, jpg):
+                skipped[str(cam.error)] += 1
+                continue
+            detect(
+                cam,
+                models.get("color-model"),
+                models.get("grey-model"),
+                models.get("vehicle-model"),
+                config,
+                ha,
+            )
+            recorded = decision(metadata["predictions"])
+            replayed = decision(cam.tracker.tracks())
+            if recorded == replayed:
+                matched += 1
+            else:
+                differed.append((jpg, recorded, replayed))
+        seconds = timer() - start
+        # lookups which outlasted the wait
+        plate_reader.close(wait=True)
+        pushover_queue.flush(30)
+        ha.services.join(30)
+        writer.flush(30)
+        replayed_frames = matched + len(differed)
+        return {
+            "frames": len(frames),
+            "replayed": replayed_frames,
+            "skipped": dict(skipped),
+            "unknown": unknown,
+            "seconds": seconds,
+            "fps": replayed_frames / seconds if seconds > 0 else 0.0,
+            "matched": matched,
+            "differed": differed,
+            "pushover": len(pushover_server.messages),
+            "alpr": codeproject_server.requests,
+            "services": len(ha_server.service_calls),
+            "mqtt": len(mqtt.messages),
+            "stages": metrics.get().summary()["stages"],
+        }
+    finally:
+        if ha is not None:
+            ha.close()
+        artifacts.set_writer(None)
+        writer.close()
+        codeproject.set_reader(None)
+        plate_reader.close()
+        pushover.set_queue(None)
+        pushover_queue.close()
+        for server in (ha_server, pushover_server, codeproject_server):
+            server.close()
+        shutil.rmtree(save_path, ignore_errors=True)
+
+
+def print_report(report):
+    print(
+        "Replayed {} of {} frames in {:.1f}s, {:.2f} frames/s".format(
+            report["replayed"], report["frames"], report["seconds"], report["fps"]
+        )
+    )
+    if report["skipped"]:
+        print(
+            "Skipped "
+            + ", ".join("{} {}".format(n, r) for r, n in report["skipped"].items())
+        )
+    if report["unknown"]:
+        print("{} frames of unconfigured cameras".format(report["unknown"]))
+    print(
+        "{:<12} {:>8} {:>8} {:>8} {:>6}".format("stage", "p50", "p95", "p99", "count")
+    )
+    for stage in metrics.STAGES:
+        stats = report["stages"].get(stage)
+        if stats is not None:
+            print(
+                "{:<12} {:>6.1f}ms {:>6.1f}ms {:>6.1f}ms {:>6}".format(
+                    stage, stats["p50"], stats["p95"], stats["p99"], stats["count"]
+                )
+            )
+    print(
+        "Decisions: {} frames match, {} differ".format(
+            report["matched"], len(report["differed"])
+        )
+    )
+    for jpg, recorded, replayed in report["differed"]:
+        print(
+            "  {} recorded {} replayed {}".format(
+                os.path.basename(jpg), recorded, replayed
+            )
+        )
+    print(
+        "Sent {} Pushover messages, {} ALPR requests, {} Home Assistant service "
+        "calls and {} MQTT messages".format(
+            report["pushover"], report["alpr"], report["services"], report["mqtt"]
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", default="config.txt")
+    parser.add_argument(
+        "--state",
+        action="append",
+        default=[],
+        help="Home Assistant state, e.g. input_boolean.night_mode=on",
+    )
+    parser.add_argument("directories", nargs="+")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    states = dict(state.split("=", 1) for state in args.state)
+    print_report(replay(config, args.directories, states))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import configparser
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip("onnxruntime")
+
+from object_detection_v4_test import LABELS, make_model  # noqa: E402
+from replay import camera_of, recorded_frames, replay  # noqa: E402
+
+
+def save_frame(directory, name, value, predictions=None):
+    # coloured, so it isn't taken for an IR frame
+    image = np.zeros((480, 640, 3), dtype=np.uint8)
+    image[:] = (value, 255 - value, 128)
+    cv2.putText(image, name, (20, 240), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255))
+    path = directory / (name + ".jpg")
+    path.write_bytes(cv2.imencode(".jpg", image)[1].tobytes())
+    if predictions is not None:
+        metadata = {"source": "ftp", "time": "now", "predictions": predictions}
+        (directory / (name + ".txt")).write_text(json.dumps(metadata))
+
+
+def recorded(tag, priority):
+    return {
+        "probability": 0.9,
+        "tagId": LABELS.index(tag),
+        "tagName": tag,
+        "boundingBox": {"left": 0.1, "top": 0.1, "width": 0.2, "height": 0.4},
+        "camName": "back yard",
+        "priority": priority,
+    }
+
+
+@pytest.fixture
+def config(tmp_path):
+    model = make_model(tmp_path / "fake.onnx", size=608)
+    labels = tmp_path / "labels.txt"
+    labels.write_text("\n".join(LABELS))
+    config = configparser.ConfigParser()
+    config.read_string("""
+[detector]
+threshold = 0.5
+labelfile-path = {labels}
+save-path = unused
+[color-model]
+onnx = {model}
+channels = 3
+height = 608
+width = 608
+prob_threshold = 0.4
+[thresholds]
+[colors]
+[sounds]
+departed = magic
+[priority]
+person = 0
+dog = -1
+[cam0]
+name = back yard
+""".format(labels=labels, model=model))
+    return config
+
+
+def test_recorded_frames(tmp_path):
+    save_frame(tmp_path, "101500-back_yard-person", 10, [recorded("person", 0)])
+    save_frame(tmp_path, "101500-back_yard-person-prior", 20)
+    save_frame(tmp_path, "101500-back_yard-person-annotated", 30)
+    (tmp_path / "101501-back_yard-codeproject.txt").write_text('{"success": true}')
+    save_frame(tmp_path, "101501-back_yard-codeproject", 40)
+    frames = recorded_frames([str(tmp_path)])
+    assert [jpg for jpg, _ in frames] == [str(tmp_path / "101500-back_yard-person.jpg")]
+
+
+def test_camera_of():
+    class Cam(object):
+        def __init__(self, name):
+            self.ha_name = name.replace(" ", "_")
+
+    cams = {"garage": Cam("garage"), "garage-l": Cam("garage-l")}
+    assert camera_of("/x/101500-garage-l-person.jpg", {"predictions": []}, cams) is (
+        cams["garage-l"]
+    )
+    assert camera_of("/x/101500-garage-dog.jpg", {"predictions": []}, cams) is (
+        cams["garage"]
+    )
+    assert camera_of("/x/101500-shed-dog.jpg", {"predictions": []}, cams) is None
+
+
+def test_replay(tmp_path, config):
+    day = tmp_path / "20240601"
+    day.mkdir()
+    save_frame(
+        day,
+        "101500-back_yard-person_dog",
+        10,
+        [recorded("person", 0), recorded("dog", -1)],
+    )
+    # the dog was notified when it was recorded
+    save_frame(
+        day,
+        "101700-back_yard-person_dog",
+        90,
+        [recorded("person", 0), recorded("dog", 1)],
+    )
+    save_frame(day, "101800-shed-person", 150, [])
+    report = replay(config, [str(day)])
+    assert report["frames"] == 3
+    assert report["replayed"] == 2
+    assert report["unknown"] == 1
+    assert report["matched"] == 1
+    [(jpg, before, after)] = report["differed"]
+    assert jpg.endswith("101700-back_yard-person_dog.jpg")
+    assert before == [("dog", 1), ("person", 0)]
+    assert after == [("dog", -1), ("person", 0)]
+    assert report["pushover"] == 2
+    assert report["fps"] > 0
+    assert report["stages"]["inference"]["count"] >= 2
+
+
+def test_replay_vacation(tmp_path, config):
+    save_frame(tmp_path, "101500-back_yard-person_dog", 10, [recorded("person", 0)])
+    report = replay(config, [str(tmp_path)], {"input_boolean.vacation_mode": "on"})
+    assert report["replayed"] == 1
+    assert report["pushover"] == 0
@@ -0,0 +1,169 @@
+"""When the main loop next reads each camera, as a heap of deadlines."""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Schedule(object):
+    """The deadline and intervals of one camera"""
+
+    __slots__ = [
+        "cam",
+        "interval",
+        "active_interval",
+        "idle_interval",
+        "idle_after",
+        "ftp_interval",
+        "snapshots",
+        "deadline",
+        "snapshot_at",
+        "delay",
+        "seq",
+        "snapshot",
+        "last_frame",
+        "last_active",
+    ]
+
+    def __init__(self, cam, config, now):
+        def setting(key, default):
+            return cam.config.getfloat(key, config.getfloat(key, default))
+
+        self.cam = cam
+        self.interval = cam.interval
+        self.active_interval = min(setting("active-interval", 1), self.interval)
+        self.idle_interval = max(
+            setting("idle-interval", self.interval * 4), self.interval
+        )
+        self.idle_after = setting("idle-after", 1800)
+        self.ftp_interval = setting("ftp-interval", 1)
+        # FTP cameras are also snapshot when they have a uri and go quiet
+        self.snapshots = not cam.ftp_path or "uri" in cam.config
+        self.deadline = now
+        self.snapshot_at = now
+        self.delay = 0.0
+        self.seq = None
+        self.snapshot = False
+        self.last_frame = now
+        self.last_active = now
+
+
+class Scheduler(object):
+    """The cameras' next due times, in a heap.
+
+    A snapshot camera is due interval seconds after it was read. While it
+    sees objects it is due every active-interval, and once it has seen
+    nothing for idle-after seconds, every idle-interval. After failed
+    snapshots it backs off for 2 ** (fails - 1) intervals, at most
+    max-backoff seconds. FTP cameras are polled again at once while files keep
+    coming, else every ftp-interval. Intervals may be set per camera or in
+    [detector].
+
+    due() hands out the cameras whose deadline has passed, the longest
+    overdue first whatever their source. A camera leaves the heap while it
+    is read and returns when done() is called with the outcome.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.max_backoff = config.getfloat("max-backoff", 300)
+        self.schedules = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+
+    def add(self, cam, now=None):
+        """Schedule a camera, due at once"""
+        now = time.monotonic() if now is None else now
+        with self.cond:
+            s = Schedule(cam, self.config, now)
+            self.schedules[cam.name] = s
+            self.push(s, now)
+
+    def push(self, s, deadline):
+        s.deadline = deadline
+        s.seq = next(self.counter)
+        heapq.heappush(self.heap, (deadline, s.seq, s))
+        self.cond.notify()
+
+    def due(self, now=None):
+        """Take the cameras due by now, as (cam, snapshot) where snapshot is
+        False when only its FTP uploads are to be read"""
+        now = time.monotonic() if now is None else now
+        cams = []
+        with self.cond:
+            while self.heap and self.heap[0][0] <= now:
+                _, seq, s = heapq.heappop(self.heap)
+                if seq != s.seq:
+                    # superseded by a later done()
+                    continue
+                s.seq = None
+                s.snapshot = s.snapshots and (
+                    not s.cam.ftp_path or now >= s.snapshot_at
+                )
+                cams.append((s.cam, s.snapshot))
+        return cams
+
+    def done(self, cam, fresh, now=None):
+        """Reschedule a camera after it was read, fresh when it had a new frame"""
+        now = time.monotonic() if now is None else now
+        with self.cond:
+            s = self.schedules[cam.name]
+            if fresh:
+                s.last_frame = now
+            if cam.objects:
+                s.last_active = now
+            if s.snapshot:
+                if cam.fails > 0:
+                    delay = min(2 ** (cam.fails - 1) * s.interval, self.max_backoff)
+                    metrics.count("skip", cam.name)
+                elif cam.objects:
+                    delay = s.active_interval
+                elif now - s.last_active > s.idle_after:
+                    delay = s.idle_interval
+                else:
+                    delay = s.interval
+                s.snapshot_at = now + delay
+            elif fresh:
+                # no need to snapshot while uploads keep coming
+                s.snapshot_at = max(s.snapshot_at, now + s.interval)
+            if cam.ftp_path:
+                delay = 0.0 if fresh else s.ftp_interval
+                if s.snapshots:
+                    delay = min(delay, max(s.snapshot_at - now, 0.0))
+            else:
+                delay = s.snapshot_at - now
+            s.delay = delay
+            self.push(s, now + delay)
+
+    def wait(self, timeout):
+        """Sleep until the next deadline or done(), at most timeout seconds"""
+        with self.cond:
+            if self.heap:
+                timeout = min(timeout, self.heap[0][0] - time.monotonic())
+            if timeout > 0:
+                self.cond.wait(timeout)
+
+    def staleness(self, now=None):
+        """Seconds since each camera last had a new frame"""
+        now = time.monotonic() if now is None else now
+        with self.cond:
+            return {name: now - s.last_frame for name, s in self.schedules.items()}
+
+    def stats(self, name, now=None):
+        """Staleness, current interval and time until due of one camera"""
+        now = time.monotonic() if now is None else now
+        with self.cond:
+            s = self.schedules[name]
+            return {
+                "staleness_seconds": round(now - s.last_frame, 3),
+                "interval_seconds": round(s.delay, 3),
+                "due_seconds": round(s.deadline - now, 3) if s.seq is not None else 0.0,
+                "reading": s.seq is None,
+            }
@@ -0,0 +1,105 @@
+import configparser
+
+from scheduler import Scheduler
+
+
+class FakeCamera(object):
+    def __init__(self, config, name, **options):
+        config[name] = dict(name=name, **options)
+        self.name = name
+        self.config = config[name]
+        self.interval = self.config.getint("interval", 30)
+        self.ftp_path = self.config.get("ftp-path", None)
+        self.objects = set()
+        self.fails = 0
+
+
+def make(**detector):
+    config = configparser.ConfigParser()
+    config["detector"] = detector
+    return config, Scheduler(config["detector"])
+
+
+def names(due):
+    return [(cam.name, snapshot) for cam, snapshot in due]
+
+
+def test_snapshot_intervals():
+    config, scheduler = make(**{"idle-after": "100"})
+    cam = FakeCamera(config, "deck", interval="10", **{"active-interval": "2"})
+    scheduler.add(cam, now=0)
+    assert names(scheduler.due(now=0)) == [("deck", True)]
+    # out of the heap while it is read
+    assert scheduler.due(now=50) == []
+    scheduler.done(cam, True, now=1)
+    assert scheduler.due(now=10) == []
+    assert names(scheduler.due(now=11)) == [("deck", True)]
+    cam.objects = {"person"}
+    scheduler.done(cam, True, now=11)
+    assert names(scheduler.due(now=13)) == [("deck", True)]
+    cam.objects = set()
+    scheduler.done(cam, True, now=13)
+    assert names(scheduler.due(now=23)) == [("deck", True)]
+    # quiet for over idle-after, 4 x interval
+    scheduler.done(cam, True, now=120)
+    assert scheduler.due(now=159) == []
+    assert names(scheduler.due(now=160)) == [("deck", True)]
+    assert scheduler.stats("deck", now=170)["staleness_seconds"] == 50
+
+
+def test_backoff():
+    config, scheduler = make(**{"max-backoff": "100"})
+    cam = FakeCamera(config, "drive", interval="10")
+    scheduler.add(cam, now=0)
+    deadlines = []
+    now = 0
+    for fails in range(1, 6):
+        assert names(scheduler.due(now=now)) == [("drive", True)]
+        cam.fails = fails
+        scheduler.done(cam, False, now=now)
+        now = scheduler.schedules["drive"].deadline
+        deadlines.append(now)
+    # 1, 2, 4, 8 intervals, at most max-backoff seconds
+    assert deadlines == [10, 30, 70, 150, 250]
+    assert scheduler.staleness(now=250) == {"drive": 250}
+
+
+def test_ftp_does_not_starve_snapshots():
+    config, scheduler = make()
+    ftp = FakeCamera(config, "porch", interval="10", **{"ftp-path": "/ftp/porch"})
+    http = FakeCamera(config, "yard", interval="5")
+    scheduler.add(ftp, now=0)
+    scheduler.add(http, now=0.5)
+    # the FTP camera has files every poll, the snapshot camera is still read
+    seen = []
+    for now in range(0, 12):
+        for cam, snapshot in scheduler.due(now=now):
+            seen.append((now, cam.name, snapshot))
+            scheduler.done(cam, cam is ftp, now=now)
+    assert [n for n, name, _ in seen if name == "yard"] == [1, 6, 11]
+    assert len([name for _, name, _ in seen if name == "porch"]) == 12
+    # no uri, so the FTP camera is never snapshot
+    assert not any(snapshot for _, name, snapshot in seen if name == "porch")
+
+
+def test_ftp_camera_snapshot_when_quiet():
+    config, scheduler = make(**{"ftp-interval": "2"})
+    cam = FakeCamera(
+        config,
+        "gate",
+        interval="10",
+        uri="http://gate/snap.jpg",
+        **{"ftp-path": "/ftp"},
+    )
+    scheduler.add(cam, now=0)
+    assert names(scheduler.due(now=0)) == [("gate", True)]
+    scheduler.done(cam, True, now=0)
+    assert names(scheduler.due(now=2)) == [("gate", False)]
+    # an upload puts off the snapshot
+    scheduler.done(cam, True, now=2)
+    assert names(scheduler.due(now=2)) == [("gate", False)]
+    scheduler.done(cam, False, now=2)
+    for now in (4, 6, 8, 10):
+        assert names(scheduler.due(now=now)) == [("gate", False)]
+        scheduler.done(cam, False, now=now)
+    assert names(scheduler.due(now=12)) == [("gate", True)]
@@ -1,7 +1,13 @@
 import sys
 
-from notify import edits1
+from plates import PlateFile
 
-plate = sys.argv[1]
-for p in edits1(plate):
-    print(p)
+# Usage: python test-plates.py PLATE [MAX_DISTANCE]
+max_distance = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+index = PlateFile("license-plates.json", max_distance).load()
+match = index.match(sys.argv[1])
+if match is None:
+    print("No known plate within {} edits".format(max_distance))
+else:
+    plate, distance, record = match
+    print("{} at distance {}: {}".format(plate, distance, record))
@@ -0,0 +1,190 @@
+"""Run the model over overlapping tiles or regions of a frame, not just the whole frame."""
+
+import math
+
+import cv2
+import numpy as np
+
+from object_detection_v4 import nms_cpu
+from utils import boxes_array
+
+# the whole frame, as a normalized (left, top, width, height) region
+FULL = (0.0, 0.0, 1.0, 1.0)
+
+
+def parse_regions(text):
+    """Regions from "left:top:width:height,..." in normalized coordinates"""
+    regions = []
+    for part in text.split(","):
+        values = tuple(float(v) for v in part.strip().split(":"))
+        if len(values) != 4:
+            raise ValueError("Expected left:top:width:height, got {}".format(part))
+        left, top, width, height = values
+        if width <= 0 or height <= 0 or left < 0 or top < 0:
+            raise ValueError("Invalid region {}".format(part))
+        if left + width > 1.0001 or top + height > 1.0001:
+            raise ValueError("Region {} extends past the frame".format(part))
+        regions.append(values)
+    return regions
+
+
+def grid(columns, rows, overlap=0.2):
+    """A columns x rows grid of regions, each overlapping its neighbours by overlap"""
+    regions = []
+    # tile size t with n tiles and overlap o covering 1: t * (n - (n - 1) * o) = 1
+    width = 1.0 / (columns - (columns - 1) * overlap)
+    height = 1.0 / (rows - (rows - 1) * overlap)
+    for row in range(rows):
+        for column in range(columns):
+            regions.append(
+                (
+                    column * width * (1 - overlap),
+                    row * height * (1 - overlap),
+                    width,
+                    height,
+                )
+            )
+    return regions
+
+
+def auto_grid(size, tile_size, overlap=0.2):
+    """Enough overlapping tiles of about tile_size pixels to cover a frame of size"""
+    width, height = size
+    step = tile_size * (1 - overlap)
+    # allow tiles a little larger than tile_size, rather than one more of them
+    columns = max(math.ceil((width - tile_size * overlap) / step - 0.25), 1)
+    rows = max(math.ceil((height - tile_size * overlap) / step - 0.25), 1)
+    if columns == 1 and rows == 1:
+        return []
+    return grid(columns, rows, overlap)
+
+
+def to_frame(predictions, region):
+    """Map predictions for a region to normalized coordinates of the whole frame"""
+    if region == FULL:
+        return predictions
+    left, top, width, height = region
+    mapped = []
+    for p in predictions:
+        box = p.boundingBox
+        p = p.copy()
+        p.boundingBox = {
+            "left": left + box["left"] * width,
+            "top": top + box["top"] * height,
+            "width": box["width"] * width,
+            "height": box["height"] * height,
+        }
+        mapped.append(p)
+    return mapped
+
+
+def merge(predictions, threshold=0.7):
+    """Class aware NMS across tiles.
+
+    Boxes are compared by their intersection over the smaller box, so an
+    object cut at the edge of one tile is suppressed by the whole box found
+    by a neighbouring tile or the full frame.
+    """
+    if len(predictions) < 2:
+        return predictions
+    boxes = boxes_array(p.boundingBox for p in predictions)
+    scores = np.array([p.probability for p in predictions])
+    tags = {tag: i for i, tag in enumerate(sorted(set(p.tagName for p in predictions)))}
+    # normalized boxes never reach 2, so shifted classes can't overlap
+    offsets = np.array([tags[p.tagName] * 2.0 for p in predictions])
+    keep = nms_cpu(boxes + offsets[:, np.newaxis], scores, threshold, min_mode=True)
+    return [predictions[i] for i in sorted(keep)]
+
+
+class Tiling(object):
+    """Which regions of a camera's frames are run through the model.
+
+    spec is "auto" for a grid of tiles of about tile_size pixels, "CxR" for
+    a grid of C columns and R rows, or a list of regions. With full, the
+    whole frame is run as well, for objects larger than a tile.
+    """
+
+    def __init__(self, spec, tile_size=1216, overlap=0.2, full=True, threshold=0.7):
+        self.spec = spec.strip()
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.full = full
+        self.threshold = threshold
+        self.fixed = None
+        self.cache = {}
+        if self.spec != "auto":
+            match = self.spec.lower().split("x")
+            if len(match) == 2 and all(v.strip().isdigit() for v in match):
+                self.fixed = grid(int(match[0]), int(match[1]), overlap)
+            else:
+                self.fixed = parse_regions(self.spec)
+
+    def regions(self, size):
+        """Regions for a frame of size (width, height), the full frame first"""
+        regions = self.cache.get(size)
+        if regions is None:
+            tiles = (
+                self.fixed
+                if self.fixed is not None
+                else auto_grid(size, self.tile_size, self.overlap)
+            )
+            regions = ([FULL] if self.full or not tiles else []) + [
+                r for r in tiles if r != FULL
+            ]
+            self.cache[size] = regions
+        return regions
+
+    def min_size(self, size, model_size):
+        """Smallest frame, for reduced decode, which keeps every tile at model_size"""
+        if self.fixed is None:
+            # the auto grid is sized in pixels of the full frame
+            return size
+        regions = self.regions(size)
+        return (
+            math.ceil(model_size[0] / min(r[2] for r in regions)),
+            math.ceil(model_size[1] / min(r[3] for r in regions)),
+        )
+
+    def crops(self, image, model_size):
+        """(region, crop resized to model_size) for every region but the full frame"""
+        height, width = image.shape[:2]
+        crops = []
+        for region in self.regions((width, height)):
+            if region == FULL:
+                continue
+            left, top, w, h = region
+            x1 = int(round(left * width))
+            y1 = int(round(top * height))
+            x2 = min(int(round((left + w) * width)), width)
+            y2 = min(int(round((top + h) * height)), height)
+            crops.append((region, cv2.resize(image[y1:y2, x1:x2], model_size)))
+        return crops
+
+
+def create_tiling(config):
+    """The tiling configured for a camera section, None without tiles"""
+    spec = config.get("tiles", None)
+    if not spec:
+        return None
+    return Tiling(
+        spec,
+        tile_size=config.getint("tile_size", 1216),
+        overlap=config.getfloat("tile_overlap", 0.2),
+        full=config.getboolean("tile_full", True),
+        threshold=config.getfloat("tile_nms", 0.7),
+    )
+
+
+def merge_tiles(tiles, predictions, threshold=0.7):
+    """Merge the predictions for each (region, image) of tiles into one frame"""
+    mapped = []
+    for (region, _), p in zip(tiles, predictions):
+        mapped += to_frame(p, region)
+    return merge(mapped, threshold) if len(tiles) > 1 else mapped
+
+
+def predict(model, tiles, threshold=0.7):
+    """Predict every tile in one call to the model and merge the results"""
+    return merge_tiles(
+        tiles, model.predict_images([image for _, image in tiles]), threshold
+    )
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import configparser
+
+import numpy as np
+import pytest
+
+from prediction import Prediction
+from tiling import (
+    FULL,
+    Tiling,
+    auto_grid,
+    create_tiling,
+    grid,
+    merge,
+    merge_tiles,
+    parse_regions,
+    to_frame,
+)
+
+
+def prediction(tag, left, top, width, height, probability=0.9):
+    return Prediction(
+        probability,
+        0,
+        tag,
+        {"left": left, "top": top, "width": width, "height": height},
+    )
+
+
+def test_parse_regions():
+    assert parse_regions("0:0.5:0.5:0.5, 0.5:0.5:0.5:0.5") == [
+        (0.0, 0.5, 0.5, 0.5),
+        (0.5, 0.5, 0.5, 0.5),
+    ]
+    with pytest.raises(ValueError):
+        parse_regions("0:0:0.5")
+    with pytest.raises(ValueError):
+        parse_regions("0.6:0:0.5:0.5")
+
+
+def test_grid_covers_frame_with_overlap():
+    regions = grid(3, 2, overlap=0.2)
+    assert len(regions) == 6
+    right = max(left + width for left, _, width, _ in regions)
+    bottom = max(top + height for _, top, _, height in regions)
+    assert right == pytest.approx(1.0)
+    assert bottom == pytest.approx(1.0)
+    first, second = regions[0], regions[1]
+    assert first[0] + first[2] - second[0] == pytest.approx(0.2 * first[2])
+
+
+def test_auto_grid():
+    assert len(auto_grid((2688, 1520), 1216)) == 6
+    assert auto_grid((1280, 720), 1216) == []
+
+
+def test_to_frame():
+    p = to_frame([prediction("deer", 0.5, 0.5, 0.1, 0.2)], (0.5, 0.0, 0.5, 0.5))[0]
+    assert p["boundingBox"] == pytest.approx(
+        {"left": 0.75, "top": 0.25, "width": 0.05, "height": 0.1}
+    )
+    assert p.tagName == "deer"
+
+
+def test_merge_suppresses_cut_boxes_by_class():
+    whole = prediction("person", 0.4, 0.4, 0.2, 0.4, 0.9)
+    cut = prediction("person", 0.4, 0.4, 0.1, 0.4, 0.6)
+    dog = prediction("dog", 0.4, 0.4, 0.1, 0.4, 0.6)
+    other = prediction("person", 0.8, 0.1, 0.1, 0.2, 0.5)
+    assert merge([cut, whole, dog, other]) == [whole, dog, other]
+
+
+def test_crops_and_reduced_size():
+    tiling = Tiling("2x1", overlap=0.0)
+    assert tiling.regions((1000, 500)) == [
+        FULL,
+        (0.0, 0.0, 0.5, 1.0),
+        (0.5, 0.0, 0.5, 1.0),
+    ]
+    image = np.zeros((500, 1000, 3), np.uint8)
+    image[:, 500:] = 255
+    crops = tiling.crops(image, (32, 32))
+    assert [region for region, _ in crops] == [
+        (0.0, 0.0, 0.5, 1.0),
+        (0.5, 0.0, 0.5, 1.0),
+    ]
+    assert crops[0][1].shape == (32, 32, 3)
+    assert crops[0][1].max() == 0 and crops[1][1].min() == 255
+    assert tiling.min_size((2688, 1520), (608, 608)) == (1216, 608)
+    assert Tiling("auto").min_size((2688, 1520), (608, 608)) == (2688, 1520)
+
+
+def test_create_tiling():
+    config = configparser.ConfigParser()
+    config.read_string("[cam]\nname = cam\n[tiled]\ntiles = auto\ntile_full = false\n")
+    assert create_tiling(config["cam"]) is None
+    tiling = create_tiling(config["tiled"])
+    assert not tiling.full
+    assert FULL not in tiling.regions((2688, 1520))
+    assert tiling.regions((640, 480)) == [FULL]
+
+
+def test_merge_tiles():
+    tiles = [(FULL, None), ((0.5, 0.0, 0.5, 0.5), None)]
+    predictions = [
+        [prediction("package", 0.7, 0.1, 0.1, 0.1, 0.5)],
+        [prediction("package", 0.4, 0.2, 0.2, 0.2, 0.8)],
+    ]
+    merged = merge_tiles(tiles, predictions)
+    assert len(merged) == 1
+    assert merged[0].probability == 0.8
+    assert merged[0].boundingBox["left"] == pytest.approx(0.7)
@@ -0,0 +1,129 @@
+"""Follow the objects a camera sees from frame to frame."""
+
+from datetime import datetime
+
+import numpy as np
+
+from sort import linear_assignment
+from utils import boxes_array, iou_matrix
+
+# attributes a prediction inherits from the track it continues
+INHERITED = ["age", "ignore", "priority", "priority_type", "start_time"]
+
+
+class Tracker(object):
+    """The tracked objects of one camera, per class.
+
+    Each class keeps arrays of track boxes, last seen times and ages, next to
+    the Predictions which started the tracks. A frame's predictions are
+    assigned one to one to tracks of their class by Hungarian matching on
+    IoU; pairs need an IoU over threshold. A track expires when it hasn't
+    been seen for 1 minute plus its age in camera intervals, at most 60
+    minutes.
+    """
+
+    def __init__(self, interval, threshold=0.5):
+        self.interval = interval
+        self.threshold = threshold
+        self.boxes = {}
+        self.last_seen = {}
+        self.ages = {}
+        self.items = {}
+
+    def __len__(self):
+        return sum(len(items) for items in self.items.values())
+
+    def tracks(self):
+        """The Prediction which started each track"""
+        return [item for items in self.items.values() for item in items]
+
+    def match(self, tag, predictions, now):
+        """Update the tracks of tag, returning the predictions which start new ones"""
+        boxes = boxes_array(p.boundingBox for p in predictions)
+        matched = np.zeros(len(predictions), dtype=bool)
+        if tag in self.boxes and len(self.boxes[tag]):
+            iou = iou_matrix(boxes, self.boxes[tag])
+            for row, col in linear_assignment(-iou):
+                if iou[row, col] <= self.threshold:
+                    continue
+                matched[row] = True
+                p = predictions[row]
+                p.iou = float(iou[row, col])
+                self.boxes[tag][col] = boxes[row]
+                self.last_seen[tag][col] = now.timestamp()
+                self.ages[tag][col] += 1
+                item = self.items[tag][col]
+                item.boundingBox = p.boundingBox  # move the box to current
+                item.last_time = now
+                item.age = int(self.ages[tag][col])
+                for t in INHERITED:
+                    value = getattr(item, t)
+                    if value is not None:
+                        setattr(p, t, value)
+        new = [p for p, m in zip(predictions, matched) if not m]
+        for p in new:
+            p.start_time = now
+            p.last_time = now
+            p.age = 0
+        if new:
+            self.boxes[tag] = np.concatenate(
+                [self.boxes.get(tag, np.empty((0, 4))), boxes[~matched]]
+            )
+            self.last_seen[tag] = np.concatenate(
+                [
+                    self.last_seen.get(tag, np.empty(0)),
+                    np.full(len(new), now.timestamp()),
+                ]
+            )
+            self.ages[tag] = np.concatenate(
+                [
+                    self.ages.get(tag, np.empty(0, dtype=np.int64)),
+                    np.zeros(len(new), dtype=np.int64),
+                ]
+            )
+            self.items.setdefault(tag, []).extend(new)
+        return new
+
+    def expire(self, now):
+        """Remove and return the tracks not seen for too long"""
+        expired = []
+        for tag in list(self.items):
+            expiry_minutes = np.minimum(1 + self.ages[tag] * self.interval / 60, 60)
+            gone = self.last_seen[tag] < now.timestamp() - expiry_minutes * 60
+            if not gone.any():
+                continue
+            expired += [item for item, g in zip(self.items[tag], gone) if g]
+            keep = ~gone
+            self.boxes[tag] = self.boxes[tag][keep]
+            self.last_seen[tag] = self.last_seen[tag][keep]
+            self.ages[tag] = self.ages[tag][keep]
+            self.items[tag] = [item for item, k in zip(self.items[tag], keep) if k]
+        return expired
+
+    def update(self, predictions, now=None):
+        """Match a frame's predictions to the tracks.
+
+        Matched predictions get iou and the age, ignore, priority and
+        start_time of their track. The others start tracks, with start_time, last_time and age 0.
+
+        Returns:
+            (predictions which started tracks, tracks which expired)
+        """
+        if now is None:
+            now = datetime.now()
+        by_tag = {}
+        for p in predictions:
+            by_tag.setdefault(p.tagName, []).append(p)
+        new = set()
+        for tag, group in by_tag.items():
+            new.update(id(p) for p in self.match(tag, group, now))
+        return [p for p in predictions if id(p) in new], self.expire(now)
+
+    def keep_alive(self, now=None):
+        """Mark every track as just seen, when the scene hasn't changed"""
+        if now is None:
+            now = datetime.now()
+        for tag, items in self.items.items():
+            self.last_seen[tag][:] = now.timestamp()
+            for item in items:
+                item.last_time = now
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+from datetime import datetime, timedelta
+
+from prediction import Prediction
+from tracker import Tracker
+
+START = datetime(2024, 6, 1, 12, 0, 0)
+
+
+def prediction(tag, left, top, width=0.1, height=0.2):
+    return Prediction(
+        0.9, 0, tag, {"left": left, "top": top, "width": width, "height": height}
+    )
+
+
+def at(seconds):
+    return START + timedelta(seconds=seconds)
+
+
+def test_tracks_follow_objects():
+    tracker = Tracker(interval=30)
+    first = prediction("person", 0.1, 0.1)
+    new, expired = tracker.update([first], at(0))
+    assert new == [first]
+    assert first["age"] == 0 and first["start_time"] == at(0)
+    # notify marks the track
+    first["priority"] = 1
+    moved = prediction("person", 0.11, 0.1)
+    new, expired = tracker.update([moved], at(30))
+    assert new == [] and expired == []
+    assert moved["age"] == 1
+    assert moved["priority"] == 1
+    assert moved["start_time"] == at(0)
+    assert moved["iou"] > 0.5
+    assert first["boundingBox"] is moved["boundingBox"]
+    assert first["last_time"] == at(30)
+    assert len(tracker) == 1
+
+
+def test_one_to_one_assignment():
+    tracker = Tracker(interval=30)
+    tracker.update([prediction("bird", 0.1, 0.1), prediction("bird", 0.5, 0.5)], at(0))
+    # three birds, two close to the tracked ones
+    birds = [
+        prediction("bird", 0.51, 0.5),
+        prediction("bird", 0.1, 0.11),
+        prediction("bird", 0.11, 0.1),
+    ]
+    new, _ = tracker.update(birds, at(30))
+    assert birds[0]["age"] == 1
+    assert len(new) == 1
+    assert new[0] in birds[1:]
+    assert len(tracker) == 3
+
+
+def test_classes_tracked_separately():
+    tracker = Tracker(interval=30)
+    tracker.update([prediction("dog", 0.1, 0.1)], at(0))
+    new, _ = tracker.update([prediction("cat", 0.1, 0.1)], at(30))
+    assert len(new) == 1
+    assert len(tracker) == 2
+
+
+def test_expiry_grows_with_age():
+    tracker = Tracker(interval=60)
+    deer = prediction("deer", 0.3, 0.3)
+    package = prediction("package", 0.7, 0.7)
+    tracker.update([deer, package], at(0))
+    for t in (30, 50):
+        tracker.update([prediction("package", 0.7, 0.7)], at(t))
+    assert package["age"] == 2
+    # age 0: 1 minute
+    _, expired = tracker.update([], at(59))
+    assert expired == []
+    _, expired = tracker.update([], at(61))
+    assert expired == [deer]
+    # age 2 at one minute intervals: 3 minutes after it was last seen
+    _, expired = tracker.update([], at(50 + 179))
+    assert expired == []
+    _, expired = tracker.update([], at(50 + 181))
+    assert expired == [package]
+    assert len(tracker) == 0
+
+
+def test_keep_alive():
+    tracker = Tracker(interval=30)
+    person = prediction("person", 0.2, 0.2)
+    tracker.update([person], at(0))
+    tracker.keep_alive(at(50))
+    assert person["last_time"] == at(50)
+    _, expired = tracker.update([], at(100))
+    assert expired == []
+    assert tracker.tracks() == [person]
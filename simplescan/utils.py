@@ -2,6 +2,7 @@ import logging
 import os
 from pathlib import Path
 
+import numpy as np
 from PIL import ImageColor, ImageDraw, ImageFont
 
 log = logging.getLogger(__name__)
@@ -78,6 +79,41 @@ def bb_intersection_over_union(boxA, boxB):
         return iou
 
 
+def boxes_array(boxes):
+    """(n, 4) array of x1, y1, x2, y2 for boundingBox dicts"""
+    return np.array(
+        [
+            (b["left"], b["top"], b["left"] + b["width"], b["top"] + b["height"])
+            for b in boxes
+        ],
+        dtype=np.float64,
+    ).reshape(-1, 4)
+
+
+def iou_matrix(a, b):
+    """IoU of every box in a with every box in b, both (n, 4) x1, y1, x2, y2 arrays.
+
+    Same as bb_intersection_over_union for boundingBox dicts, including 0.0
+    when both boxes are empty.
+    """
+    w = np.maximum(
+        0.0,
+        np.minimum(a[:, None, 2], b[None, :, 2])
+        - np.maximum(a[:, None, 0], b[None, :, 0]),
+    )
+    h = np.maximum(
+        0.0,
+        np.minimum(a[:, None, 3], b[None, :, 3])
+        - np.maximum(a[:, None, 1], b[None, :, 1]),
+    )
+    inter = w * h
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    denominator = area_a[:, None] + area_b[None, :] - inter
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denominator == 0, 0.0, inter / denominator)
+
+
 def cleanup(directory_name, children_only=True):
     directory = Path(directory_name)
     if not directory.exists():
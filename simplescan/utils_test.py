@@ -1,8 +1,29 @@
 #!/usr/bin/env python3
+import numpy as np
+import pytest
 from PIL import ImageColor
 
+from utils import bb_intersection_over_union, boxes_array, iou_matrix
+
 
 def test_colors():
     for color in ["grey", "red"]:
         rgba = ImageColor.getrgb(color) + (128,)
         assert rgba is not None
+
+
+def test_iou_matrix_matches_pairwise():
+    rng = np.random.RandomState(1)
+    boxes = [
+        {"left": l, "top": t, "width": w, "height": h}
+        for l, t, w, h in rng.uniform(0, 0.5, (12, 4))
+    ]
+    boxes.append({"left": 0.1, "top": 0.1, "width": 0.0, "height": 0.0})
+    matrix = iou_matrix(boxes_array(boxes[:5]), boxes_array(boxes))
+    assert matrix.shape == (5, len(boxes))
+    for i, a in enumerate(boxes[:5]):
+        for j, b in enumerate(boxes):
+            assert matrix[i, j] == pytest.approx(bb_intersection_over_union(a, b))
+    empty = boxes_array(boxes[-1:])
+    assert iou_matrix(empty, empty)[0, 0] == 0.0
+    assert iou_matrix(boxes_array([]), boxes_array(boxes)).shape == (0, len(boxes))